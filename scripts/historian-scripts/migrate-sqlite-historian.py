@@ -0,0 +1,133 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+'''Convert a SQLite historian database to the partitioned schema.
+
+Copies every reading from the flat data table into the monthly
+data_YYYYMM tables used when the SQLHistorian's sqlite connection has
+"schema": "partitioned", then drops the flat table and compacts the
+file. The conversion is done in place; stop the historian and back up
+the database first.
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/historian-scripts/migrate-sqlite-historian.py \
+        ~/.volttron/data/platform.historian.sqlite
+'''
+
+import argparse
+import os
+import sqlite3
+import sys
+
+from dateutil.parser import parse
+from zmq.utils import jsonapi
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'services', 'core',
+                                'SQLHistorian'))
+
+from sqlhistorian.db.sqlitefuncts import SqlLiteFuncts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('database', help='historian database to convert')
+    parser.add_argument('--batch', type=int, default=10000,
+                        help='readings copied per transaction')
+    parser.add_argument('--keep-flat', action='store_true',
+                        help='keep the flat data table after copying it')
+    args = parser.parse_args()
+
+    database = os.path.expandvars(os.path.expanduser(args.database))
+    if not os.path.exists(database):
+        parser.error('{} does not exist'.format(database))
+    source = sqlite3.connect(database)
+    if not source.execute('''SELECT COUNT(*) FROM sqlite_master
+                             WHERE type = 'table' AND name = 'data' '''
+                          ).fetchone()[0]:
+        parser.error('{} has no flat data table'.format(database))
+
+    writer = SqlLiteFuncts(database=database, schema='partitioned')
+    copied = 0
+    last = 0
+    while True:
+        # Page by rowid so no read is open while the writer commits.
+        rows = source.execute('''SELECT rowid, ts, topic_id, value_string
+                                 FROM data WHERE rowid > ?
+                                 ORDER BY rowid LIMIT ?''',
+                              (last, args.batch)).fetchall()
+        if not rows:
+            break
+        readings = [(parse(ts), topic_id, jsonapi.loads(value))
+                    for _, ts, topic_id, value in rows]
+        writer.prepare_insert(ts for ts, _, _ in readings)
+        writer.insert_data_many(readings)
+        if not writer.commit():
+            sys.exit('failed to commit readings after rowid {}'.format(last))
+        last = rows[-1][0]
+        copied += len(rows)
+        print('copied {} readings'.format(copied))
+
+    if not args.keep_flat:
+        source.execute('DROP INDEX IF EXISTS data_idx')
+        source.execute('DROP TABLE data')
+        source.commit()
+        source.execute('VACUUM')
+    source.close()
+    print('partitions: {}'.format(', '.join(writer.get_partitions())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+
+'''Measure sustained throughput of the historian backup cache.
+
+Passes simulated device scrapes through BaseHistorianAgent's
+capture_device_data and _backup_new_to_publish, which store them in
+backup.sqlite, and reports the readings written per second. It then
+drains the cache the way the processing loop does, reading records
+for publish_to_historian and removing them once they are handled, and
+reports the readings read per second, optionally simulating a sink
+with a fixed latency per batch and publishing several batches at
+once. The database is created in a temporary directory.
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/backup_cache.py
+'''
+
+import argparse
+from collections import defaultdict
+import datetime
+import os
+from Queue import Queue
+import random
+import shutil
+import tempfile
+from threading import local
+import time
+
+from volttron.platform.agent.base_historian import BaseHistorianAgent
+from volttron.platform.messaging import headers as headers_mod
+
+
+class BenchmarkHistorian(BaseHistorianAgent):
+    latency = 0
+
+    def publish_to_historian(self, to_publish_list):
+        for record in to_publish_list:
+            pass
+        if self.latency:
+            time.sleep(self.latency)
+        self.report_all_handled()
+
+
+def make_historian(columnar):
+    '''Return a historian with a backup database but no agent core.'''
+    historian = BaseHistorianAgent.__new__(BenchmarkHistorian)
+    historian._columnar_backup = columnar
+    historian._submit_size_limit = 1000
+    historian._publish_local = local()
+    historian._publish_pool = None
+    historian._backup_cache = {}
+    historian._meta_data = defaultdict(dict)
+    historian._point_lists = {}
+    historian._point_list_ids = {}
+    historian._event_queue = Queue()
+    historian._queue_high_water = 10000
+    historian._queue_low_water = 5000
+    historian._queue_overflow = 'drop'
+    historian._queue_throttled = False
+    historian._backup_batch_size = 1000
+    historian._backup_batch_period = 1.0
+    historian._retry_period = 300.0
+    historian._ingest_stats = defaultdict(int)
+    historian._setup_backup_db()
+    return historian
+
+
+def scrape(devices, points, timestamp):
+    '''Return the (topic, headers, message) of each device's all publish.'''
+    headers = {headers_mod.DATE: timestamp.isoformat() + 'Z'}
+    meta = {'units': 'degreesFahrenheit', 'type': 'float', 'tz': 'US/Pacific'}
+    publishes = []
+    for device in range(devices):
+        values = {}
+        for point in range(points):
+            values['point%d' % point] = round(random.uniform(0, 1000), 3)
+        publishes.append(('devices/campus/building/device%d/all' % device,
+                          headers, [values, {name: meta for name in values}]))
+    return publishes
+
+
+def capture(historian, publishes, batch):
+    '''Capture publishes, backing up batch devices at a time.'''
+    for start in range(0, len(publishes), batch):
+        for topic, headers, message in publishes[start:start + batch]:
+            historian.capture_device_data(None, 'platform.driver', '',
+                                          topic, headers, message)
+        historian._backup_new_to_publish(historian._get_batch(False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--devices', type=int, default=10,
+                        help='devices publishing each scrape')
+    parser.add_argument('--points', type=int, default=200,
+                        help='points per device')
+    parser.add_argument('--scrapes', type=int, default=20,
+                        help='scrapes to write')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='devices written per call, as when the '
+                             'processing loop drains several messages')
+    parser.add_argument('--per-point', action='store_true',
+                        help='cache one row per point instead of per scrape')
+    parser.add_argument('--publish-latency', type=float, default=0,
+                        help='seconds the simulated sink takes per batch')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='batches published at once')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        historian = make_historian(not args.per_point)
+        historian.latency = args.publish_latency
+        historian.concurrent_publishes = args.concurrency
+        start = datetime.datetime.utcnow()
+        # The first scrape also creates the topics.
+        capture(historian, scrape(args.devices, args.points, start),
+                args.devices)
+
+        scrapes = [scrape(args.devices, args.points,
+                          start + datetime.timedelta(seconds=i))
+                   for i in range(1, args.scrapes)]
+        readings = args.devices * args.points * len(scrapes)
+        begin = time.time()
+        for publishes in scrapes:
+            capture(historian, publishes, args.batch)
+        elapsed = time.time() - begin
+        rows = sum(historian._connection.execute(
+            'SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+            for table in ('outstanding', 'outstanding_scrapes'))
+        print('write: %d readings (%d rows) in %.2f s: %.0f readings/s' % (
+            readings, rows, elapsed, readings / elapsed))
+
+        published = args.devices * args.points * args.scrapes
+        begin = time.time()
+        while historian._publish_batches():
+            pass
+        elapsed = time.time() - begin
+        print('read: %d readings in %.2f s: %.0f readings/s' % (
+            published, elapsed, published / elapsed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+'''Compare message encodings using device scrape messages.
+
+Builds the devices/.../all message a driver would publish for the
+points in a registry configuration and reports the encoded size and
+the encode and decode times of each available encoding, both for the
+pubsub.publish RPC request sent by the driver and for the push
+delivered to each subscriber.
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/message_encoding.py
+'''
+
+import argparse
+from csv import DictReader
+import datetime
+import random
+import timeit
+
+from volttron.platform import jsonrpc
+from volttron.platform.messaging import headers as headers_mod
+from volttron.platform.vip.agent.serialization import ENCODINGS, dumps, loads
+
+
+def build_scrape(registry, copies):
+    '''Return (topic, headers, message) for an all publish.'''
+    with open(registry, 'rb') as registry_file:
+        names = [row['Volttron Point Name'] for row in DictReader(registry_file)]
+    values = {}
+    meta = {}
+    for copy in range(copies):
+        for name in names:
+            if copies > 1:
+                name = '%s%d' % (name, copy)
+            values[name] = round(random.uniform(0, 1000), 3)
+            meta[name] = {'units': 'degreesFahrenheit', 'type': 'float',
+                          'tz': 'US/Pacific'}
+    headers = {headers_mod.DATE:
+               datetime.datetime.utcnow().isoformat(' ') + 'Z'}
+    return 'devices/campus/building/unit/all', headers, [values, meta]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--registry',
+                        default='volttron/drivers/bacnet_example_config.csv',
+                        help='registry configuration to take points from')
+    parser.add_argument('--copies', type=int, default=1,
+                        help='repeat the registry points to grow the device')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='encodes and decodes timed per measurement')
+    args = parser.parse_args()
+
+    topic, headers, message = build_scrape(args.registry, args.copies)
+    payloads = [
+        ('publish request', jsonrpc.json_method(
+            '12345.67890', 'pubsub.publish', None,
+            {'topic': topic, 'headers': headers,
+             'message': message, 'bus': ''})),
+        ('push', ['platform.driver', '', topic, headers, message]),
+    ]
+    print('%d points' % len(message[0]))
+    print('%-16s %-8s %10s %14s %14s' % (
+        'message', 'encoding', 'bytes', 'encode (us)', 'decode (us)'))
+    for name, payload in payloads:
+        for encoding in ENCODINGS:
+            data = dumps(payload, encoding)
+            encode = timeit.timeit(lambda: dumps(payload, encoding),
+                                   number=args.number)
+            decode = timeit.timeit(lambda: loads(data), number=args.number)
+            print('%-16s %-8s %10d %14.1f %14.1f' % (
+                name, encoding, len(data), encode * 1e6 / args.number,
+                decode * 1e6 / args.number))
+
+
+if __name__ == '__main__':
+    main()
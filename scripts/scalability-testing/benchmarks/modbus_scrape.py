@@ -0,0 +1,260 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+'''Measure Modbus scrape cost with and without gap-aware read planning.
+
+Generates a registry with points in a few clusters spread over a wide
+address span, serves it from the virtual Modbus device in
+scripts/scalability-testing/virtual-drivers/modbus.py and scrapes it
+through the master driver's modbus Interface. Each scrape is made once
+reading the whole span in MODBUS_READ_MAX chunks, as the driver used
+to, and once with the planned reads, reporting the reads, registers
+read and time per scrape for both.
+
+With --devices, that many devices spread over --gateways virtual
+devices are then scraped concurrently, as the master driver's device
+greenlets do each interval, reporting the time for every device to be
+scraped. --latency slows each virtual device's answers to model real
+gateways, e.g. 1000 devices behind 50 gateways answering in 20 ms:
+
+    python scripts/scalability-testing/benchmarks/modbus_scrape.py \
+        --devices 1000 --gateways 50 --latency 0.02
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/modbus_scrape.py
+'''
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, os.pardir, 'services', 'core',
+                                'MasterDriverAgent'))
+
+from master_driver.driver_locks import configure_socket_lock
+from master_driver.interfaces import modbus
+
+VIRTUAL_DEVICE = os.path.join(os.path.dirname(__file__), os.pardir,
+                              'virtual-drivers', 'modbus.py')
+
+REGISTRY_HEADER = ('Reference Point Name,Volttron Point Name,Units,'
+                   'Units Details,Modbus Register,Writable,Point Address,'
+                   'Notes\n')
+
+# Each point type the virtual device serves: (Modbus Register, Writable).
+POINT_TYPES = [('>f', 'TRUE'), ('>f', 'FALSE'),
+               ('BOOL', 'TRUE'), ('BOOL', 'FALSE')]
+
+
+def make_registry(points, clusters, span):
+    '''Return registry CSV text with points grouped into clusters.'''
+    lines = [REGISTRY_HEADER]
+    starts = [span * i // clusters for i in range(clusters)]
+    for index, (io_type, writable) in enumerate(POINT_TYPES):
+        for i in range(points // len(POINT_TYPES)):
+            address = starts[i % clusters] + (i // clusters) * 2
+            name = 'point%d_%d' % (index, i)
+            lines.append('%s,%s,units,,%s,%s,%d,\n' % (
+                name, name, io_type, writable, address))
+    return ''.join(lines)
+
+
+def span_plan(registers, max_count):
+    '''Reads covering every address between the first and last register.'''
+    if not registers:
+        return []
+    start = min(r.address for r in registers)
+    end = max(r.address + r.get_register_count() - 1 for r in registers)
+    reads = []
+    for group in range(start, end + 1, max_count):
+        count = min(end - group + 1, max_count)
+        members = [r for r in registers
+                   if group <= r.address < group + count]
+        for r in members:
+            count = max(count, r.address + r.get_register_count() - group)
+        reads.append((group, count, members))
+    return reads
+
+
+class SpanInterface(modbus.Interface):
+    '''Interface that reads the whole register span as before planning.'''
+    def get_read_plan(self, register_type, read_only):
+        return span_plan(self.registers[(register_type, read_only)],
+                         self.max_read_count)
+
+
+def measure(interface, scrapes):
+    reads = registers = 0
+    for register_type in ('byte', 'bit'):
+        for read_only in (True, False):
+            for start, count, members in interface.get_read_plan(
+                    register_type, read_only):
+                reads += 1
+                registers += count
+    begin = time.time()
+    for i in range(scrapes):
+        if interface.scrape_all() is None:
+            raise RuntimeError('scrape failed')
+    elapsed = time.time() - begin
+    return reads, registers, elapsed / scrapes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--points', type=int, default=40,
+                        help='points in the registry, split between '
+                             'holding, input, coil and discrete registers')
+    parser.add_argument('--clusters', type=int, default=4,
+                        help='groups of neighbouring points')
+    parser.add_argument('--span', type=int, default=40000,
+                        help='addresses the clusters are spread over')
+    parser.add_argument('--scrapes', type=int, default=20,
+                        help='scrapes to time for each strategy')
+    parser.add_argument('--max-read-count', type=int,
+                        default=modbus.MODBUS_READ_MAX,
+                        help='registers or bits per read')
+    parser.add_argument('--max-read-gap', type=int,
+                        default=modbus.MODBUS_READ_GAP,
+                        help='unused addresses a planned read may span')
+    parser.add_argument('--devices', type=int, default=0,
+                        help='devices to scrape concurrently')
+    parser.add_argument('--gateways', type=int, default=1,
+                        help='virtual devices the devices are spread over')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each virtual device takes to answer')
+    parser.add_argument('--max-concurrent-requests', type=int,
+                        default=modbus.DEFAULT_MAX_CONCURRENT_REQUESTS,
+                        help='requests in flight per gateway')
+    parser.add_argument('--port', type=int, default=5020,
+                        help='port for the first virtual device')
+    args = parser.parse_args()
+    configure_socket_lock()
+
+    directory = tempfile.mkdtemp()
+    registry = make_registry(args.points, args.clusters, args.span)
+    registry_path = os.path.join(directory, 'registry.csv')
+    with open(registry_path, 'w') as registry_file:
+        registry_file.write(registry)
+    ports = range(args.port, args.port + args.gateways)
+    devices = []
+    with open(os.devnull, 'w') as devnull:
+        for port in ports:
+            devices.append(subprocess.Popen(
+                [sys.executable, VIRTUAL_DEVICE, registry_path,
+                 '--port', str(port), '--latency', str(args.latency)],
+                stdout=devnull, stderr=devnull))
+    try:
+        for port in ports:
+            for attempt in range(50):
+                try:
+                    socket.create_connection(('localhost', port)).close()
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+            else:
+                raise RuntimeError('virtual device did not start')
+        config = {'device_address': 'localhost', 'port': args.port,
+                  'max_concurrent_requests': args.max_concurrent_requests,
+                  'max_read_count': args.max_read_count,
+                  'max_read_gap': args.max_read_gap}
+        for name, cls in (('span', SpanInterface),
+                          ('planned', modbus.Interface)):
+            interface = cls()
+            interface.configure(config, registry)
+            reads, registers, per_scrape = measure(interface, args.scrapes)
+            print('%s: %d reads, %d registers read, %.1f ms/scrape' % (
+                name, reads, registers, per_scrape * 1000))
+
+        if args.devices:
+            interfaces = []
+            for i in range(args.devices):
+                interface = modbus.Interface()
+                interface.configure(dict(config, port=ports[i % len(ports)],
+                                         slave_id=i // len(ports) % 247),
+                                    registry)
+                interfaces.append(interface)
+            rounds = []
+            for i in range(args.scrapes):
+                begin = time.time()
+                scrapes = [gevent.spawn(interface.scrape_all)
+                           for interface in interfaces]
+                gevent.joinall(scrapes)
+                rounds.append(time.time() - begin)
+                failed = sum(1 for scrape in scrapes if scrape.value is None)
+                if failed:
+                    raise RuntimeError('%d scrapes failed' % failed)
+            rounds.sort()
+            print('concurrent: %d devices on %d gateways: median %.2f s, '
+                  'max %.2f s to scrape every device' % (
+                      args.devices, args.gateways,
+                      rounds[len(rounds) // 2], rounds[-1]))
+    finally:
+        for device in devices:
+            device.terminate()
+            device.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
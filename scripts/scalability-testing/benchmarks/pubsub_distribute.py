@@ -0,0 +1,153 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+'''Microbenchmark of pubsub subscriber lookup against subscription count.
+
+Measures the time taken to resolve the subscribers of a device topic
+using the prefix tree and the linear prefix scan used previously, along
+with the total cost of PubSub._distribute using a socket that discards
+everything sent.
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/pubsub_distribute.py
+'''
+
+import argparse
+import timeit
+import weakref
+
+from volttron.platform.vip.agent.serialization import JSON
+from volttron.platform.vip.agent.subsystems.pubsub import PubSub
+
+
+class NullSocket(object):
+    identity = b'pubsub'
+
+    def send(self, frame, flags=0, copy=True, track=False):
+        pass
+
+    def send_multipart(self, frames, flags=0, copy=True, track=False):
+        pass
+
+
+class NullCore(object):
+    socket = NullSocket()
+
+
+class NullRPC(object):
+    def peer_encoding(self, peer):
+        return JSON
+
+
+def make_pubsub(count, agents):
+    '''Build a PubSub service with count device prefix subscriptions.'''
+    core = NullCore()
+    rpc = NullRPC()
+    pubsub = PubSub.__new__(PubSub)
+    pubsub.core = weakref.ref(core)
+    pubsub.rpc = weakref.ref(rpc)
+    pubsub._peer_subscriptions = {}
+    pubsub._peer_subscription_index = {}
+    pubsub._my_subscriptions = {}
+    pubsub.add_bus('')
+    for i in range(count):
+        prefix = 'devices/campus/building%d/unit%d' % (i // 50, i % 50)
+        pubsub._add_peer_subscription('agent%d' % (i % agents), '', prefix)
+    return pubsub, core, rpc
+
+
+def linear_lookup(subscriptions, topic):
+    subscribers = set()
+    for prefix, subscription in subscriptions.iteritems():
+        if subscription and topic.startswith(prefix):
+            subscribers |= subscription
+    return subscribers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000, 10000],
+                        help='subscription counts to measure')
+    parser.add_argument('--agents', type=int, default=100,
+                        help='number of distinct subscribing peers')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='publishes timed per measurement')
+    args = parser.parse_args()
+
+    topic = 'devices/campus/building3/unit7/all'
+    print('%10s %14s %14s %18s' % (
+        'prefixes', 'tree (us)', 'linear (us)', 'distribute (us)'))
+    for count in args.counts:
+        pubsub, core, rpc = make_pubsub(count, args.agents)
+        subscriptions = pubsub._peer_subscriptions['']
+        index = pubsub._peer_subscription_index['']
+        results = [
+            timeit.timeit(lambda: index.match(topic), number=args.number),
+            timeit.timeit(lambda: linear_lookup(subscriptions, topic),
+                          number=args.number),
+            timeit.timeit(
+                lambda: pubsub._distribute('publisher', topic, {}, [1.0]),
+                number=args.number),
+        ]
+        print('%10d %14.2f %14.2f %18.2f' % (
+            (count,) + tuple(r * 1e6 / args.number for r in results)))
+
+
+if __name__ == '__main__':
+    main()
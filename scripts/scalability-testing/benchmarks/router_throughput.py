@@ -0,0 +1,229 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+'''Benchmark VIP router throughput with a slow consumer on the bus.
+
+Starts a router in a thread and connects N agents which each send M
+messages per second. Most messages go to a fast sink; a fraction go to
+a slow sink which reads with a delay, as a busy agent would. Messages
+delivered to each sink and errors bounced back to the senders are
+reported for each router queue limit given; a limit of 0 is the
+original behavior of bouncing EAGAIN errors immediately.
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/router_throughput.py
+'''
+
+import argparse
+import os
+import threading
+import time
+
+import zmq
+
+from volttron.platform.main import Router
+
+
+class Sink(threading.Thread):
+    def __init__(self, context, address, identity, delay=0, hwm=1000):
+        super(Sink, self).__init__()
+        self.daemon = True
+        self.socket = sock = context.socket(zmq.DEALER)
+        sock.identity = identity
+        sock.rcvhwm = hwm
+        sock.connect(address)
+        # Announce the peer so the router can route to it.
+        sock.send_multipart([b'', b'VIP1', b'', b'hello', b'hello'])
+        sock.recv_multipart()
+        self.delay = delay
+        self.received = 0
+        self.running = True
+
+    def run(self):
+        sock = self.socket
+        # Keep reading until stopped and nothing more is arriving.
+        while sock.poll(1000) or self.running:
+            if not sock.poll(0):
+                continue
+            if sock.recv_multipart()[4] != b'bench':
+                continue
+            self.received += 1
+            if self.delay:
+                time.sleep(self.delay)
+        sock.close(0)
+
+
+class Sender(threading.Thread):
+    def __init__(self, context, address, identity, rate, duration,
+                 slow_every, size):
+        super(Sender, self).__init__()
+        self.daemon = True
+        self.socket = sock = context.socket(zmq.DEALER)
+        sock.identity = identity
+        sock.connect(address)
+        self.rate = rate
+        self.duration = duration
+        self.slow_every = slow_every
+        self.payload = b'x' * size
+        self.sent = 0
+        self.errors = 0
+
+    def run(self):
+        sock = self.socket
+        payload = self.payload
+        interval = 1.0 / self.rate
+        start = time.time()
+        deadline = start
+        while deadline - start < self.duration:
+            slow = self.slow_every and not self.sent % self.slow_every
+            sock.send_multipart([b'slow' if slow else b'fast', b'VIP1',
+                                 b'', b'', b'bench', payload])
+            self.sent += 1
+            while sock.poll(0):
+                if sock.recv_multipart()[4] == b'error':
+                    self.errors += 1
+            deadline += interval
+            timeout = deadline - time.time()
+            if timeout > 0:
+                time.sleep(timeout)
+        # Collect late errors.
+        while sock.poll(500):
+            if sock.recv_multipart()[4] == b'error':
+                self.errors += 1
+        # Linger so messages still queued for the router are delivered.
+        sock.close()
+
+
+def run_router(router):
+    try:
+        router.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def measure(args, queue_limit):
+    context = zmq.Context.instance()
+    address = 'ipc://@volttron-router-benchmark-%d-%d' % (
+        os.getpid(), queue_limit)
+    router = Router(address, context=context, default_user_id=b'bench',
+                    queue_limit=queue_limit)
+    thread = threading.Thread(target=run_router, args=(router,))
+    thread.daemon = True
+    thread.start()
+
+    sinks = [Sink(context, address, b'fast'),
+             Sink(context, address, b'slow', args.slow_delay, args.slow_hwm)]
+    senders = [Sender(context, address, b'agent%d' % i, args.rate,
+                      args.duration, args.slow_every, args.size)
+               for i in range(args.agents)]
+    for sink in sinks:
+        sink.start()
+    start = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    elapsed = time.time() - start
+    for sink in sinks:
+        sink.running = False
+        sink.join()
+
+    # Stop the router using the quit subsystem.
+    control = context.socket(zmq.DEALER)
+    control.identity = b'control'
+    control.connect(address)
+    control.send_multipart([b'', b'VIP1', b'', b'', b'quit'])
+    thread.join(5)
+    control.close(0)
+
+    sent = sum(sender.sent for sender in senders)
+    errors = sum(sender.errors for sender in senders)
+    fast, slow = [sink.received for sink in sinks]
+    print('%12d %10d %12.0f %10d %10d %10d' % (
+        queue_limit, sent, (fast + slow) / elapsed, fast, slow, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--agents', type=int, default=20,
+                        help='number of sending agents (N)')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='messages per second sent by each agent (M)')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds to send for')
+    parser.add_argument('--size', type=int, default=256,
+                        help='message payload size in bytes')
+    parser.add_argument('--slow-every', type=int, default=20,
+                        help='send every Nth message to the slow sink')
+    parser.add_argument('--slow-delay', type=float, default=0.005,
+                        help='seconds the slow sink spends per message')
+    parser.add_argument('--slow-hwm', type=int, default=100,
+                        help='receive high-water mark of the slow sink')
+    parser.add_argument('--queue-limits', type=int, nargs='+',
+                        default=[0, 100000],
+                        help='router queue limits to measure')
+    args = parser.parse_args()
+
+    print('%12s %10s %12s %10s %10s %10s' % (
+        'queue limit', 'sent', 'delivered/s', 'fast', 'slow', 'bounced'))
+    for queue_limit in args.queue_limits:
+        measure(args, queue_limit)
+
+
+if __name__ == '__main__':
+    main()
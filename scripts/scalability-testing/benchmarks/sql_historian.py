@@ -0,0 +1,209 @@
+#!python
+
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+'''Measure write and query throughput of the SQLHistorian database drivers.
+
+Writes batches of readings through a DbDriver the way the SQLHistorian's
+publish_to_historian does, committing once per batch, and reports the
+readings written per second. It then runs repeated queries for single
+topics and reports the queries answered per second and their latency.
+By default a SQLite database is created in a temporary directory, with
+the flat or (--schema) partitioned layout; pass a historian config
+file (such as services/core/SQLHistorian/config.mysql) to measure
+another database instead. Readings are spaced --interval seconds
+apart, so a year of 15 minute data is
+
+    python scripts/scalability-testing/benchmarks/sql_historian.py \
+        --intervals 35040 --interval 900 --window 86400
+
+Run from the root volttron directory in an activated environment:
+
+    python scripts/scalability-testing/benchmarks/sql_historian.py
+'''
+
+import argparse
+import datetime
+import importlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from zmq.utils import jsonapi
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, os.pardir, 'services', 'core',
+                                'SQLHistorian'))
+
+
+def make_driver(config_path, directory, schema, rollups):
+    '''Return a database driver for the config or a temporary SQLite db.'''
+    if config_path:
+        with open(config_path) as config_file:
+            connection = jsonapi.loads(config_file.read())['connection']
+    else:
+        connection = {'type': 'sqlite', 'params': {
+            'database': os.path.join(directory, 'historian.sqlite'),
+            'schema': schema}}
+    connection['params']['rollups'] = rollups
+    module = importlib.import_module(
+        'sqlhistorian.db.{}functs'.format(connection['type']))
+    cls = getattr(module, {'sqlite': 'SqlLiteFuncts',
+                           'mysql': 'MySqlFuncts'}[connection['type']])
+    driver = cls(**connection['params'])
+    # The drivers log every query at debug level.
+    logging.getLogger('sqlhistorian').setLevel(logging.WARNING)
+    return driver
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config', nargs='?',
+                        help='historian config file naming the database')
+    parser.add_argument('--topics', type=int, default=200,
+                        help='topics written each interval')
+    parser.add_argument('--intervals', type=int, default=100,
+                        help='intervals written')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between intervals')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='readings committed together, as the '
+                             'historian submit_size_limit')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='single topic queries to run')
+    parser.add_argument('--window', type=float,
+                        help='query a random window this many seconds long '
+                             'instead of the latest 100 readings')
+    parser.add_argument('--schema', choices=('flat', 'partitioned'),
+                        default='flat', help='layout of the SQLite database')
+    parser.add_argument('--rollups', action='store_true',
+                        help='maintain rollup tables while writing')
+    parser.add_argument('--agg', choices=('min', 'max', 'avg', 'count'),
+                        help='query this aggregate from the rollups')
+    parser.add_argument('--agg-interval', choices=('5m', '1h', '1d'),
+                        default='1h', help='rollup interval to query')
+    parser.add_argument('--per-row', action='store_true',
+                        help='insert one row per call instead of executemany')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        driver = make_driver(args.config, directory, args.schema,
+                             args.rollups or args.agg is not None)
+        prefix = 'benchmark/{}/'.format(random.randint(0, 1 << 30))
+        topic_ids = []
+        for i in range(args.topics):
+            topic_ids.append(driver.insert_topic(prefix + 'point%d' % i)[0])
+        driver.commit()
+
+        start = datetime.datetime.utcnow().replace(microsecond=0)
+        readings = [(start + datetime.timedelta(
+                         seconds=interval * args.interval), topic_id,
+                     round(random.uniform(0, 1000), 3))
+                    for interval in range(args.intervals)
+                    for topic_id in topic_ids]
+        begin = time.time()
+        for first in range(0, len(readings), args.batch):
+            batch = readings[first:first + args.batch]
+            driver.prepare_insert(ts for ts, _, _ in batch)
+            if args.per_row:
+                for ts, topic_id, value in batch:
+                    driver.insert_data(ts, topic_id, value)
+            else:
+                driver.insert_data_many(batch)
+            driver.commit()
+        elapsed = time.time() - begin
+        print('write: %d readings in %.2f s: %.0f readings/s' % (
+            len(readings), elapsed, len(readings) / elapsed))
+        if not args.config:
+            size = os.path.getsize(os.path.join(directory, 'historian.sqlite'))
+            print('size: %.1f MB: %.1f bytes/reading' % (
+                size / 1e6, float(size) / len(readings)))
+
+        span = args.intervals * args.interval
+        latencies = []
+        returned = 0
+        for i in range(args.queries):
+            topic = prefix + 'point%d' % random.randrange(args.topics)
+            begin = time.time()
+            if args.window:
+                first = start + datetime.timedelta(
+                    seconds=random.uniform(0, max(span - args.window, 0)))
+                result = driver.query(
+                    topic, start=first,
+                    end=first + datetime.timedelta(seconds=args.window),
+                    agg=args.agg, interval=args.agg_interval)
+            else:
+                result = driver.query(topic, count=100, order='LAST_TO_FIRST',
+                                      agg=args.agg,
+                                      interval=args.agg_interval)
+            latencies.append(time.time() - begin)
+            returned += len(result['values'])
+        elapsed = sum(latencies)
+        latencies.sort()
+        print('query: %d queries in %.2f s: %.0f queries/s, '
+              'median %.1f ms, p95 %.1f ms, %.0f values/query' % (
+                  args.queries, elapsed, args.queries / elapsed,
+                  latencies[len(latencies) // 2] * 1000,
+                  latencies[int(len(latencies) * 0.95)] * 1000,
+                  float(returned) / args.queries))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -77,10 +77,12 @@ from csv import DictReader
 import argparse
 import struct
 import logging
+import time
 
 parser = argparse.ArgumentParser(description='Run a test pymodbus driver')
 parser.add_argument('config', help='device registry configuration')
 parser.add_argument('--port', default=5020, type=int, help='port for device to listen on')
+parser.add_argument('--latency', default=0.0, type=float, help='seconds to wait before answering each read')
 args = parser.parse_args()
 
 logging.basicConfig()
@@ -89,6 +91,12 @@ log.setLevel(logging.DEBUG)
 
 MODBUS_REGISTER_SIZE = 2
 
+class SlowSlaveContext(ModbusSlaveContext):
+    '''Simulates a slow device or serial gateway.'''
+    def getValues(self, fx, address, count=1):
+        time.sleep(args.latency)
+        return ModbusSlaveContext.getValues(self, fx, address, count)
+
 class Register(object):
     def __init__(self, address, register_type, read_only, register_struct=''):
         self.read_only = read_only
@@ -195,7 +203,7 @@ class DeviceAbstraction(object):
         print "byte", False, start, count
         hr = ModbusSequentialDataBlock(start, [0]*count)
         
-        store = ModbusSlaveContext(
+        store = SlowSlaveContext(
             di = di,
             co = co,
             hr = hr,
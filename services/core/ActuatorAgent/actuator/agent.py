@@ -66,6 +66,7 @@ from volttron.platform.vip.agent import Agent, Core, RPC
 from volttron.platform.messaging import topics
 from volttron.platform.agent import utils
 from volttron.platform.messaging.utils import normtopic
+from volttron.platform.jsonrpc import RemoteError
 from volttron.platform.agent.sched import EventWithTime
 from actuator.scheduler import ScheduleManager
 
@@ -264,6 +265,81 @@ def actuator_agent(config_path, **kwargs):
                 
             return result
 
+        @RPC.export
+        def get_multiple_points(self, topics):
+            '''Read several points with a single request to the driver.
+
+            Returns a dictionary mapping each topic to its value.
+            '''
+            _log.debug('handle_get_multiple: {topics}'.format(topics=topics))
+            results = {}
+            with self.vip.rpc.pipeline(driver_vip_identity) as pipeline:
+                for topic in topics:
+                    topic = topic.strip('/')
+                    path, point_name = topic.rsplit('/', 1)
+                    results[topic] = pipeline.call('get_point', path, point_name)
+            return {topic: result.get() for topic, result in results.iteritems()}
+
+        @RPC.export
+        def set_multiple_points(self, requester_id, topics_values):
+            '''Write several points with a single request to the driver.
+
+            topics_values is a list of (topic, value) pairs. The caller
+            must hold the lock for every device written. The writes to
+            each device are sent as one request, which the driver
+            executes in the order given, and the requests for different
+            devices are sent without waiting for one another.
+
+            Every write is attempted and publishes its own value or error
+            topics. Returns a dictionary mapping each topic to the value
+            set or, if the write failed, to an error dictionary with
+            'type' and 'value' keys like those published on the error
+            topic.
+            '''
+            _log.debug('handle_set_multiple: {requester_id}, {topics_values}'.
+                       format(requester_id=requester_id,
+                              topics_values=topics_values))
+            devices = {}
+            order = []
+            for topic, value in topics_values:
+                topic = topic.strip('/')
+                path, point_name = topic.rsplit('/', 1)
+                if not self.check_lock(path, requester_id):
+                    raise LockError("caller does not have this lock")
+                if path not in devices:
+                    devices[path] = []
+                    order.append(path)
+                devices[path].append((topic, point_name, value))
+
+            headers = self.get_headers(requester_id)
+            results = {}
+            # One ordered batch per device.
+            pending = []
+            for path in order:
+                points = devices[path]
+                with self.vip.rpc.pipeline(driver_vip_identity, 
+                                           max_size=len(points), 
+                                           max_delay=None, 
+                                           sequential=True) as pipeline:
+                    for topic, point_name, value in points:
+                        pending.append((topic, value, pipeline.call(
+                            'set_point', path, point_name, value)))
+            for topic, value, result in pending:
+                try:
+                    results[topic] = result.get()
+                except (StandardError, RemoteError) as ex:
+                    error = {'type': ex.__class__.__name__, 'value': str(ex)}
+                    results[topic] = error
+                    self.push_result_topic_pair(ERROR_RESPONSE_PREFIX,
+                                                topic, headers, error)
+                    _log.debug('Actuator Agent Error: '+str(error))
+                    continue
+                self.push_result_topic_pair(WRITE_ATTEMPT_PREFIX,
+                                            topic, headers, value)
+                self.push_result_topic_pair(VALUE_RESPONSE_PREFIX,
+                                            topic, headers, results[topic])
+            return results
+
         def check_lock(self, device, requester):
             _log.debug('check_lock: {device}, {requester}'.format(device=device, 
                                                                   requester=requester))
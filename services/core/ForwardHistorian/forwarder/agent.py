@@ -54,6 +54,7 @@
 #}}}
 from __future__ import absolute_import, print_function
 
+import base64
 import datetime
 import errno
 import logging
@@ -62,8 +63,10 @@ from pprint import pprint
 import sqlite3
 import sys
 import uuid
+import zlib
 
 import gevent
+import monotonic as clock
 from zmq.utils import jsonapi
 
 from volttron.platform.vip.agent import *
@@ -87,9 +90,34 @@ def historian(config_path, **kwargs):
     
     destination_vip = config.get('destination-vip')
     identity = config.get('identity', kwargs.pop('identity', None))
+    # Readings per message and messages in flight at once.
+    batch_size = int(config.get('batch_size', 1000))
+    max_in_flight = int(config.get('max_in_flight', 4))
+    # Messages with several readings per topic, and compressed messages
+    # larger than compress_threshold bytes, can only be read by
+    # destinations running this version or later, so both are off
+    # unless configured.
+    multi_reading = bool(config.get('multi_reading', False))
+    compress_threshold = int(config.get('compress_threshold', 0))
+    publish_timeout = float(config.get('publish_timeout', 30))
+    # Seconds to wait before retrying after a failed publish, doubling
+    # with each consecutive failure.
+    backoff_initial = float(config.get('backoff_initial', 1))
+    backoff_max = float(config.get('backoff_max', 300))
+    kwargs.setdefault('submit_size_limit', batch_size * max_in_flight)
             
     class ForwardHistorian(BaseHistorian):
         '''This historian forwards data to another platform.
+
+        Each batch of records is sent as up to max_in_flight datalogger
+        messages of batch_size readings, published to the destination at
+        the same time. By default a message holds one reading per topic,
+        which every destination understands, and a topic's later readings
+        go in later messages. With multi_reading, each topic carries a
+        list of readings instead, and with compress_threshold, larger
+        messages are zlib compressed; see the README before enabling
+        either. After a failure nothing is sent until a backoff period,
+        doubling from backoff_initial up to backoff_max, has passed. get_ingest_stats includes the forwarding statistics.
         '''
 
         @Core.receiver("onstart")
@@ -98,6 +126,12 @@ def historian(config_path, **kwargs):
             print('Starting address: {} identity: {}'.format(self.core.address, self.core.identity))
             #TODO: Check that destination exists
             self.topic_map = {}
+            self._failures = 0
+            self._retry_at = 0
+            self._ingest_stats.update(forwarded=0,
+                                      forwarded_bytes=0,
+                                      forward_failures=0,
+                                      forward_backoff=0)
 
             
 
@@ -108,69 +142,109 @@ def historian(config_path, **kwargs):
         def publish_to_historian(self, to_publish_list):
             _log.debug("publish_to_historian number of items: {}"
                        .format(len(to_publish_list)))
-            
-            # load a topic map if there isn't one yet.
-#             try:
-#                 self.topic_map.items()
-#             except:
-#                 self.topic_map = self.reader.get_topic_map()
 
-            
-            datalog ={}
+            if clock.monotonic() < self._retry_at:
+                return
 
+            records = []
             for x in to_publish_list:
-                ts = x['timestamp']
+                if x['topic'].startswith('datalogger'):
+                    # Never forward these; they came from a forwarder.
+                    self.report_handled(x)
+                else:
+                    records.append(x)
+
+            base_topic = 'datalogger/devices'
+            pending = []
+            for chunk in self._chunks(records):
+                headers, message, size = self._encode(chunk)
+                _log.debug("about to publish {} readings ({} bytes) to "
+                           "destination: {}".format(len(chunk), size,
+                                                    destination_vip))
+                result = self._target_platform.vip.pubsub.publish(
+                    peer='pubsub', topic=base_topic, headers=headers,
+                    message=message)
+                pending.append((result, chunk, size))
+                if len(pending) >= max_in_flight:
+                    self._wait(pending)
+                    pending = []
+                    if self._failures:
+                        return
+            self._wait(pending)
+
+        def _chunks(self, records):
+            '''Split records into the readings for each message.'''
+            if multi_reading:
+                for start in range(0, len(records), batch_size):
+                    yield records[start:start + batch_size]
+                return
+            chunk = []
+            chunk_topics = set()
+            for x in records:
+                if x['topic'] in chunk_topics or len(chunk) >= batch_size:
+                    yield chunk
+                    chunk = []
+                    chunk_topics = set()
+                chunk.append(x)
+                chunk_topics.add(x['topic'])
+            if chunk:
+                yield chunk
+
+        def _encode(self, records):
+            '''Return the headers, message and size for records.'''
+            datalog = {}
+            for x in records:
                 topic = x['topic']
-                value = x['value']
                 meta = x['meta']
-                # look at the topics that are stored in the database already
-                # to see if this topic has a value
-                if topic.startswith('datalogger'):
-                    continue
-#                 topic_id = self.topic_map.get(topic)
-
-#                 if topic_id is None:
-#                     row  = self.writer.insert_topic(topic)
-#                     topic_id = row[0]
-#                     self.topic_map[topic] = topic_id
-
-#                 self.writer.insert_data(ts,topic_id, value)
-#                 parts = topic.split('/')
-#                 all_topic = '/'.join(reversed(parts[2:]))
-
-                if not 'units' in meta.keys():
-                    #print('unit for topic {} is now {}'.format(topic, 'percent'))
-                    meta['units'] = 'percent'
-
-                #Device data is UTC
-                #.replace(tzinfo=None)
-                datalog[topic] = {'Readings': [str(ts),value],
-                                  'Units': meta['units'],'data_type': meta['type'], 
-                                  'tz':meta['tz']}
-                
-            base_topic = 'datalogger/devices'
-
-
+                item = datalog.get(topic)
+                if item is None:
+                    #Device data is UTC
+                    item = datalog[topic] = {
+                        'Readings': [],
+                        'Units': meta.get('units', 'percent'),
+                        'data_type': meta.get('type'),
+                        'tz': meta.get('tz')}
+                reading = [str(x['timestamp']), x['value']]
+                if multi_reading:
+                    item['Readings'].append(reading)
+                else:
+                    item['Readings'] = reading
 
-            
             message = jsonapi.dumps(datalog)
-            
-#             agent = self._get_rpc_agent(destination_vip)
-            _log.debug("about to publish to destination: {}".format(destination_vip))
-#                         agent.vip.publish()
-#             agent.vip.pubsub.publish(peer='pubsub',headers=headers,
-#                                         topic=topic,
-#                                         message=message)
-
-            with gevent.Timeout(30):
-                try:
-                    self._target_platform.vip.pubsub.publish(peer='pubsub',
-                                    topic=base_topic,
-                                    message=datalog).get()
-                except gevent.Timeout:
-                    pass
-                else: 
-                    self.report_all_handled()
+            if not compress_threshold or len(message) <= compress_threshold:
+                return {}, datalog, len(message)
+            message = base64.b64encode(zlib.compress(message))
+            headers = {headers_mod.CONTENT_ENCODING:
+                           headers_mod.CONTENT_ENCODING.ZLIB_BASE64}
+            return headers, message, len(message)
+
+        def _wait(self, pending):
+            '''Wait for publishes and report the delivered records.'''
+            gevent.wait([result for result, _, _ in pending],
+                        timeout=publish_timeout)
+            failed = False
+            for result, chunk, size in pending:
+                if result.ready() and result.successful():
+                    self.report_handled(chunk)
+                    self._ingest_stats['forwarded'] += len(chunk)
+                    self._ingest_stats['forwarded_bytes'] += size
+                else:
+                    failed = True
+                    _log.warning('failed to forward {} readings to {}: '
+                                 '{}'.format(len(chunk), destination_vip,
+                                             result.exception or 'timeout'))
+            if failed:
+                self._failures += 1
+                self._ingest_stats['forward_failures'] += 1
+                backoff = min(backoff_initial * 2 ** (self._failures - 1),
+                              backoff_max)
+                self._retry_at = clock.monotonic() + backoff
+                self._ingest_stats['forward_backoff'] = backoff
+                _log.warning('retrying forwarding in {} seconds'.format(
+                    backoff))
+            elif self._failures:
+                self._failures = 0
+                self._ingest_stats['forward_backoff'] = 0
 
         def query_topic_list(self):
             if len(self.topic_map) > 0:
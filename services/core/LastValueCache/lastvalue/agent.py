@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+from __future__ import absolute_import
+
+import datetime
+from fnmatch import fnmatchcase
+import logging
+import sys
+
+from volttron.platform.vip.agent import Agent, Core, RPC
+from volttron.platform.agent import utils
+from volttron.platform.messaging import headers as headers_mod, topics
+
+utils.setup_logging()
+_log = logging.getLogger(__name__)
+
+DEVICES_PREFIX = topics.DRIVER_TOPIC_BASE + '/'
+ALL_SUFFIX = '/' + topics.DRIVER_TOPIC_ALL
+BREADTH_FIRST_PREFIX = DEVICES_PREFIX + topics.DRIVER_TOPIC_ALL + '/'
+
+
+class DeviceValues(object):
+    '''Latest values of one device's points.
+
+    index maps point names to positions in values and timestamps, and is
+    shared by every device publishing the same points. A scrape's
+    timestamp string is shared by all the points it updated.
+    '''
+    __slots__ = ('index', 'values', 'timestamps')
+
+    def __init__(self, index):
+        self.index = index
+        self.values = [None] * len(index)
+        self.timestamps = [None] * len(index)
+
+    def items(self):
+        '''Yield (name, timestamp, value) for each point with a value.'''
+        timestamps = self.timestamps
+        values = self.values
+        for name, position in self.index.iteritems():
+            timestamp = timestamps[position]
+            if timestamp is not None:
+                yield name, timestamp, values[position]
+
+
+def is_pattern(topic):
+    return '*' in topic or '?' in topic or '[' in topic
+
+
+def last_value_agent(config_path, **kwargs):
+    config = utils.load_config(config_path)
+    vip_identity = config.get('vip_identity', 'platform.lastvalue')
+    kwargs.pop('identity', None)
+
+    class LastValueAgent(Agent):
+        '''Keep the latest value of every device point in memory.
+
+        Subscribes to the devices all topics and answers get_latest and
+        snapshot from memory. Depth first all topics are used, falling
+        back to the breadth first all topic for devices which publish
+        only that form. Devices are named by their path without
+        the devices/ prefix, such as campus/building/device, and points
+        by the device path and point name. Either may be a glob pattern.
+        '''
+
+        def __init__(self, **kwargs):
+            super(LastValueAgent, self).__init__(**kwargs)
+            self._devices = {}
+            # Devices seen on their depth first all topic.
+            self._depth_first = set()
+            # Point indexes by sorted point names, shared across devices.
+            self._indexes = {}
+
+        @Core.receiver('onstart')
+        def on_start(self, sender, **kwargs):
+            self.vip.pubsub.subscribe(peer='pubsub',
+                                      prefix=topics.DRIVER_TOPIC_BASE,
+                                      callback=self.capture_device_data)
+
+        def capture_device_data(self, peer, sender, bus, topic, headers,
+                                message):
+            if topic.startswith(BREADTH_FIRST_PREFIX):
+                device = '/'.join(reversed(
+                    topic[len(BREADTH_FIRST_PREFIX):].split('/')))
+                if device in self._depth_first:
+                    return
+            elif topic.endswith(ALL_SUFFIX):
+                device = topic[len(DEVICES_PREFIX):-len(ALL_SUFFIX)]
+                self._depth_first.add(device)
+            else:
+                return
+            values = message[0] if isinstance(message, list) else message
+            if not isinstance(values, dict):
+                _log.error('ignoring malformed all message for ' + device)
+                return
+            timestamp = headers.get(headers_mod.DATE)
+            if timestamp is None:
+                timestamp = datetime.datetime.utcnow().isoformat(' ') + 'Z'
+
+            state = self._devices.get(device)
+            if state is None:
+                state = self._devices[device] = DeviceValues(
+                    self._get_index(values))
+            index = state.index
+            try:
+                positions = [index[name] for name in values]
+            except KeyError:
+                self._add_points(state, values)
+                index = state.index
+                positions = [index[name] for name in values]
+            state_values = state.values
+            state_timestamps = state.timestamps
+            for position, value in zip(positions, values.itervalues()):
+                state_values[position] = value
+                state_timestamps[position] = timestamp
+
+        def _get_index(self, names):
+            key = tuple(sorted(names))
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = {
+                    name: position for position, name in enumerate(key)}
+            return index
+
+        def _add_points(self, state, names):
+            '''Move state to an index that also holds the given names.'''
+            index = self._get_index(set(state.index).union(names))
+            values = [None] * len(index)
+            timestamps = [None] * len(index)
+            for name, position in state.index.iteritems():
+                values[index[name]] = state.values[position]
+                timestamps[index[name]] = state.timestamps[position]
+            state.index = index
+            state.values = values
+            state.timestamps = timestamps
+
+        def _match_devices(self, pattern):
+            if not is_pattern(pattern):
+                state = self._devices.get(pattern)
+                return [] if state is None else [(pattern, state)]
+            return [(device, state)
+                    for device, state in self._devices.iteritems()
+                    if fnmatchcase(device, pattern)]
+
+        @RPC.export
+        def get_latest(self, point_topics):
+            '''Return the latest values of points.
+
+            point_topics is a point topic or list of them, each of which
+            may be a glob pattern. Returns {topic: [timestamp, value]} for every
+            point found, keyed by the topic as given or, for patterns, by
+            the matching point's topic.
+            '''
+            if isinstance(point_topics, basestring):
+                point_topics = [point_topics]
+            results = {}
+            for requested in point_topics:
+                topic = requested
+                if topic.startswith(DEVICES_PREFIX):
+                    topic = topic[len(DEVICES_PREFIX):]
+                device, _, point = topic.rpartition('/')
+                if not is_pattern(topic):
+                    state = self._devices.get(device)
+                    if state is None:
+                        continue
+                    position = state.index.get(point)
+                    if (position is not None and
+                            state.timestamps[position] is not None):
+                        results[requested] = [state.timestamps[position],
+                                              state.values[position]]
+                    continue
+                for name, state in self._match_devices(device):
+                    for point_name, timestamp, value in state.items():
+                        if fnmatchcase(point_name, point):
+                            results[name + '/' + point_name] = [timestamp,
+                                                                value]
+            return results
+
+        @RPC.export
+        def snapshot(self, devices='*'):
+            '''Return the latest values of whole devices.
+
+            devices is a device path or list of them, each of which may
+            be a glob pattern; the default is every device. Returns
+            {device: {point: [timestamp, value]}}.
+            '''
+            if isinstance(devices, basestring):
+                devices = [devices]
+            results = {}
+            for pattern in devices:
+                if pattern.startswith(DEVICES_PREFIX):
+                    pattern = pattern[len(DEVICES_PREFIX):]
+                for name, state in self._match_devices(pattern):
+                    results[name] = {
+                        point: [timestamp, value]
+                        for point, timestamp, value in state.items()}
+            return results
+
+        @RPC.export
+        def get_devices(self):
+            '''Return the paths of the devices with cached values.'''
+            return sorted(self._devices)
+
+    return LastValueAgent(identity=vip_identity, **kwargs)
+
+
+def main(argv=sys.argv):
+    '''Main method called by the eggsecutable.'''
+    try:
+        utils.vip_main(last_value_agent)
+    except Exception as e:
+        _log.exception('unhandled exception')
+
+
+if __name__ == '__main__':
+    # Entry point for script
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
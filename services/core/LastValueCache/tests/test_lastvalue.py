@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+
+from lastvalue.agent import last_value_agent
+from volttron.platform.messaging import headers as headers_mod
+
+
+def make_agent():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as config:
+            json.dump({}, config)
+        return last_value_agent(path)
+    finally:
+        os.remove(path)
+
+
+class LastValueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = make_agent()
+
+    def publish(self, topic, values, timestamp='t1'):
+        self.agent.capture_device_data(
+            'pubsub', 'platform.driver', '', topic,
+            {headers_mod.DATE: timestamp}, [values, {}])
+
+    def test_depth_first_all(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70, 'Fan': 1})
+        self.assertEqual(self.agent.get_latest('campus/b1/ahu/Temp'),
+                         {'campus/b1/ahu/Temp': ['t1', 70]})
+        self.assertEqual(self.agent.get_devices(), ['campus/b1/ahu'])
+
+    def test_point_topics_ignored(self):
+        self.publish('devices/campus/b1/ahu/Temp', 70)
+        self.publish('devices/Temp/ahu/b1/campus', 70)
+        self.assertEqual(self.agent.get_devices(), [])
+
+    def test_breadth_first_fallback(self):
+        self.publish('devices/all/ahu/b1/campus', {'Temp': 70})
+        self.assertEqual(self.agent.get_latest('devices/campus/b1/ahu/Temp'),
+                         {'devices/campus/b1/ahu/Temp': ['t1', 70]})
+
+    def test_depth_first_preferred(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70}, 't1')
+        self.publish('devices/all/ahu/b1/campus', {'Temp': 71}, 't2')
+        self.assertEqual(self.agent.get_latest('campus/b1/ahu/Temp'),
+                         {'campus/b1/ahu/Temp': ['t1', 70]})
+
+    def test_get_latest_globs(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70, 'Fan': 1})
+        self.publish('devices/campus/b2/ahu/all', {'Temp': 72}, 't2')
+        self.publish('devices/campus/b2/vav/all', {'Temp': 68}, 't3')
+        self.assertEqual(self.agent.get_latest('campus/*/ahu/Temp'), {
+            'campus/b1/ahu/Temp': ['t1', 70],
+            'campus/b2/ahu/Temp': ['t2', 72]})
+        self.assertEqual(self.agent.get_latest(['campus/b1/ahu/[FT]*',
+                                                'campus/b2/vav/Temp',
+                                                'campus/b2/vav/Missing',
+                                                'campus/b3/ahu/Temp']), {
+            'campus/b1/ahu/Temp': ['t1', 70],
+            'campus/b1/ahu/Fan': ['t1', 1],
+            'campus/b2/vav/Temp': ['t3', 68]})
+
+    def test_snapshot_globs(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70})
+        self.publish('devices/campus/b2/vav/all', {'Temp': 68}, 't2')
+        self.assertEqual(self.agent.snapshot(), {
+            'campus/b1/ahu': {'Temp': ['t1', 70]},
+            'campus/b2/vav': {'Temp': ['t2', 68]}})
+        self.assertEqual(self.agent.snapshot('devices/campus/b?/vav'), {
+            'campus/b2/vav': {'Temp': ['t2', 68]}})
+        self.assertEqual(self.agent.snapshot(['campus/b1/ahu', 'none']), {
+            'campus/b1/ahu': {'Temp': ['t1', 70]}})
+
+    def test_partial_scrapes_keep_other_points(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70, 'Fan': 1})
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 71}, 't2')
+        self.assertEqual(self.agent.snapshot('campus/b1/ahu'), {
+            'campus/b1/ahu': {'Temp': ['t2', 71], 'Fan': ['t1', 1]}})
+
+    def test_new_points_reindexed(self):
+        self.publish('devices/campus/b1/ahu/all', {'Temp': 70})
+        self.publish('devices/campus/b2/ahu/all', {'Temp': 72})
+        self.publish('devices/campus/b1/ahu/all', {'Fan': 1, 'Alarm': 0},
+                     't2')
+        self.assertEqual(self.agent.snapshot('campus/b1/ahu'), {
+            'campus/b1/ahu': {'Temp': ['t1', 70], 'Fan': ['t2', 1],
+                              'Alarm': ['t2', 0]}})
+        # Devices with the same points share an index.
+        self.publish('devices/campus/b2/ahu/all', {'Fan': 0, 'Alarm': 1})
+        devices = self.agent._devices
+        self.assertIs(devices['campus/b1/ahu'].index,
+                      devices['campus/b2/ahu'].index)
+        self.assertEqual(self.agent.get_latest('campus/b2/ahu/Temp'),
+                         {'campus/b2/ahu/Temp': ['t1', 72]})
+
+    def test_malformed_message_ignored(self):
+        self.publish('devices/campus/b1/ahu/all', 'bad')
+        self.assertEqual(self.agent.get_devices(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
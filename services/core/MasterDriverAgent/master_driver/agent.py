@@ -57,12 +57,17 @@ import logging
 import sys
 import os
 import gevent
+from gevent.lock import Semaphore
+import monotonic as clock
 from volttron.platform.vip.agent import Agent, Core, RPC
+from volttron.platform.vip.agent.errors import VIPError, Again
+from volttron.platform.messaging.topics import DRIVER_TOPIC_BASE
 from volttron.platform.agent import utils
 from driver import DriverAgent
 import resource
 
 from driver_locks import configure_socket_lock, configure_publish_lock
+from scheduler import ScrapeScheduler
 
 utils.setup_logging()
 _log = logging.getLogger(__name__)
@@ -109,7 +114,7 @@ def master_driver_agent(config_path, **kwargs):
     else:
         configure_socket_lock()
         _log.warn("No limit set on the maximum number of concurrently open sockets. "
-                  "Consider setting max_open_sockets if you plan to work with 800+ modbus devices.")
+                  "Consider setting max_open_sockets if you plan to work with 800+ devices.")
         
     
     #TODO: update the default after scalability testing.
@@ -121,6 +126,20 @@ def master_driver_agent(config_path, **kwargs):
         _log.info("maximum concurrent driver publishes limited to " + str(max_concurrent_publishes))
     configure_publish_lock(max_concurrent_publishes)
 
+    # Defaults for the topics published for each scrape, which may be
+    # overridden in each device configuration.
+    publish_settings = {name: get_config(name, True) for name in 
+                        ('publish_depth_first', 'publish_breadth_first',
+                         'publish_depth_first_all', 'publish_breadth_first_all')}
+
+    # Seconds between refreshes of the subscriptions consulted by devices
+    # publishing point topics in "auto" mode.
+    subscription_refresh_interval = get_config('subscription_refresh_interval', 60)
+
+    # Scrapes that overrun their slots stretch the spacing between 
+    # scrapes, up to this multiple of each device's interval.
+    max_scrape_stretch = get_config('max_scrape_stretch', 2.0)
+
     vip_identity = get_config('vip_identity', 'platform.driver')
     #pop the uuid based id
     kwargs.pop('identity', None)
@@ -130,6 +149,11 @@ def master_driver_agent(config_path, **kwargs):
         def __init__(self, **kwargs):
             super(MasterDriverAgent, self).__init__(**kwargs)
             self.instances = {}
+            self.publish_settings = publish_settings
+            self.scheduler = ScrapeScheduler(max_stretch=max_scrape_stretch)
+            self._subscription_lock = Semaphore()
+            self._subscription_prefixes = None
+            self._subscriptions_listed = None
             
         @Core.receiver('onstart')
         def starting(self, sender, **kwargs):
@@ -141,12 +165,43 @@ def master_driver_agent(config_path, **kwargs):
                 gevent.spawn(driver.core.run)   
                 #driver.core.stop to kill an agent. 
                    
+        @Core.receiver('onstop')
+        def stopping(self, sender, **kwargs):
+            self.scheduler.stop()
+            
         
         def device_startup_callback(self, topic, driver):
             _log.debug("Driver hooked up for "+topic)
             topic = topic.strip('/')
             self.instances[topic] = driver
             
+        def get_subscription_prefixes(self):
+            """Returns the prefixes subscribed to driver topics.
+            
+            One list is shared by every device and refreshed every 
+            subscription_refresh_interval seconds. Returns None if the 
+            subscriptions could not be listed.
+            """
+            with self._subscription_lock:
+                now = clock.monotonic()
+                if (self._subscriptions_listed is not None and 
+                        now - self._subscriptions_listed < subscription_refresh_interval):
+                    return self._subscription_prefixes
+                try:
+                    subscriptions = self.vip.pubsub.list('pubsub', 
+                                                         DRIVER_TOPIC_BASE, 
+                                                         subscribed=False).get(timeout=10.0)
+                except (Again, VIPError, gevent.Timeout) as ex:
+                    _log.warn("failed to list subscriptions, publishing all "
+                              "point topics: " + str(ex))
+                    self._subscription_prefixes = None
+                else:
+                    self._subscription_prefixes = [prefix for bus, prefix, member 
+                                                   in subscriptions]
+                # Failures are retried at the next refresh, not by every device.
+                self._subscriptions_listed = now
+                return self._subscription_prefixes
+        
         @RPC.export
         def get_point(self, path, point_name):
             return self.instances[path].get_point(point_name)
@@ -155,6 +210,11 @@ def master_driver_agent(config_path, **kwargs):
         def set_point(self, path, point_name, value):
             return self.instances[path].set_point(point_name, value)
         
+        @RPC.export
+        def get_scrape_stats(self):
+            """Scrape counts, overruns and latencies in seconds per device."""
+            return self.scheduler.stats()
+        
         @RPC.export
         def heart_beat(self):
             _log.debug("sending heartbeat")
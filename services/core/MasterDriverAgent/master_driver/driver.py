@@ -61,6 +61,8 @@ import logging
 import sys
 import random
 import gevent
+from csv import DictReader
+from StringIO import StringIO
 from volttron.platform.messaging import headers as headers_mod
 from volttron.platform.messaging.topics import (DRIVER_TOPIC_BASE, 
                                                 DRIVER_TOPIC_ALL, 
@@ -73,6 +75,9 @@ from driver_locks import publish_lock
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+#Marks points not yet published since the driver started.
+_NOT_PUBLISHED = object()
+
 
 
 class DriverAgent(BasicAgent): 
@@ -84,6 +89,7 @@ class DriverAgent(BasicAgent):
         self.parent = parent
         self.vip = parent.vip
         self.config_name = config_name
+        self.scheduled = None
         
     def get_config(self, config_name):
         #Until config store is setup just grab a file.
@@ -105,10 +111,20 @@ class DriverAgent(BasicAgent):
         self.registry_config_name = None
         self.setup_device()
         
+        # The master driver's scheduler spreads scrapes across the
+        # interval, keeping devices behind the same address apart.
         interval = self.config.get("interval", 60)
-        self.core.periodic(interval, self.periodic_read, wait=None)
-            
-        self.all_path_depth, self.all_path_breadth = self.get_paths_for_point(DRIVER_TOPIC_ALL)
+        group = self.config.get("scrape_group", 
+                                self.config["driver_config"].get("device_address"))
+        self.scheduled = self.parent.scheduler.add(
+            self.device_name.strip('/'), self.periodic_read, interval,
+            group=group, offset=self.config.get("scrape_offset"))
+        
+    @Core.receiver('onstop')
+    def stopping(self, sender, **kwargs):
+        if self.scheduled is not None:
+            self.parent.scheduler.remove(self.scheduled.name, self.scheduled)
+            self.scheduled = None
 
 
     def setup_device(self):
@@ -159,8 +175,106 @@ class DriverAgent(BasicAgent):
                                    path=config.get('path', ''),
                                    point='')
         
+        self.all_path_depth, self.all_path_breadth = self.get_paths_for_point(DRIVER_TOPIC_ALL)
+        self.point_topics = {point: self.get_paths_for_point(point) 
+                             for point in self.interface.get_register_names()}
+        
+        # Each publish form may be enabled or disabled. The per point 
+        # forms may also be "auto", publishing only while some agent 
+        # is subscribed to point topics of this device.
+        defaults = self.parent.publish_settings
+        self.publish_depth_first = config.get('publish_depth_first', 
+                                              defaults['publish_depth_first'])
+        self.publish_breadth_first = config.get('publish_breadth_first', 
+                                                defaults['publish_breadth_first'])
+        self.publish_depth_first_all = config.get('publish_depth_first_all', 
+                                                  defaults['publish_depth_first_all'])
+        self.publish_breadth_first_all = config.get('publish_breadth_first_all', 
+                                                    defaults['publish_breadth_first_all'])
+        # Whether each point form has subscribers, and the subscription 
+        # list that was computed from. The master driver replaces the 
+        # list when it refreshes it.
+        self._subscribed_forms = None
+        self._subscribed_forms_prefixes = None
+        
+        self.setup_change_filter(config, registry_config)
+        
         self.parent.device_startup_callback(self.device_name, self)
             
+    def setup_change_filter(self, config, registry_config):
+        """Reads the publish on change settings for each point.
+        
+        Points whose registry row has "Publish On Change" set to TRUE, or 
+        that have a "Deadband", are only published when they change, or 
+        for numbers when they move more than the deadband from the value 
+        last published. The device config's publish_on_change sets the 
+        default for rows that leave both columns empty.
+        
+        Every force_publish_interval scrapes (default 10) every point is 
+        published anyway. The all message carries every point every 
+        all_snapshot_interval scrapes (default force_publish_interval) 
+        and only the published points otherwise, with the Partial header 
+        set.
+        """
+        default = config.get('publish_on_change', False)
+        self.force_publish_interval = config.get('force_publish_interval', 10)
+        self.all_snapshot_interval = config.get('all_snapshot_interval', 
+                                                self.force_publish_interval)
+        self.scrape_count = 0
+        
+        names = self.interface.get_register_names()
+        self.point_index = {name: index for index, name in enumerate(names)}
+        # None publishes the point every scrape, otherwise the change 
+        # needed before it is published again.
+        self.deadbands = [0.0 if default else None] * len(names)
+        self.last_published = [_NOT_PUBLISHED] * len(names)
+        
+        for row in DictReader(StringIO(registry_config)):
+            index = self.point_index.get(row.get('Volttron Point Name'))
+            if index is None:
+                continue
+            deadband = (row.get('Deadband') or '').strip()
+            on_change = (row.get('Publish On Change') or '').strip().lower()
+            if deadband:
+                try:
+                    self.deadbands[index] = float(deadband)
+                except ValueError:
+                    _log.warning("Ignoring invalid Deadband {!r} for point {} "
+                                 "of {}".format(deadband, row['Volttron Point Name'],
+                                                self.device_name))
+                    continue
+            elif on_change:
+                self.deadbands[index] = 0.0 if on_change == 'true' else None
+                
+    def _changed_points(self, results, force):
+        """Returns the points of results to publish.
+        
+        The last published values are left alone until the publish 
+        succeeds; see _commit_published."""
+        changed = {}
+        deadbands = self.deadbands
+        last_published = self.last_published
+        for point, value in results.iteritems():
+            index = self.point_index[point]
+            deadband = deadbands[index]
+            last = last_published[index]
+            if not (force or deadband is None or last is _NOT_PUBLISHED):
+                if (deadband and isinstance(value, (int, long, float)) and 
+                        isinstance(last, (int, long, float))):
+                    if abs(value - last) <= deadband:
+                        continue
+                elif value == last:
+                    continue
+            changed[point] = value
+        return changed
+        
+    def _commit_published(self, changed):
+        """Records the values of changed as the last published."""
+        last_published = self.last_published
+        point_index = self.point_index
+        for point, value in changed.iteritems():
+            last_published[point_index[point]] = value
+            
         
     def periodic_read(self):
         _log.debug("scraping device: " + self.device_name)
@@ -182,41 +296,110 @@ class DriverAgent(BasicAgent):
         }
             
 
-        for point, value in results.iteritems():
-            topics = self.get_paths_for_point(point)
-            for topic in topics:
-                message = [value, self.meta_data[point]] 
-                self._publish_wrapper(topic, 
-                                      headers=headers, 
-                                      message=message)
-         
-        message = [results, self.meta_data] 
-        self._publish_wrapper(self.all_path_depth, 
-                              headers=headers, 
-                              message=message)
-         
-        self._publish_wrapper(self.all_path_breadth, 
-                              headers=headers, 
-                              message=message)
+        # An interval of 0 disables forced and full all publishes.
+        count = self.scrape_count
+        self.scrape_count += 1
+        force = (self.force_publish_interval > 0 and 
+                 not count % self.force_publish_interval)
+        snapshot = (self.all_snapshot_interval > 0 and 
+                    not count % self.all_snapshot_interval)
+        changed = self._changed_points(results, force)
+        
+        publish_depth, publish_breadth = self._get_point_publish_forms()
+        
+        # Publish every topic for the scrape in a single request.
+        items = []
+        for point, value in changed.iteritems():
+            message = [value, self.meta_data[point]]
+            depth_first, breadth_first = self.point_topics[point]
+            if publish_depth:
+                items.append((depth_first, headers, message))
+            if publish_breadth:
+                items.append((breadth_first, headers, message))
+
+        if snapshot:
+            all_headers = headers
+            message = [results, self.meta_data]
+        else:
+            all_headers = dict(headers)
+            all_headers[headers_mod.PARTIAL] = True
+            message = [changed, {point: self.meta_data[point] for point in changed}]
+        if message[0]:
+            if self.publish_depth_first_all:
+                items.append((self.all_path_depth, all_headers, message))
+            if self.publish_breadth_first_all:
+                items.append((self.all_path_breadth, all_headers, message))
+
+        # A failed publish leaves the last published values as they 
+        # were, so the changes are published again next scrape.
+        if not items or self._publish_wrapper(items):
+            self._commit_published(changed)
+        
+        
+    def _get_point_publish_forms(self):
+        """Returns whether to publish depth and breadth first point topics.
+        
+        Forms set to "auto" are published only if a subscription prefix 
+        matches a point topic of that form and is not also a prefix of 
+        the corresponding all topic. Agents subscribed to a broader prefix, such as 
+        historians subscribed to "devices", receive the all message and 
+        are not considered to need the per point topics. The 
+        subscriptions come from the master driver's periodically 
+        refreshed list and are only rechecked when that list changes.
+        """
+        depth, breadth = self.publish_depth_first, self.publish_breadth_first
+        if 'auto' not in (depth, breadth):
+            return depth, breadth
+        
+        prefixes = self.parent.get_subscription_prefixes()
+        if prefixes is None:
+            return bool(depth), bool(breadth)
+        
+        if prefixes is not self._subscribed_forms_prefixes:
+            self._subscribed_forms = (
+                self._point_topics_subscribed(prefixes, 0, self.all_path_depth),
+                self._point_topics_subscribed(prefixes, 1, self.all_path_breadth))
+            self._subscribed_forms_prefixes = prefixes
+        
+        if depth == 'auto':
+            depth = self._subscribed_forms[0]
+        if breadth == 'auto':
+            breadth = self._subscribed_forms[1]
+        return depth, breadth
+        
+        
+    def _point_topics_subscribed(self, prefixes, form, all_topic):
+        for prefix in prefixes:
+            if all_topic.startswith(prefix):
+                continue
+            for topics in self.point_topics.itervalues():
+                if topics[form].startswith(prefix):
+                    return True
+        return False
         
         
-    def _publish_wrapper(self, topic, headers, message):
+    def _publish_wrapper(self, items):
+        """Publishes items, returning whether the publish succeeded."""
         while True:
             try:
                 with publish_lock():
-                    self.vip.pubsub.publish('pubsub', 
-                                        topic, 
-                                        headers=headers, 
-                                        message=message).get(timeout=10.0)
+                    self.vip.pubsub.publish_batch('pubsub', 
+                                                  items).get(timeout=10.0)
                                         
             except Again:
-                _log.warn("publish delayed: " + topic + " pubsub is busy")
+                _log.warn("publish delayed: " + self.device_name + 
+                          " pubsub is busy")
                 gevent.sleep(random.random())
             except VIPError as ex:
-                _log.warn("driver failed to publish " + topic + ": " + str(ex))
-                break
+                _log.warn("driver failed to publish " + self.device_name + 
+                          ": " + str(ex))
+                return False
+            except gevent.Timeout:
+                _log.warn("driver failed to publish " + self.device_name + 
+                          ": timed out")
+                return False
             else:
-                break
+                return True
             
     
     def heart_beat(self):
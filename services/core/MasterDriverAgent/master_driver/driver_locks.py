@@ -77,6 +77,20 @@ def socket_lock():
         yield 
     finally:
         _socket_lock.release()
+
+def acquire_socket(blocking=True, timeout=None):
+    """Take a socket_lock slot for a socket that outlives one request."""
+    global _socket_lock
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    #DummySemaphore.acquire returns None.
+    return _socket_lock.acquire(blocking, timeout) is not False
+
+def release_socket():
+    global _socket_lock
+    if _socket_lock is None:
+        raise RuntimeError("socket_lock not configured!")
+    _socket_lock.release()
         
 _publish_lock = None
 
@@ -54,28 +54,327 @@ under Contract DE-AC05-76RL01830
 from gevent import monkey
 monkey.patch_socket()
 
-from pymodbus.client.sync import ModbusTcpClient as SyncModbusClient  
 from pymodbus.exceptions import ConnectionException, ModbusIOException, ModbusException
 from pymodbus.pdu import ExceptionResponse
 from pymodbus.constants import Defaults
+from pymodbus.factory import ClientDecoder
+from pymodbus.bit_read_message import ReadCoilsRequest, ReadDiscreteInputsRequest
+from pymodbus.bit_write_message import WriteSingleCoilRequest
+from pymodbus.register_read_message import ReadHoldingRegistersRequest, ReadInputRegistersRequest
+from pymodbus.register_write_message import WriteMultipleRegistersRequest
 from volttron.platform.agent import utils
 
 from master_driver.interfaces import BaseInterface, BaseRegister
+from master_driver.driver_locks import acquire_socket, release_socket
 
 import struct
 import logging
+import socket
 from csv import DictReader
 from StringIO import StringIO
 import os.path
 
-from contextlib import contextmanager, closing
-from master_driver.driver_locks import socket_lock
+import gevent
+import monotonic as clock
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore, Semaphore
+from contextlib import contextmanager
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 1
+DEFAULT_CONNECTION_IDLE_TIMEOUT = 60.0
+#Consecutive request timeouts after which a connection is presumed dead.
+DEFAULT_MAX_TIMEOUTS = 3
+#How often the pool looks for idle connections to close.
+POOL_SWEEP_INTERVAL = 10.0
+#How long the pool waits for a free socket before looking for another
+#connection to close.
+POOL_SOCKET_WAIT = 1.0
+
+#Transaction id, protocol id, length and unit id.
+MBAP_HEADER = struct.Struct('>HHHB')
+
+
+class ModbusTcpConnection(object):
+    """A cooperative Modbus TCP connection to one gateway.
+
+    Requests from any number of greenlets share the socket. Each request
+    gets its own transaction id and a reader greenlet hands responses
+    back by id, so up to max_pending requests may be in flight at once
+    and a request that times out doesn't desynchronize the others. Any
+    socket error closes the connection and fails the pending requests,
+    as do max_timeouts consecutive request timeouts, since a gateway
+    that has gone away without closing the connection never answers.
+
+    The read and write methods match the pymodbus sync client's.
+    """
+    def __init__(self, address, port, timeout=Defaults.Timeout,
+                 max_pending=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 max_timeouts=DEFAULT_MAX_TIMEOUTS, on_close=None):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.max_timeouts = max_timeouts
+        self.on_close = on_close
+        self.timeouts = 0
+        self.semaphore = BoundedSemaphore(max_pending)
+        self.send_lock = Semaphore()
+        self.decoder = ClientDecoder()
+        self.pending = {}
+        self.last_transaction = 0
+        self.last_used = clock.monotonic()
+        try:
+            self.socket = socket.create_connection((address, port), timeout)
+        except socket.error as e:
+            raise ConnectionException("Failed to connect to {}:{} {}".format(
+                address, port, e))
+        self.socket.settimeout(None)
+        #Let the OS notice a dead peer while the connection sits idle.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.reader = gevent.spawn(self._read_responses)
+
+    @property
+    def closed(self):
+        return self.socket is None
+
+    def close(self, reason="connection closed"):
+        if self.socket is None:
+            return
+        self.socket.close()
+        self.socket = None
+        for result in self.pending.itervalues():
+            result.set_exception(ConnectionException("{}:{} {}".format(
+                self.address, self.port, reason)))
+        self.pending.clear()
+        if gevent.getcurrent() is not self.reader:
+            self.reader.kill(block=False)
+        if self.on_close is not None:
+            self.on_close()
+
+    def _next_transaction(self):
+        tid = self.last_transaction
+        while True:
+            tid = tid % 0xffff + 1
+            if tid not in self.pending:
+                self.last_transaction = tid
+                return tid
+
+    def _recv_exactly(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise socket.error("closed by gateway")
+            data += chunk
+        return data
+
+    def _read_responses(self):
+        try:
+            while True:
+                header = self._recv_exactly(MBAP_HEADER.size)
+                tid, protocol, length, unit = MBAP_HEADER.unpack(header)
+                pdu = self._recv_exactly(length - 1)
+                result = self.pending.pop(tid, None)
+                if result is None:
+                    _log.debug("Dropping response %d from %s:%s with no request "
+                               "waiting", tid, self.address, self.port)
+                    continue
+                response = None
+                try:
+                    response = self.decoder.decode(pdu)
+                finally:
+                    if response is None:
+                        result.set_exception(ModbusIOException(
+                            "undecodable response from {}:{}".format(self.address, self.port)))
+                    else:
+                        result.set(response)
+        except Exception as e:
+            #Anything that stops the reader (including AttributeError once
+            #the socket is closed underneath us) would leave the pending
+            #requests waiting for responses nobody reads.
+            if not isinstance(e, (socket.error, AttributeError)):
+                _log.exception("Error reading from Modbus gateway %s:%s",
+                               self.address, self.port)
+            self.close(str(e) or type(e).__name__)
+
+    def execute(self, request):
+        with self.semaphore:
+            if self.socket is None:
+                raise ConnectionException("{}:{} connection closed".format(
+                    self.address, self.port))
+            self.last_used = clock.monotonic()
+            tid = self._next_transaction()
+            request.transaction_id = tid
+            pdu = request.encode()
+            frame = (MBAP_HEADER.pack(tid, 0, len(pdu) + 2, request.unit_id) +
+                     chr(request.function_code) + pdu)
+            result = self.pending[tid] = AsyncResult()
+            try:
+                with self.send_lock:
+                    self.socket.sendall(frame)
+            except (socket.error, AttributeError) as e:
+                self.close(str(e))
+                raise ConnectionException(str(e))
+            try:
+                response = result.get(timeout=self.timeout)
+            except gevent.Timeout:
+                self.timeouts += 1
+                if self.max_timeouts and self.timeouts >= self.max_timeouts:
+                    self.close("no response to {} requests".format(
+                        self.timeouts))
+                raise ModbusIOException("request to {}:{} timed out".format(
+                    self.address, self.port))
+            finally:
+                self.pending.pop(tid, None)
+                self.last_used = clock.monotonic()
+            self.timeouts = 0
+            return response
+
+    def read_coils(self, address, count=1, unit=0):
+        return self.execute(ReadCoilsRequest(address, count, unit=unit))
+
+    def read_discrete_inputs(self, address, count=1, unit=0):
+        return self.execute(ReadDiscreteInputsRequest(address, count, unit=unit))
+
+    def read_holding_registers(self, address, count=1, unit=0):
+        return self.execute(ReadHoldingRegistersRequest(address, count, unit=unit))
+
+    def read_input_registers(self, address, count=1, unit=0):
+        return self.execute(ReadInputRegistersRequest(address, count, unit=unit))
+
+    def write_coil(self, address, value, unit=0):
+        return self.execute(WriteSingleCoilRequest(address, value, unit=unit))
+
+    def write_registers(self, address, values, unit=0):
+        return self.execute(WriteMultipleRegistersRequest(address, values, unit=unit))
+
+
+class ModbusGateway(object):
+    """The persistent connection to a single Modbus TCP gateway.
+
+    Every slave ID behind the gateway shares one connection. At most
+    max_pending requests are in flight on it at once; the default of
+    1 suits gateways bridging to a serial bus. users counts the devices
+    currently borrowing the connection.
+    """
+    def __init__(self, address, port,
+                 max_pending=DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 idle_timeout=DEFAULT_CONNECTION_IDLE_TIMEOUT,
+                 timeout=Defaults.Timeout,
+                 max_timeouts=DEFAULT_MAX_TIMEOUTS, pool=None):
+        self.address = address
+        self.port = port
+        self.max_pending = max_pending
+        self.max_timeouts = max_timeouts
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pool = pool
+        self.connection = None
+        self.users = 0
+        self.connect_lock = Semaphore()
+
+    def checkout(self):
+        with self.connect_lock:
+            if self.connection is None or self.connection.closed:
+                if self.connection is not None:
+                    _log.debug("Reconnecting to Modbus gateway %s:%s",
+                               self.address, self.port)
+                on_close = None
+                if self.pool is not None:
+                    self.pool.reserve_socket(self)
+                    on_close = release_socket
+                try:
+                    self.connection = ModbusTcpConnection(
+                        self.address, self.port, timeout=self.timeout,
+                        max_pending=self.max_pending,
+                        max_timeouts=self.max_timeouts, on_close=on_close)
+                except:
+                    if on_close is not None:
+                        on_close()
+                    raise
+            return self.connection
+
+    def close_idle(self, now):
+        """Close the connection if it has not been used for idle_timeout."""
+        connection = self.connection
+        if (connection is not None and not self.users and
+                not connection.pending and
+                connection.last_used < now - self.idle_timeout):
+            connection.close("idle")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class ModbusConnectionPool(object):
+    """ModbusGateways keyed by (address, port).
+
+    A gateway's settings come from the first device that uses it. Each
+    open connection holds one of the master driver's socket_lock slots,
+    so max_open_sockets bounds the connections in the pool.
+    """
+    def __init__(self):
+        self.gateways = {}
+        self.last_sweep = clock.monotonic()
+
+    def get_gateway(self, address, port, **kwargs):
+        key = (address, port)
+        try:
+            return self.gateways[key]
+        except KeyError:
+            gateway = self.gateways[key] = ModbusGateway(address, port,
+                                                         pool=self, **kwargs)
+            return gateway
+
+    def reserve_socket(self, gateway):
+        """Take a socket_lock slot for a new connection to gateway.
+
+        While no slot is free, the least recently used connection that
+        no device is borrowing is closed to free one.
+        """
+        while not acquire_socket(blocking=False):
+            idle = [other.connection for other in self.gateways.itervalues()
+                    if other is not gateway and not other.users and
+                    other.connection is not None and
+                    not other.connection.closed]
+            if idle:
+                connection = min(idle, key=lambda c: c.last_used)
+                connection.close("too many open sockets")
+            elif acquire_socket(timeout=POOL_SOCKET_WAIT):
+                return
+
+    def sweep(self):
+        now = clock.monotonic()
+        if now - self.last_sweep < POOL_SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        for gateway in self.gateways.itervalues():
+            gateway.close_idle(now)
+
+    def close(self):
+        for gateway in self.gateways.itervalues():
+            gateway.close()
+        self.gateways.clear()
+
+connection_pool = ModbusConnectionPool()
 
 @contextmanager
-def modbus_client(address, port):
-    with socket_lock():
-        with closing(SyncModbusClient(address, port)) as client:
-            yield client
+def modbus_client(address, port, **kwargs):
+    """Borrow the connection to the gateway at address:port.
+
+    Keyword arguments are passed to ModbusGateway when the gateway is
+    first seen. Concurrency is limited per gateway, by its max_pending:
+    each gateway keeps a single socket open however many devices use
+    it, and that socket counts against max_open_sockets while it stays
+    open.
+    """
+    connection_pool.sweep()
+    gateway = connection_pool.get_gateway(address, port, **kwargs)
+    gateway.users += 1
+    try:
+        yield gateway.checkout()
+    finally:
+        gateway.users -= 1
 
 modbus_logger = logging.getLogger("pymodbus")
 modbus_logger.setLevel(logging.WARNING)
@@ -85,6 +384,8 @@ _log = logging.getLogger(__name__)
 
 MODBUS_REGISTER_SIZE = 2
 MODBUS_READ_MAX = 100
+#Unused registers (or bits) a single read may span to avoid another request.
+MODBUS_READ_GAP = 20
 PYMODBUS_REGISTER_STRUCT = struct.Struct('>H')
 
 path = os.path.dirname(os.path.abspath(__file__))
@@ -94,6 +395,34 @@ configFile = os.path.join(path, "example.csv")
 class ModbusInterfaceException(ModbusException):
     pass
 
+
+def plan_reads(registers, max_count=MODBUS_READ_MAX, max_gap=MODBUS_READ_GAP):
+    """Group registers into as few reads as possible.
+
+    Returns a list of (start, count, registers) tuples. Registers are
+    coalesced into one read unless more than max_gap unused addresses
+    separate them or the read would grow past max_count. A register
+    wider than max_count is still read on its own.
+    """
+    reads = []
+    start = end = None
+    group = []
+    for register in sorted(registers, key=lambda r: r.address):
+        reg_start = register.address
+        reg_end = reg_start + register.get_register_count() - 1
+        if (group and reg_start - end - 1 <= max_gap and
+                max(end, reg_end) - start + 1 <= max_count):
+            end = max(end, reg_end)
+            group.append(register)
+            continue
+        if group:
+            reads.append((start, end - start + 1, group))
+        start, end = reg_start, reg_end
+        group = [register]
+    if group:
+        reads.append((start, end - start + 1, group))
+    return reads
+
 class ModbusRegisterBase(BaseRegister):
     def __init__(self, address, register_type, read_only, pointName, units, description = '', slave_id=0):
         super(ModbusRegisterBase, self).__init__(register_type, read_only, pointName, units, description = '')
@@ -194,6 +523,14 @@ class Interface(BaseInterface):
         self.slave_id=config_dict.get("slave_id", 0)
         self.ip_address = config_dict["device_address"]
         self.port = config_dict.get("port", Defaults.Port)
+        self.max_concurrent_requests = config_dict.get("max_concurrent_requests",
+                                                       DEFAULT_MAX_CONCURRENT_REQUESTS)
+        self.connection_idle_timeout = config_dict.get("connection_idle_timeout",
+                                                       DEFAULT_CONNECTION_IDLE_TIMEOUT)
+        self.request_timeout = config_dict.get("request_timeout", Defaults.Timeout)
+        self.max_timeouts = config_dict.get("max_timeouts", DEFAULT_MAX_TIMEOUTS)
+        self.max_read_count = config_dict.get("max_read_count", MODBUS_READ_MAX)
+        self.max_read_gap = config_dict.get("max_read_gap", MODBUS_READ_GAP)
         self.parse_config(registry_config_str) 
         
     def build_ranges_map(self):
@@ -201,9 +538,11 @@ class Interface(BaseInterface):
                                 ('byte',False):[None,None],
                                 ('bit',True):[None,None],
                                 ('bit',False):[None,None]}
+        self.read_plans = {}
         
     def insert_register(self, register):
         super(Interface, self).insert_register(register)
+        self.read_plans.clear()
         
         register_type = register.get_register_type()
         
@@ -220,88 +559,89 @@ class Interface(BaseInterface):
             if register_range[1] < end:
                 register_range[1] = end        
         
+    def modbus_client(self):
+        return modbus_client(self.ip_address, self.port,
+                             max_pending=self.max_concurrent_requests,
+                             idle_timeout=self.connection_idle_timeout,
+                             timeout=self.request_timeout,
+                             max_timeouts=self.max_timeouts)
+        
     def get_point(self, point_name):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
+        try:
+            with self.modbus_client() as client:
                 result = register.get_state(client)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException):
+            result = None
         return result
     
     def set_point(self, point_name, value):    
         register = self.get_register_by_name(point_name)
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
+        try:
+            with self.modbus_client() as client:
                 result = register.set_state(client, value)
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException):
-                result = None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException):
+            result = None
         return result
     
-    def scrape_byte_registers(self, client, read_only):
-        result_dict = {}
-        start, end = self.register_ranges[('byte',read_only)]
-        registers = self.registers[('byte',read_only)]
-        
-        if not registers:
-            return result_dict
-        
-        result = ''
-        
-        for group in xrange(start, end + 1, MODBUS_READ_MAX):
-            count = min(end - group + 1, MODBUS_READ_MAX)            
-            response = client.read_input_registers(group, count, unit=self.slave_id) if read_only else client.read_holding_registers(group, count, unit=self.slave_id)
-            if response is None:
-                raise ModbusInterfaceException("pymodbus returned None")
-            response_bytes = response.encode()
-            result += response_bytes[1:]
-            
-        for register in registers:
-            point = register.point_name
-            value = register.parse_value(start, result)
-            result_dict[point] = value
-            
-        return result_dict
+    def get_read_plan(self, register_type, read_only):
+        key = (register_type, read_only)
+        try:
+            return self.read_plans[key]
+        except KeyError:
+            plan = plan_reads(self.registers[key], self.max_read_count, self.max_read_gap)
+            self.read_plans[key] = plan
+            return plan
     
-    def scrape_bit_registers(self, client, read_only):
-        result_dict = {}
-        start, end = self.register_ranges[('bit',read_only)]
-        registers = self.registers[('bit',read_only)]
-        
-        if not registers:
-            return result_dict
-        
-        result = []
+    def read_block(self, client, register_type, read_only, start, count):
+        if register_type == 'byte':
+            response = client.read_input_registers(start, count, unit=self.slave_id) if read_only else client.read_holding_registers(start, count, unit=self.slave_id)
+        else:
+            response = client.read_discrete_inputs(start, count, unit=self.slave_id) if read_only else client.read_coils(start, count, unit=self.slave_id)
+        if response is None:
+            raise ModbusInterfaceException("pymodbus returned None")
+        if isinstance(response, ExceptionResponse):
+            raise ModbusInterfaceException(str(response))
+        if register_type == 'byte':
+            #skip the result count
+            return response.encode()[1:]
+        return response.bits
         
-        for group in xrange(start, end + 1, MODBUS_READ_MAX):
-            count = min(end - group + 1, MODBUS_READ_MAX)            
-            response = client.read_discrete_inputs(group, count, unit=self.slave_id) if read_only else client.read_coils(group, count, unit=self.slave_id)
-            if response is None:
-                raise ModbusInterfaceException("pymodbus returned None")
-            result += response.bits
-            
-        for register in registers:
-            point = register.point_name
-            value = register.parse_value(start, result)
-            result_dict[point] = value
-            
-        return result_dict
+    def try_read_block(self, *args):
+        """Returns (result, None) or (None, error) so a failed read
+        greenlet doesn't report its exception to the hub."""
+        try:
+            return self.read_block(*args), None
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
+            return None, e
         
     def scrape_all(self):
         result_dict={}
-        with modbus_client(self.ip_address, self.port) as client:
-            try:
-                
-                result_dict.update(self.scrape_byte_registers(client, True))
-                result_dict.update(self.scrape_byte_registers(client, False))
-                
-                result_dict.update(self.scrape_bit_registers(client, True))
-                result_dict.update(self.scrape_bit_registers(client, False))
-            except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
-                _log.error ("Failed to scrape device at " + 
-                           self.ip_address + ":" + str(self.port) + " " + 
-                           "ID: " + str(self.slave_id) + str(e))
-                return None
+        blocks = [(register_type, read_only) + read
+                  for register_type in ('byte', 'bit')
+                  for read_only in (True, False)
+                  for read in self.get_read_plan(register_type, read_only)]
+        try:
+            with self.modbus_client() as client:
+                #Issue every read at once; the connection pipelines as
+                #many as the gateway allows.
+                reads = [gevent.spawn(self.try_read_block, client, register_type, 
+                                      read_only, start, count)
+                         for register_type, read_only, start, count, _ in blocks]
+                for read, (_, _, start, _, registers) in zip(reads, blocks):
+                    result, error = read.get()
+                    if error is not None:
+                        gevent.killall(reads, block=False)
+                        raise error
+                    for register in registers:
+                        point = register.point_name
+                        value = register.parse_value(start, result)
+                        result_dict[point] = value
+        except (ConnectionException, ModbusIOException, ModbusInterfaceException) as e:
+            _log.error ("Failed to scrape device at " + 
+                       self.ip_address + ":" + str(self.port) + " " + 
+                       "ID: " + str(self.slave_id) + str(e))
+            return None
         
         return result_dict
     
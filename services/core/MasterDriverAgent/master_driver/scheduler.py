@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+#
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+#
+
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization
+# that has cooperated in the development of these materials, makes
+# any warranty, express or implied, or assumes any legal liability
+# or responsibility for the accuracy, completeness, or usefulness or
+# any information, apparatus, product, software, or process disclosed,
+# or represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does
+# not necessarily constitute or imply its endorsement, recommendation,
+# r favoring by the United States Government or any agency thereof,
+# or Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+
+#}}}
+
+import logging
+from collections import deque, defaultdict
+
+import gevent
+import monotonic as clock
+
+from volttron.platform.agent import utils
+
+utils.setup_logging()
+_log = logging.getLogger(__name__)
+
+#Scrape latencies kept per device for the statistics.
+LATENCY_SAMPLES = 100
+
+
+def spread(groups):
+    """Order the members of groups so each group is spread evenly.
+
+    groups maps a group key to a list of members. The j-th of a group's k
+    members lands at (j + 0.5) / k of the way through the result, so
+    devices behind the same gateway are as far apart as possible.
+    """
+    positions = []
+    for index, key in enumerate(sorted(groups)):
+        members = groups[key]
+        k = len(members)
+        for j, member in enumerate(members):
+            positions.append(((j + 0.5) / k, index, member))
+    positions.sort()
+    return [member for _, _, member in positions]
+
+
+class ScheduledDevice(object):
+    def __init__(self, name, scrape, interval, group, offset):
+        self.name = name
+        self.scrape = scrape
+        self.interval = interval
+        self.group = group
+        self.offset = offset
+        self.greenlet = None
+        self.scrapes = 0
+        self.overruns = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def tick(self):
+        """Start a scrape unless the last one is still running.
+
+        Returns False if the scrape overran its slot.
+        """
+        if self.greenlet is not None and not self.greenlet.ready():
+            self.overruns += 1
+            _log.warning("scrape of %s still running, skipping this interval",
+                         self.name)
+            return False
+        self.greenlet = gevent.spawn(self.run)
+        return True
+
+    def run(self):
+        start = clock.monotonic()
+        try:
+            self.scrape()
+        finally:
+            self.latencies.append(clock.monotonic() - start)
+            self.scrapes += 1
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        result = {'interval': self.interval,
+                  'group': self.group,
+                  'scrapes': self.scrapes,
+                  'overruns': self.overruns}
+        if latencies:
+            result.update(
+                latency_last=self.latencies[-1],
+                latency_mean=sum(latencies) / len(latencies),
+                latency_median=latencies[len(latencies) // 2],
+                latency_p95=latencies[int(len(latencies) * 0.95)],
+                latency_max=latencies[-1])
+        return result
+
+
+class ScrapeScheduler(object):
+    """Spreads device scrapes evenly across their intervals.
+
+    Devices sharing an interval form a ring, scheduled by one greenlet.
+    Each round the ring's devices get evenly spaced slots, spread so the
+    devices of each group (normally a gateway) are far apart. A device
+    with an offset is scraped that many seconds into the round instead.
+
+    A device whose last scrape is still running when its slot comes
+    round is skipped. If that happens during a round, the next round is
+    stretched by stretch_factor, up to max_stretch times the interval,
+    and it relaxes back once rounds complete without overruns.
+    """
+    def __init__(self, max_stretch=2.0, stretch_factor=1.25, start_delay=1.0):
+        self.max_stretch = max_stretch
+        self.stretch_factor = stretch_factor
+        self.start_delay = start_delay
+        self.devices = {}
+        self.rings = defaultdict(list)
+        self.stretch = {}
+        self.greenlets = {}
+
+    def add(self, name, scrape, interval, group=None, offset=None):
+        """Scrape a device every interval seconds, starting next round."""
+        self.remove(name)
+        device = ScheduledDevice(name, scrape, interval, group, offset)
+        self.devices[name] = device
+        self.rings[interval].append(device)
+        if interval not in self.greenlets:
+            self.stretch[interval] = 1.0
+            self.greenlets[interval] = gevent.spawn_later(
+                self.start_delay, self.run_ring, interval)
+        return device
+
+    def remove(self, name, device=None):
+        """Stop scraping a device.
+
+        If device is given, the device is only removed if it is still
+        the one scheduled under name.
+        """
+        if device is not None and self.devices.get(name) is not device:
+            return
+        device = self.devices.pop(name, None)
+        if device is not None:
+            self.rings[device.interval].remove(device)
+
+    def stop(self):
+        gevent.killall(self.greenlets.values())
+        self.greenlets.clear()
+
+    def plan_round(self, interval):
+        """Return (offset, device) pairs for a round of the ring."""
+        ring = self.rings[interval]
+        groups = defaultdict(list)
+        fixed = []
+        for device in ring:
+            if device.offset is None:
+                groups[device.group].append(device)
+            else:
+                fixed.append((device.offset % interval, device))
+        spaced = spread(groups)
+        slot = float(interval) / max(len(spaced), 1)
+        plan = [(i * slot, device) for i, device in enumerate(spaced)]
+        plan.extend(fixed)
+        plan.sort(key=lambda item: item[0])
+        return plan
+
+    def run_ring(self, interval):
+        round_start = clock.monotonic()
+        while True:
+            stretch = self.stretch[interval]
+            overran = False
+            for offset, device in self.plan_round(interval):
+                delay = round_start + offset * stretch - clock.monotonic()
+                if delay > 0:
+                    gevent.sleep(delay)
+                # Skip devices removed, or added again, since planning.
+                if self.devices.get(device.name) is device:
+                    overran = not device.tick() or overran
+
+            round_start += interval * stretch
+            if overran:
+                stretch = min(stretch * self.stretch_factor, self.max_stretch)
+                _log.warning("scrapes overran their %ss interval, spacing "
+                             "them over %.1fs", interval, interval * stretch)
+            else:
+                stretch = max(stretch / self.stretch_factor, 1.0)
+            self.stretch[interval] = stretch
+
+            delay = round_start - clock.monotonic()
+            if delay > 0:
+                gevent.sleep(delay)
+            else:
+                round_start = clock.monotonic()
+
+    def stats(self):
+        """Scrape counts, overruns and latencies per device."""
+        return {'devices': {name: device.stats()
+                            for name, device in self.devices.iteritems()},
+                'stretch': {str(interval): stretch
+                            for interval, stretch in self.stretch.iteritems()}}
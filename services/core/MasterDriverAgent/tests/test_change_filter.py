@@ -0,0 +1,177 @@
+import unittest
+
+from master_driver.driver import DriverAgent
+
+REGISTRY = '''Volttron Point Name,Deadband,Publish On Change
+Temperature,0.5,
+Setpoint,,TRUE
+Status,,
+Damper,0,
+Fan,,FALSE
+Bad,warm,
+'''
+
+
+class Interface(object):
+
+    def __init__(self, results):
+        self.results = results
+
+    def get_register_names(self):
+        return sorted(self.results)
+
+    def scrape_all(self):
+        return dict(self.results)
+
+
+class Parent(object):
+
+    def get_subscription_prefixes(self):
+        return []
+
+
+def make_driver(results, config=None, registry=REGISTRY):
+    driver = DriverAgent.__new__(DriverAgent)
+    driver.__dict__.update(
+        device_name='campus/building/unit',
+        interface=Interface(results),
+        parent=Parent(),
+        publish_depth_first=True,
+        publish_breadth_first=False,
+        publish_depth_first_all=True,
+        publish_breadth_first_all=False,
+        all_path_depth='devices/campus/building/unit/all',
+        all_path_breadth='devices/all/unit/building/campus',
+        meta_data={name: {} for name in results},
+        point_topics={name: ('devices/campus/building/unit/' + name,
+                             'devices/' + name + '/unit/building/campus')
+                      for name in results})
+    driver.setup_change_filter(config or {}, registry)
+    return driver
+
+
+class ChangeFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = make_driver({'Temperature': 70.0, 'Setpoint': 72,
+                                   'Status': 'on', 'Damper': 10, 'Fan': 1,
+                                   'Bad': 1.0, 'Other': 5})
+
+    def changed(self, **values):
+        changed = self.driver._changed_points(values, False)
+        self.driver._commit_published(changed)
+        return changed
+
+    def deadband(self, name):
+        return self.driver.deadbands[self.driver.point_index[name]]
+
+    def test_registry_settings(self):
+        self.assertEqual(self.deadband('Temperature'), 0.5)
+        self.assertEqual(self.deadband('Setpoint'), 0.0)
+        self.assertIsNone(self.deadband('Status'))
+        self.assertEqual(self.deadband('Damper'), 0.0)
+        self.assertIsNone(self.deadband('Fan'))
+        self.assertIsNone(self.deadband('Other'))
+
+    def test_invalid_deadband_skipped(self):
+        self.assertIsNone(self.deadband('Bad'))
+
+    def test_device_default(self):
+        driver = make_driver({'Status': 'on', 'Fan': 1, 'Other': 5},
+                             {'publish_on_change': True})
+        # Fan, Other and Status.
+        self.assertEqual(driver.deadbands, [None, 0.0, 0.0])
+
+    def test_first_value_published(self):
+        self.assertEqual(self.changed(Temperature=70.0), {'Temperature': 70.0})
+
+    def test_deadband(self):
+        self.changed(Temperature=70.0)
+        self.assertEqual(self.changed(Temperature=70.5), {})
+        self.assertEqual(self.changed(Temperature=69.6), {})
+        self.assertEqual(self.changed(Temperature=70.6),
+                         {'Temperature': 70.6})
+        # Measured from the value last published.
+        self.assertEqual(self.changed(Temperature=70.2), {})
+        self.assertEqual(self.changed(Temperature=70.0),
+                         {'Temperature': 70.0})
+
+    def test_on_change(self):
+        self.changed(Setpoint=72, Status='on')
+        self.assertEqual(self.changed(Setpoint=72, Status='on'),
+                         {'Status': 'on'})
+        self.assertEqual(self.changed(Setpoint=73), {'Setpoint': 73})
+
+    def test_non_numeric_values_with_deadband(self):
+        self.changed(Temperature=70.0)
+        self.assertEqual(self.changed(Temperature='error'),
+                         {'Temperature': 'error'})
+        self.assertEqual(self.changed(Temperature='error'), {})
+        self.assertEqual(self.changed(Temperature=70.0),
+                         {'Temperature': 70.0})
+
+    def test_force(self):
+        self.changed(Setpoint=72)
+        self.assertEqual(self.driver._changed_points({'Setpoint': 72}, True),
+                         {'Setpoint': 72})
+
+    def test_uncommitted_changes_published_again(self):
+        self.changed(Setpoint=72)
+        self.driver._changed_points({'Setpoint': 73}, False)
+        self.assertEqual(self.changed(Setpoint=73), {'Setpoint': 73})
+
+
+class PeriodicReadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = make_driver({'Setpoint': 72, 'Status': 'on'},
+                                  {'force_publish_interval': 0})
+        self.published = []
+        self.succeed = True
+        def publish(items):
+            self.published.append(items)
+            return self.succeed
+        self.driver._publish_wrapper = publish
+
+    def topics(self):
+        return sorted(topic for topic, _, _ in self.published[-1])
+
+    def all_message(self):
+        (headers, message), = [(headers, message)
+                               for topic, headers, message in self.published[-1]
+                               if topic.endswith('/all')]
+        return headers, message
+
+    def test_unchanged_points_not_published(self):
+        self.driver.periodic_read()
+        self.assertEqual(len(self.published[-1]), 3)
+        self.driver.periodic_read()
+        self.assertEqual(self.topics(),
+                         ['devices/campus/building/unit/Status',
+                          'devices/campus/building/unit/all'])
+
+    def test_partial_all_message_marked(self):
+        self.driver.all_snapshot_interval = 2
+        self.driver.periodic_read()
+        headers, message = self.all_message()
+        self.assertNotIn('Partial', headers)
+        self.assertEqual(sorted(message[0]), ['Setpoint', 'Status'])
+        self.driver.periodic_read()
+        headers, message = self.all_message()
+        self.assertIs(headers['Partial'], True)
+        self.assertEqual(sorted(message[0]), ['Status'])
+        self.driver.periodic_read()
+        self.assertNotIn('Partial', self.all_message()[0])
+
+    def test_failed_publish_retried(self):
+        self.succeed = False
+        self.driver.periodic_read()
+        self.succeed = True
+        self.driver.periodic_read()
+        self.assertEqual(len(self.published[-1]), 3)
+        self.driver.periodic_read()
+        self.assertEqual(len(self.published[-1]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
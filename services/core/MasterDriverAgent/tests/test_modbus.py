@@ -0,0 +1,216 @@
+import struct
+import unittest
+
+import gevent
+from gevent.lock import BoundedSemaphore
+from gevent.server import StreamServer
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+from master_driver import driver_locks
+from master_driver.interfaces import modbus
+from master_driver.interfaces.modbus import (MBAP_HEADER, ModbusBitRegister,
+                                             ModbusByteRegister,
+                                             ModbusConnectionPool,
+                                             ModbusTcpConnection, plan_reads)
+
+
+def word(address, type_string='>H'):
+    return ModbusByteRegister(address, type_string, 'w%d' % address, '', True)
+
+
+def bit(address):
+    return ModbusBitRegister(address, '>?', 'b%d' % address, '', True)
+
+
+def spans(reads):
+    return [(start, count, [r.address for r in group])
+            for start, count, group in reads]
+
+
+class PlanReadsTests(unittest.TestCase):
+
+    def test_no_registers(self):
+        self.assertEqual(plan_reads([]), [])
+
+    def test_adjacent_registers_coalesced(self):
+        reads = plan_reads([word(2), word(0), word(1)])
+        self.assertEqual(spans(reads), [(0, 3, [0, 1, 2])])
+
+    def test_wide_registers(self):
+        reads = plan_reads([word(0, '>f'), word(2, '>d'), word(6)])
+        self.assertEqual(spans(reads), [(0, 7, [0, 2, 6])])
+
+    def test_gap_limit(self):
+        reads = plan_reads([word(0), word(6), word(13)], max_gap=5)
+        self.assertEqual(spans(reads), [(0, 7, [0, 6]), (13, 1, [13])])
+
+    def test_zero_gap(self):
+        reads = plan_reads([word(0), word(1), word(3)], max_gap=0)
+        self.assertEqual(spans(reads), [(0, 2, [0, 1]), (3, 1, [3])])
+
+    def test_count_limit(self):
+        reads = plan_reads([word(address) for address in range(10)],
+                           max_count=4)
+        self.assertEqual(spans(reads), [(0, 4, [0, 1, 2, 3]),
+                                        (4, 4, [4, 5, 6, 7]),
+                                        (8, 2, [8, 9])])
+
+    def test_wide_register_at_count_limit(self):
+        reads = plan_reads([word(0), word(1, '>d')], max_count=4)
+        self.assertEqual(spans(reads), [(0, 1, [0]), (1, 4, [1])])
+
+    def test_register_wider_than_count_limit(self):
+        reads = plan_reads([word(0, '>d'), word(4)], max_count=2)
+        self.assertEqual(spans(reads), [(0, 4, [0]), (4, 1, [4])])
+
+    def test_overlapping_registers(self):
+        reads = plan_reads([word(0, '>f'), word(1)])
+        self.assertEqual(spans(reads), [(0, 2, [0, 1])])
+
+    def test_bits(self):
+        reads = plan_reads([bit(address) for address in (0, 1, 30)])
+        self.assertEqual(spans(reads), [(0, 2, [0, 1]), (30, 1, [30])])
+
+    def test_values_parsed_from_coalesced_read(self):
+        registers = [word(10), word(12, '>f'), word(15, '>h')]
+        (start, count, group), = plan_reads(registers)
+        block = struct.pack('>HHfHh', 7, 0, 1.5, 0, -2)
+        self.assertEqual(len(block), count * 2)
+        self.assertEqual([r.parse_value(start, block) for r in group],
+                         [7, 1.5, -2])
+
+
+
+class ModbusTcpConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StreamServer(('127.0.0.1', 0), self.respond)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def respond(self, sock, address):
+        # Answer each read with two registers holding 1 and 2, except
+        # reads of address 99, which are never answered.
+        while True:
+            header = sock.recv(MBAP_HEADER.size)
+            if not header:
+                return
+            tid, protocol, length, unit = MBAP_HEADER.unpack(header)
+            request = sock.recv(length - 1)
+            if struct.unpack('>H', request[1:3])[0] == 99:
+                continue
+            pdu = request[:1] + struct.pack('>BHH', 4, 1, 2)
+            sock.sendall(MBAP_HEADER.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+
+    def connect(self, **kwargs):
+        return ModbusTcpConnection('127.0.0.1', self.server.server_port,
+                                   timeout=5, max_pending=4, **kwargs)
+
+    def test_concurrent_requests(self):
+        connection = self.connect()
+        reads = [gevent.spawn(connection.read_holding_registers, 0, 2)
+                 for _ in range(8)]
+        gevent.joinall(reads, raise_error=True)
+        self.assertEqual([read.value.registers for read in reads],
+                         [[1, 2]] * 8)
+        self.assertEqual(connection.pending, {})
+        connection.close()
+
+    def test_reader_error_fails_pending_requests(self):
+        connection = self.connect()
+        def decode(pdu):
+            raise ValueError('bad response')
+        connection.decoder.decode = decode
+        reads = [gevent.spawn(connection.read_holding_registers, 0, 2)
+                 for _ in range(2)]
+        with gevent.Timeout(1):
+            gevent.joinall(reads)
+        self.assertIsInstance(reads[0].exception, ModbusIOException)
+        self.assertIsInstance(reads[1].exception, ConnectionException)
+        self.assertTrue(connection.closed)
+        self.assertTrue(connection.reader.dead)
+        self.assertRaises(ConnectionException,
+                          connection.read_holding_registers, 0, 2)
+
+    def test_consecutive_timeouts_close_connection(self):
+        connection = self.connect(max_timeouts=2)
+        def time_out():
+            connection.timeout = 0.01
+            self.assertRaises(ModbusIOException,
+                              connection.read_holding_registers, 99, 2)
+            connection.timeout = 5
+        time_out()
+        connection.read_holding_registers(0, 2)
+        time_out()
+        self.assertFalse(connection.closed)
+        time_out()
+        self.assertTrue(connection.closed)
+        self.assertRaises(ConnectionException,
+                          connection.read_holding_registers, 0, 2)
+
+
+class ModbusConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [StreamServer(('127.0.0.1', 0), self.respond)
+                        for _ in range(3)]
+        for server in self.servers:
+            server.start()
+        self.saved = driver_locks._socket_lock, modbus.connection_pool
+        self.lock = driver_locks._socket_lock = BoundedSemaphore(2)
+        self.pool = modbus.connection_pool = ModbusConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        driver_locks._socket_lock, modbus.connection_pool = self.saved
+        for server in self.servers:
+            server.stop()
+
+    def respond(self, sock, address):
+        while sock.recv(1024):
+            pass
+
+    def client(self, index):
+        return modbus.modbus_client('127.0.0.1',
+                                    self.servers[index].server_port)
+
+    def test_least_recently_used_idle_connection_closed(self):
+        with self.client(0) as first:
+            pass
+        with self.client(1) as second:
+            pass
+        with self.client(0):
+            with self.client(2) as third:
+                self.assertFalse(first.closed)
+                self.assertTrue(second.closed)
+                self.assertFalse(third.closed)
+        self.assertEqual(self.lock.counter, 0)
+
+    def test_connections_in_use_not_closed(self):
+        with self.client(0) as first:
+            with self.client(1) as second:
+                waiting = gevent.spawn(self.client(2).__enter__)
+                gevent.sleep(0.01)
+                self.assertFalse(waiting.ready())
+            waiting.join(timeout=5)
+            self.assertTrue(second.closed)
+            self.assertFalse(first.closed)
+
+    def test_closing_releases_sockets(self):
+        with self.client(0) as first:
+            pass
+        with self.client(1):
+            pass
+        first.close()
+        self.assertEqual(self.lock.counter, 1)
+        with self.client(0) as reconnected:
+            self.assertIsNot(reconnected, first)
+        self.assertEqual(self.lock.counter, 0)
+        self.pool.close()
+        self.assertEqual(self.lock.counter, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from master_driver.driver import DriverAgent
+
+
+class Parent(object):
+
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+
+    def get_subscription_prefixes(self):
+        return self.prefixes
+
+
+def make_driver(prefixes, depth='auto', breadth='auto'):
+    driver = DriverAgent.__new__(DriverAgent)
+    driver.__dict__.update(
+        parent=Parent(prefixes),
+        publish_depth_first=depth,
+        publish_breadth_first=breadth,
+        all_path_depth='devices/campus/building/unit/all',
+        all_path_breadth='devices/all/unit/building/campus',
+        point_topics={name: ('devices/campus/building/unit/' + name,
+                             'devices/' + name + '/unit/building/campus')
+                      for name in ('Temperature', 'Setpoint')},
+        _subscribed_forms=None,
+        _subscribed_forms_prefixes=None)
+    return driver
+
+
+class PublishFormsTests(unittest.TestCase):
+
+    def forms(self, prefixes, depth='auto', breadth='auto'):
+        return make_driver(prefixes, depth, breadth)._get_point_publish_forms()
+
+    def test_fixed_forms(self):
+        self.assertEqual(self.forms(None, True, False), (True, False))
+
+    def test_unknown_subscriptions_publish_all_forms(self):
+        self.assertEqual(self.forms(None), (True, True))
+        self.assertEqual(self.forms(None, 'auto', False), (True, False))
+
+    def test_no_point_subscribers(self):
+        self.assertEqual(self.forms([]), (False, False))
+        self.assertEqual(self.forms(['devices', 'analysis/']),
+                         (False, False))
+
+    def test_device_prefix_receives_all_topic_only(self):
+        self.assertEqual(self.forms(['devices/campus/building/unit']),
+                         (False, False))
+
+    def test_point_subscribers(self):
+        self.assertEqual(
+            self.forms(['devices/campus/building/unit/Temperature']),
+            (True, False))
+        self.assertEqual(self.forms(['devices/Setpoint']), (False, True))
+
+    def test_forms_cached_until_list_replaced(self):
+        driver = make_driver([])
+        calls = []
+        check = driver._point_topics_subscribed
+        def counted(*args):
+            calls.append(args[1])
+            return check(*args)
+        driver._point_topics_subscribed = counted
+        driver._get_point_publish_forms()
+        driver._get_point_publish_forms()
+        self.assertEqual(calls, [0, 1])
+        driver.parent.prefixes = ['devices/Setpoint']
+        self.assertEqual(driver._get_point_publish_forms(), (False, True))
+        self.assertEqual(calls, [0, 1, 0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
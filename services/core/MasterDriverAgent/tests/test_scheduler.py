@@ -0,0 +1,114 @@
+import unittest
+
+import gevent
+from gevent.event import Event
+
+from master_driver.scheduler import ScrapeScheduler, spread
+
+
+class SpreadTests(unittest.TestCase):
+
+    def test_single_group_keeps_order(self):
+        self.assertEqual(spread({'a': [1, 2, 3]}), [1, 2, 3])
+
+    def test_groups_interleaved(self):
+        self.assertEqual(spread({'a': ['a1', 'a2'], 'b': ['b1', 'b2']}),
+                         ['a1', 'b1', 'a2', 'b2'])
+
+    def test_group_members_spaced_evenly(self):
+        order = spread({'a': ['a1', 'a2'], 'b': ['b1', 'b2', 'b3', 'b4',
+                                                 'b5', 'b6']})
+        self.assertEqual(len(order), 8)
+        positions = [order.index(member) for member in ('a1', 'a2')]
+        self.assertEqual(positions[1] - positions[0], 4)
+
+    def test_empty(self):
+        self.assertEqual(spread({}), [])
+
+
+class ScrapeSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ScrapeScheduler(start_delay=0)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def plan(self, interval):
+        return [(offset, device.name)
+                for offset, device in self.scheduler.plan_round(interval)]
+
+    def test_plan_spreads_groups(self):
+        for name, group in (('a1', 'a'), ('a2', 'a'), ('b1', 'b'),
+                            ('b2', 'b')):
+            self.scheduler.add(name, lambda: None, 60, group=group)
+        self.assertEqual(self.plan(60), [(0, 'a1'), (15, 'b1'),
+                                         (30, 'a2'), (45, 'b2')])
+
+    def test_plan_fixed_offsets(self):
+        self.scheduler.add('a', lambda: None, 60)
+        self.scheduler.add('b', lambda: None, 60)
+        self.scheduler.add('fixed', lambda: None, 60, offset=70)
+        self.assertEqual(self.plan(60), [(0, 'a'), (10, 'fixed'),
+                                         (30, 'b')])
+
+    def test_intervals_have_separate_rings(self):
+        self.scheduler.add('a', lambda: None, 60)
+        self.scheduler.add('b', lambda: None, 30)
+        self.assertEqual(self.plan(60), [(0, 'a')])
+        self.assertEqual(self.plan(30), [(0, 'b')])
+
+    def test_remove(self):
+        self.scheduler.add('a', lambda: None, 60)
+        self.scheduler.add('b', lambda: None, 60)
+        self.scheduler.remove('a')
+        self.assertEqual(self.plan(60), [(0, 'b')])
+        self.assertEqual(list(self.scheduler.stats()['devices']), ['b'])
+
+    def test_remove_replaced_device(self):
+        old = self.scheduler.add('a', lambda: None, 60)
+        new = self.scheduler.add('a', lambda: None, 60)
+        self.scheduler.remove('a', old)
+        self.assertIs(self.scheduler.devices['a'], new)
+        self.scheduler.remove('a', new)
+        self.assertEqual(self.plan(60), [])
+
+    def test_scrapes_each_interval(self):
+        scrapes = []
+        self.scheduler.add('a', lambda: scrapes.append('a'), 0.05)
+        gevent.sleep(0.22)
+        # Five rounds start in 0.22s, less any lost to a slow test host.
+        self.assertIn(len(scrapes), (3, 4, 5))
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['devices']['a']['scrapes'], len(scrapes))
+        self.assertEqual(stats['devices']['a']['overruns'], 0)
+        self.assertEqual(stats['stretch'], {'0.05': 1.0})
+
+    def test_device_added_again_skipped_until_next_round(self):
+        scrapes = []
+        def replace():
+            if 'b' not in scrapes:
+                self.scheduler.add('a', lambda: scrapes.append('new'), 0.1,
+                                   offset=0.05)
+            scrapes.append('b')
+        self.scheduler.add('a', lambda: scrapes.append('old'), 0.1,
+                           offset=0.05)
+        self.scheduler.add('b', replace, 0.1, offset=0)
+        gevent.sleep(0.3)
+        self.assertNotIn('old', scrapes)
+        self.assertIn('new', scrapes)
+
+    def test_overruns_stretch_then_relax(self):
+        finished = Event()
+        self.scheduler.add('slow', finished.wait, 0.05)
+        gevent.sleep(0.5)
+        self.assertEqual(self.scheduler.stretch[0.05], 2.0)
+        self.assertGreater(self.scheduler.devices['slow'].overruns, 0)
+
+        finished.set()
+        gevent.sleep(0.6)
+        self.assertEqual(self.scheduler.stretch[0.05], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
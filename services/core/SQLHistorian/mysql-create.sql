@@ -10,3 +10,18 @@ CREATE TABLE topics (topic_id INTEGER NOT NULL AUTO_INCREMENT,
                                  topic_name varchar(512) NOT NULL,
 								 PRIMARY KEY (topic_id),
                                  UNIQUE(topic_name));
+
+-- Only needed with "rollups": true in the connection params.
+CREATE INDEX data_topic_idx ON data (topic_id, ts);
+
+CREATE TABLE rollup_5m (topic_id INTEGER NOT NULL,
+                        ts DATETIME NOT NULL,
+                        value_min DOUBLE NOT NULL,
+                        value_max DOUBLE NOT NULL,
+                        value_sum DOUBLE NOT NULL,
+                        value_count INTEGER NOT NULL,
+                        PRIMARY KEY (topic_id, ts));
+
+CREATE TABLE rollup_1h LIKE rollup_5m;
+
+CREATE TABLE rollup_1d LIKE rollup_5m;
@@ -1,3 +1,6 @@
 DROP INDEX data_idx ON data;
 DROP TABLE `data`;
 DROP TABLE topics;
+DROP TABLE IF EXISTS rollup_5m;
+DROP TABLE IF EXISTS rollup_1h;
+DROP TABLE IF EXISTS rollup_1d;
@@ -1,7 +1,10 @@
 from __future__ import absolute_import, print_function
 from abc import abstractmethod
+from datetime import datetime, timedelta
 import importlib
 import logging
+import math
+import threading
 
 from zmq.utils import jsonapi
 
@@ -10,15 +13,49 @@ from volttron.platform.agent import utils
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+# Rollup intervals, finest first, with their length in seconds. Each
+# has a rollup_<name> table holding the min, max, sum and count of the
+# numeric readings of each topic starting at ts.
+ROLLUP_INTERVALS = (('5m', 300), ('1h', 3600), ('1d', 86400))
+ROLLUP_COLUMNS = {'min': 'value_min',
+                  'max': 'value_max',
+                  'avg': 'value_sum / value_count',
+                  'count': 'value_count'}
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def utc_naive(ts):
+    '''Return ts as a naive UTC datetime.
+
+    Naive datetimes are taken to be UTC already.
+    '''
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None) - ts.utcoffset()
+    return ts
+
+
+def rollup_start(ts, seconds):
+    '''Return the start of the rollup interval holding ts.'''
+    ts = utc_naive(ts)
+    delta = ts - _EPOCH
+    offset = (delta.days * 86400 + delta.seconds) % seconds
+    return ts - timedelta(seconds=offset, microseconds=ts.microsecond)
+
+
 class DbDriver(object):
     
-    def __init__(self, dbapimodule, **kwargs):
+    def __init__(self, dbapimodule, rollups=False, **kwargs):
         _log.debug("Constructing Driver for "+ dbapimodule)
         
+        self.rollups = rollups
         self.__dbmodule = importlib.import_module(dbapimodule)
         self.__connection = None
         self.__cursor = None  
         self.__connect_params = kwargs
+        # Queries may come from any thread, so each thread keeps its
+        # own connection for them.
+        self.__query_local = threading.local()
                 
         try:
             if not self.__check_connection():
@@ -52,6 +89,16 @@ class DbDriver(object):
         
         if self.__connection == None:
             self.__connection = self.__dbmodule.connect(**self.__connect_params)        
+
+    def __disconnect(self):
+        '''Close the write connection so the next write reconnects.'''
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except Exception:
+                pass
+        self.__cursor = None
+        self.__connection = None
             
     @abstractmethod
     def get_topic_map(self):
@@ -78,9 +125,96 @@ class DbDriver(object):
         if self.__cursor == None:
             self.__cursor = self.__connection.cursor()
         
-        self.__cursor.execute(self.insert_data_query(), (ts,topic_id,jsonapi.dumps(data)))
+        for statement, params in self.__insert_statements(
+                [(ts, topic_id, data)]):
+            if params is None:
+                self.__cursor.execute(statement)
+            else:
+                for row in params:
+                    self.__cursor.execute(statement, row)
+        return True
+
+    def insert_data_many(self, rows):
+        '''Insert an iterable of (ts, topic_id, data) rows in one call.'''
+        
+        self.__connect()
+
+        if self.__connection is None:
+            return False
+        
+        if self.__cursor == None:
+            self.__cursor = self.__connection.cursor()
+        
+        for statement, params in self.__insert_statements(rows):
+            if params is None:
+                self.__cursor.execute(statement)
+            else:
+                self.__cursor.executemany(statement, params)
         return True
 
+    def __insert_statements(self, rows):
+        if not self.rollups:
+            return self.insert_data_statements(rows)
+        rows = list(rows)
+        return (self.insert_data_statements(rows) +
+                self.rollup_statements(self.__rollup_buckets(rows)))
+
+    def __rollup_buckets(self, rows):
+        '''Return the rollup buckets holding the numeric readings in rows.
+
+        Returns {interval: [(topic_id, start, end), ...]}.
+        '''
+        readings = set()
+        for ts, topic_id, data in rows:
+            if (isinstance(data, bool) or
+                    not isinstance(data, (int, long, float)) or
+                    math.isnan(data) or math.isinf(data)):
+                continue
+            delta = utc_naive(ts) - _EPOCH
+            readings.add((topic_id, delta.days * 86400 + delta.seconds))
+
+        buckets = {}
+        for name, seconds in ROLLUP_INTERVALS:
+            starts = set((topic_id, second - second % seconds)
+                         for topic_id, second in readings)
+            buckets[name] = [(topic_id, _EPOCH + timedelta(seconds=start),
+                              _EPOCH + timedelta(seconds=start + seconds))
+                             for topic_id, start in sorted(starts)]
+        return buckets
+
+    def rollup_statements(self, buckets):
+        '''Return the (statement, params) pairs that recompute buckets.
+
+        buckets maps each interval name in ROLLUP_INTERVALS to a list of
+        (topic_id, start, end) buckets that rows were just written to.
+        The statements run after the rows are inserted and replace each
+        bucket: those of the first interval from the stored readings,
+        and each later interval from the interval before it. Readings
+        that are written again are therefore counted only once.
+        '''
+        raise NotImplementedError(
+            '{} does not support rollups'.format(type(self).__name__))
+
+    def prepare_insert(self, timestamps):
+        '''Create any tables needed to insert readings at timestamps.
+
+        Called before each batch is written, while no write transaction
+        is open. Drivers that store data in tables created as time
+        passes override this.
+        '''
+        pass
+
+    def insert_data_statements(self, rows):
+        '''Return the (statement, params) pairs that insert the rows.
+
+        params is a list of parameter tuples for the statement, or None
+        for a statement that is executed once without parameters. Drivers
+        that store data in more than one table override this.
+        '''
+        return [(self.insert_data_query(),
+                 [(ts, topic_id, jsonapi.dumps(data))
+                  for ts, topic_id, data in rows])]
+
     def insert_topic(self, topic):
         
         self.__connect()
@@ -98,61 +232,86 @@ class DbDriver(object):
         return row
     
     def commit(self):
-        try:
-            retValue = False
-            if self.__connection is not None:
+        '''Commit the current transaction.
+
+        The connection is kept open for the next batch unless the
+        commit fails, in which case it is closed and the next write
+        reconnects.
+        '''
+        retValue = False
+        if self.__connection is not None:
+            try:
                 self.__connection.commit()
                 retValue = True
-            else:
-                _log.warn('connection was null during commit phase.')
-        finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            except Exception:
+                _log.exception('commit failed; reconnecting on next write.')
+                self.__disconnect()
+        else:
+            _log.warn('connection was null during commit phase.')
         return retValue
+
     def rollback(self):
-        try:
-            retValue = False
-            if self.__connection is not None:
+        '''Roll back the current transaction.
+
+        The connection is closed if the rollback fails.
+        '''
+        retValue = False
+        if self.__connection is not None:
+            try:
                 self.__connection.rollback()
                 retValue = True
-            else:
-                _log.warn('connection was null during rollback phase.')
-        finally:
-            if self.__connection is not None:
-                try:
-                    self.__connection.close()
-                except:
-                    pass
-                                                            
-            self.__cursor = None
-            self.__connection = None
+            except Exception:
+                _log.exception('rollback failed; reconnecting on next write.')
+                self.__disconnect()
+        else:
+            _log.warn('connection was null during rollback phase.')
         return retValue
     
     def select(self, query, args):
-        conn = self.__connect(True)
-        cursor = conn.cursor()
-        if args is not None:
-            cursor.execute(query, args)
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
-        return rows
+        '''Run a query and return all of its rows.
+
+        Uses a connection kept for the calling thread, which is
+        replaced and the query retried once if it fails with a database
+        error (such as a dropped server connection).
+        '''
+        for attempt in (1, 2):
+            conn = getattr(self.__query_local, 'connection', None)
+            if conn is None:
+                conn = self.__query_local.connection = self.__connect(True)
+            try:
+                cursor = conn.cursor()
+                if args is not None:
+                    cursor.execute(query, args)
+                else:
+                    cursor.execute(query)
+                rows = cursor.fetchall()
+                cursor.close()
+                # End the read transaction so later queries see new data.
+                conn.rollback()
+                return rows
+            except self.__dbmodule.Error:
+                self.__query_local.connection = None
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                if attempt == 2:
+                    raise
+                _log.warn('query failed; reconnecting and retrying.')
     
     
     @abstractmethod                        
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST",
+                            agg=None, interval=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
+
+         With agg (a key of ROLLUP_COLUMNS) and interval (a name in
+         ROLLUP_INTERVALS) the values are that aggregate for each
+         interval, read from the rollup tables.
         """
         pass
\ No newline at end of file
@@ -62,7 +62,8 @@ import os
 #from mysql import connector
 from zmq.utils import jsonapi
 
-from basedb import DbDriver
+from basedb import (DbDriver, ROLLUP_COLUMNS, ROLLUP_INTERVALS,
+                    rollup_start, utc_naive)
 from volttron.platform.agent import utils
 
 utils.setup_logging()
@@ -74,14 +75,49 @@ class MySqlFuncts(DbDriver):
         #kwargs['dbapimodule'] = 'mysql.connector'
         super(MySqlFuncts, self).__init__('mysql.connector', **kwargs)
         
+    def rollup_statements(self, buckets):
+        statements = []
+        previous = None
+        for name, _ in ROLLUP_INTERVALS:
+            if buckets[name] and previous is None:
+                # Numbers are the JSON values starting with a digit.
+                statements.append((
+                    '''REPLACE INTO rollup_{}
+                       SELECT topic_id, %s, MIN(value_string + 0),
+                              MAX(value_string + 0), SUM(value_string + 0),
+                              COUNT(*)
+                       FROM data
+                       WHERE topic_id = %s AND ts >= %s AND ts < %s AND
+                             value_string REGEXP '^-?[0-9]'
+                       GROUP BY topic_id'''.format(name),
+                    [(start, topic_id, start, end)
+                     for topic_id, start, end in buckets[name]]))
+            elif buckets[name]:
+                statements.append((
+                    '''REPLACE INTO rollup_{}
+                       SELECT topic_id, %s, MIN(value_min), MAX(value_max),
+                              SUM(value_sum), SUM(value_count)
+                       FROM rollup_{}
+                       WHERE topic_id = %s AND ts >= %s AND ts < %s
+                       GROUP BY topic_id'''.format(name, previous),
+                    [(start, topic_id, start, end)
+                     for topic_id, start, end in buckets[name]]))
+            previous = name
+        return statements
+
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST",
+                            agg=None, interval=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
         """
+        if agg is not None:
+            return self.__query_rollup(topic, start, end, skip, count,
+                                       order, agg, interval)
+
         query = '''SELECT data.ts, data.value_string
                    FROM data, topics
                    {where}
@@ -130,7 +166,7 @@ class MySqlFuncts(DbDriver):
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        rows = self.select(real_query)
+        rows = self.select(real_query, args)
         
         if rows:
             values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
@@ -139,6 +175,41 @@ class MySqlFuncts(DbDriver):
         
         return {'values':values}
     
+    def __query_rollup(self, topic, start, end, skip, count, order, agg,
+                       interval):
+        seconds = dict(ROLLUP_INTERVALS)[interval]
+        query = '''SELECT r.ts, r.{column}
+                   FROM rollup_{interval} r, topics
+                   {where}
+                   {order_by}
+                   LIMIT %s OFFSET %s'''
+
+        where_clauses = ["WHERE topics.topic_name = %s",
+                         "topics.topic_id = r.topic_id"]
+        args = [topic]
+
+        if start is not None:
+            where_clauses.append("r.ts >= %s")
+            args.append(rollup_start(start, seconds))
+
+        if end is not None:
+            where_clauses.append("r.ts < %s")
+            args.append(utc_naive(end))
+
+        order_by = 'ORDER BY r.ts ASC'
+        if order == 'LAST_TO_FIRST':
+            order_by = 'ORDER BY r.ts DESC'
+
+        args.append(100 if count is None else count)
+        args.append(skip)
+
+        real_query = query.format(column=ROLLUP_COLUMNS[agg],
+                                  interval=interval,
+                                  where=' AND '.join(where_clauses),
+                                  order_by=order_by)
+        rows = self.select(real_query, args)
+        return {'values': [(ts.isoformat(), value) for ts, value in rows]}
+
     def insert_data_query(self):
         return '''REPLACE INTO data values(%s, %s, %s)'''
         
@@ -55,29 +55,120 @@
 # under Contract DE-AC05-76RL01830
 #}}}
 
+from datetime import datetime, timedelta
 import errno
 import logging
+import math
 import os
 import sqlite3
 
+import pytz
 from zmq.utils import jsonapi
 
-from basedb import DbDriver
+from basedb import (DbDriver, ROLLUP_COLUMNS, ROLLUP_INTERVALS,
+                    rollup_start, utc_naive)
 from volttron.platform.agent import utils
 
 utils.setup_logging()
 _log = logging.getLogger(__name__)
 
+SCHEMAS = ('flat', 'partitioned')
+
+# Partitioned schema: one table per calendar month (UTC), named
+# data_YYYYMM. Timestamps are microseconds since the epoch and numbers
+# are stored natively in the untyped value column; any other value is
+# stored as JSON text.
+_PARTITION_PREFIX = 'data_'
+_CREATE_PARTITION = '''CREATE TABLE IF NOT EXISTS {}
+                       (topic_id INTEGER NOT NULL,
+                        ts INTEGER NOT NULL,
+                        value NOT NULL,
+                        PRIMARY KEY (topic_id, ts)) WITHOUT ROWID'''
+_EPOCH = datetime(1970, 1, 1)
+_MAX_INTEGER = (1 << 63) - 1
+
+
+def to_micros(ts):
+    '''Return a datetime as microseconds since the epoch, UTC.
+
+    Naive datetimes are taken to be UTC already.
+    '''
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None) - ts.utcoffset()
+    delta = ts - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(micros):
+    '''Return the naive UTC datetime for microseconds since the epoch.'''
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def utc_isoformat(ts):
+    '''Return a UTC datetime in ISO 8601 form, with its offset.
+
+    sqlite3 drops the offset of stored timestamps, so naive datetimes
+    read back are taken to be UTC.
+    '''
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=pytz.utc)
+    return ts.isoformat()
+
+
+def partition_name(micros):
+    '''Return the name of the table holding the given timestamp.'''
+    ts = from_micros(micros)
+    return '{}{:04d}{:02d}'.format(_PARTITION_PREFIX, ts.year, ts.month)
+
+
+def encode_value(value):
+    '''Return value as stored in the partitioned value column.'''
+    if isinstance(value, bool):
+        return jsonapi.dumps(value)
+    if isinstance(value, (int, long)) and -_MAX_INTEGER <= value <= _MAX_INTEGER:
+        return value
+    if isinstance(value, float) and not (math.isnan(value) or
+                                         math.isinf(value)):
+        return value
+    return jsonapi.dumps(value)
+
+
+def decode_value(value):
+    '''Return a value read from the partitioned value column.'''
+    if isinstance(value, basestring):
+        return jsonapi.loads(value)
+    return value
+
+
 class SqlLiteFuncts(DbDriver):
+    '''SQLite historian storage.
 
-    def __init__(self, database, **kwargs):
+    The schema parameter picks the table layout. 'flat' (the default)
+    keeps every reading in one data table with JSON encoded values.
+    'partitioned' keeps each month in its own data_YYYYMM table keyed
+    on (topic_id, ts), so per topic queries read only the months and
+    rows they need. With retention_months set, whole months older than
+    that are dropped as new months are started.
+
+    With rollups set, rollup_5m, rollup_1h and rollup_1d tables are
+    kept up to date as data is inserted and serve aggregate queries.
+    '''
+
+    def __init__(self, database, schema='flat', retention_months=None,
+                 **kwargs):
+
+        if schema not in SCHEMAS:
+            raise ValueError('schema must be one of {}'.format(
+                ', '.join(SCHEMAS)))
+        self.__partitioned = schema == 'partitioned'
+        self.__retention_months = retention_months
 
         if database == ':memory:':
             self.__database = database
         else:
             self.__database = os.path.expandvars(os.path.expanduser(database))
             db_dir  = os.path.dirname(self.__database)
-
+            
             #If the db does not exist create it
             # in case we are started before the historian.
             try:
@@ -92,19 +183,44 @@ class SqlLiteFuncts(DbDriver):
             
         conn = sqlite3.connect(self.__database, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS data
-                                (ts timestamp NOT NULL,
-                                 topic_id INTEGER NOT NULL,
-                                 value_string TEXT NOT NULL,
-                                 UNIQUE(ts, topic_id))''')
+        if self.__partitioned:
+            cursor.execute('''SELECT COUNT(*) FROM sqlite_master
+                              WHERE type = 'table' AND name = 'data' ''')
+            if cursor.fetchone()[0]:
+                _log.warning('{} has data in the flat schema that will not '
+                             'be queried; convert it with scripts/'
+                             'historian-scripts/migrate-sqlite-historian.py'
+                             .format(self.__database))
+        else:
+            cursor.execute('''CREATE TABLE IF NOT EXISTS data
+                                    (ts timestamp NOT NULL,
+                                     topic_id INTEGER NOT NULL,
+                                     value_string TEXT NOT NULL,
+                                     UNIQUE(ts, topic_id))''')
 
-        cursor.execute('''CREATE INDEX IF NOT EXISTS data_idx
-                                ON data (ts ASC)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS data_idx
+                                    ON data (ts ASC)''')
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS topics
                                 (topic_id INTEGER PRIMARY KEY,
                                  topic_name TEXT NOT NULL,
                                  UNIQUE(topic_name))''')
+
+        if kwargs.get('rollups'):
+            if not self.__partitioned:
+                # Rollup buckets are recomputed from each topic's readings.
+                cursor.execute('''CREATE INDEX IF NOT EXISTS data_topic_idx
+                                        ON data (topic_id, ts)''')
+            for name, _ in ROLLUP_INTERVALS:
+                cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_{}
+                                        (topic_id INTEGER NOT NULL,
+                                         ts timestamp NOT NULL,
+                                         value_min REAL NOT NULL,
+                                         value_max REAL NOT NULL,
+                                         value_sum REAL NOT NULL,
+                                         value_count INTEGER NOT NULL,
+                                         PRIMARY KEY (topic_id, ts))
+                                  WITHOUT ROWID'''.format(name))
         conn.commit()
         conn.close()
         
@@ -120,17 +236,167 @@ class SqlLiteFuncts(DbDriver):
         
         print (kwargs)    
         super(SqlLiteFuncts, self).__init__('sqlite3', **kwargs)
+
+        self.__partitions = set(self.get_partitions())
         
 
+    def get_partitions(self):
+        '''Return the names of the partition tables, oldest first.'''
+        rows = self.select('''SELECT name FROM sqlite_master
+                              WHERE type = 'table' AND name LIKE ?''',
+                           [_PARTITION_PREFIX + '______'])
+        return sorted(name for name, in rows
+                      if name.startswith(_PARTITION_PREFIX) and
+                      name[len(_PARTITION_PREFIX):].isdigit())
+
+    def drop_partitions(self, before):
+        '''Drop the partitions holding only data older than before.
+
+        before is a datetime; the month containing it is kept. Returns
+        the names of the dropped tables.
+        '''
+        keep = partition_name(to_micros(before))
+        dropped = [name for name in self.get_partitions() if name < keep]
+        conn = sqlite3.connect(self.__database)
+        try:
+            for name in dropped:
+                _log.info('dropping partition {}'.format(name))
+                conn.execute('DROP TABLE IF EXISTS {}'.format(name))
+            conn.commit()
+        finally:
+            conn.close()
+        self.__partitions.difference_update(dropped)
+        return dropped
+
+    def __retention_cutoff(self, micros):
+        ts = from_micros(micros)
+        months = ts.year * 12 + ts.month - 1 - self.__retention_months
+        return datetime(months // 12, months % 12 + 1, 1)
+
+    def prepare_insert(self, timestamps):
+        if not self.__partitioned:
+            return
+        micros = [to_micros(ts) for ts in timestamps]
+        names = set(partition_name(m) for m in micros)
+        missing = sorted(names - self.__partitions)
+        if not missing:
+            return
+        # DDL would commit the writer's open transaction, so new months
+        # are created, and expired ones dropped, on a connection of
+        # their own before the batch is written.
+        dropped = []
+        if self.__retention_months is not None:
+            cutoff = self.__retention_cutoff(max(micros))
+            keep = partition_name(to_micros(cutoff))
+            dropped = [name for name in self.__partitions
+                       if name < keep and name not in names]
+        conn = sqlite3.connect(self.__database)
+        try:
+            for name in missing:
+                conn.execute(_CREATE_PARTITION.format(name))
+            for name in sorted(dropped):
+                _log.info('dropping partition {}'.format(name))
+                conn.execute('DROP TABLE IF EXISTS {}'.format(name))
+            conn.commit()
+        finally:
+            conn.close()
+        self.__partitions.update(missing)
+        self.__partitions.difference_update(dropped)
+
+    def insert_data_statements(self, rows):
+        if not self.__partitioned:
+            return super(SqlLiteFuncts, self).insert_data_statements(rows)
+
+        tables = {}
+        for ts, topic_id, data in rows:
+            micros = to_micros(ts)
+            tables.setdefault(partition_name(micros), []).append(
+                (topic_id, micros, encode_value(data)))
+
+        statements = []
+        for name in sorted(tables):
+            if name not in self.__partitions:
+                # Not prepared; creating it here commits the rows
+                # written so far in this transaction.
+                _log.warning('creating partition {} mid-transaction; call '
+                             'prepare_insert first'.format(name))
+                statements.append((_CREATE_PARTITION.format(name), None))
+                self.__partitions.add(name)
+            statements.append(
+                ('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)'.format(name),
+                 tables[name]))
+        return statements
+
+    def rollup_statements(self, buckets):
+        statements = []
+        previous = None
+        for name, _ in ROLLUP_INTERVALS:
+            if previous is None:
+                statements.extend(self.__reading_rollup_statements(
+                    name, buckets[name]))
+            elif buckets[name]:
+                statements.append((
+                    '''INSERT OR REPLACE INTO rollup_{}
+                       SELECT topic_id, ?, MIN(value_min), MAX(value_max),
+                              TOTAL(value_sum), SUM(value_count)
+                       FROM rollup_{}
+                       WHERE topic_id = ? AND ts >= ? AND ts < ?
+                       GROUP BY topic_id'''.format(name, previous),
+                    [(start, topic_id, start, end)
+                     for topic_id, start, end in buckets[name]]))
+            previous = name
+        return statements
+
+    def __reading_rollup_statements(self, name, buckets):
+        if not self.__partitioned:
+            if not buckets:
+                return []
+            # Numbers are the JSON values starting with a digit.
+            return [('''INSERT OR REPLACE INTO rollup_{}
+                        SELECT topic_id, ?,
+                               MIN(CAST(value_string AS REAL)),
+                               MAX(CAST(value_string AS REAL)),
+                               TOTAL(CAST(value_string AS REAL)), COUNT(*)
+                        FROM data
+                        WHERE topic_id = ? AND ts >= ? AND ts < ? AND
+                              (value_string GLOB '[0-9]*' OR
+                               value_string GLOB '-[0-9]*')
+                        GROUP BY topic_id'''.format(name),
+                     [(start, topic_id, start, end)
+                      for topic_id, start, end in buckets])]
+
+        # A bucket never spans two months.
+        tables = {}
+        for topic_id, start, end in buckets:
+            begin = to_micros(start)
+            tables.setdefault(partition_name(begin), []).append(
+                (start, topic_id, begin, to_micros(end)))
+        return [('''INSERT OR REPLACE INTO rollup_{}
+                    SELECT topic_id, ?, MIN(value), MAX(value),
+                           TOTAL(value), COUNT(*)
+                    FROM {}
+                    WHERE topic_id = ? AND ts >= ? AND ts < ? AND
+                          typeof(value) IN ('integer', 'real')
+                    GROUP BY topic_id'''.format(name, table), params)
+                for table, params in sorted(tables.iteritems())]
 
     def query(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST",
+                            agg=None, interval=None):
         """This function should return the results of a query in the form:
         {"values": [(timestamp1, value1), (timestamp2, value2), ...],
          "metadata": {"key1": value1, "key2": value2, ...}}
 
          metadata is not required (The caller will normalize this to {} for you)
         """
+        if agg is not None:
+            return self.__query_rollup(topic, start, end, skip, count,
+                                       order, agg, interval)
+
+        if self.__partitioned:
+            return self.__query_partitions(topic, start, end, skip, count,
+                                           order)
+
         query = '''SELECT data.ts, data.value_string
                    FROM data, topics
                    {where}
@@ -178,13 +444,95 @@ class SqlLiteFuncts(DbDriver):
         _log.debug("Real Query: " + real_query)
         _log.debug("args: "+str(args))
 
-        c = sqlite3.connect(self.__database, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        rows = c.execute(real_query,args)
+        rows = self.select(real_query, args)
 
-        values = [(ts.isoformat(), jsonapi.loads(value)) for ts, value in rows]
+        values = [(utc_isoformat(ts), jsonapi.loads(value))
+                  for ts, value in rows]
         _log.debug("QueryResults: " + str(values))
         return {'values':values}
 
+    def __query_rollup(self, topic, start, end, skip, count, order, agg,
+                       interval):
+        seconds = dict(ROLLUP_INTERVALS)[interval]
+        query = '''SELECT r.ts, r.{column}
+                   FROM rollup_{interval} r, topics
+                   {where}
+                   {order_by}
+                   LIMIT ? OFFSET ?'''
+
+        where_clauses = ["WHERE topics.topic_name = ?",
+                         "topics.topic_id = r.topic_id"]
+        args = [topic]
+
+        if start is not None:
+            where_clauses.append("r.ts >= ?")
+            args.append(rollup_start(start, seconds))
+
+        if end is not None:
+            where_clauses.append("r.ts < ?")
+            args.append(utc_naive(end))
+
+        order_by = 'ORDER BY r.ts ASC'
+        if order == 'LAST_TO_FIRST':
+            order_by = 'ORDER BY r.ts DESC'
+
+        args.append(-1 if count is None else count)
+        args.append(skip)
+
+        real_query = query.format(column=ROLLUP_COLUMNS[agg],
+                                  interval=interval,
+                                  where=' AND '.join(where_clauses),
+                                  order_by=order_by)
+        rows = self.select(real_query, args)
+        values = [(utc_isoformat(ts), value) for ts, value in rows]
+        _log.debug("QueryResults: " + str(values))
+        return {'values': values}
+
+    def __query_partitions(self, topic, start, end, skip, count, order):
+        rows = self.select('SELECT topic_id FROM topics WHERE topic_name = ?',
+                           [topic])
+        if not rows:
+            return {'values': []}
+        topic_id = rows[0][0]
+
+        where_clauses = ['topic_id = ?']
+        args = [topic_id]
+        partitions = self.get_partitions()
+        if start is not None:
+            start = to_micros(start)
+            where_clauses.append('ts > ?')
+            args.append(start)
+            first = partition_name(start)
+            partitions = [name for name in partitions if name >= first]
+        if end is not None:
+            end = to_micros(end)
+            where_clauses.append('ts < ?')
+            args.append(end)
+            last = partition_name(end)
+            partitions = [name for name in partitions if name <= last]
+
+        descending = order == 'LAST_TO_FIRST'
+        if descending:
+            partitions.reverse()
+        query = 'SELECT ts, value FROM {{}} WHERE {} ORDER BY ts {} LIMIT ?'
+        query = query.format(' AND '.join(where_clauses),
+                             'DESC' if descending else 'ASC')
+
+        # Walk the months in order until enough rows have been read to
+        # cover the offset and count.
+        wanted = -1 if count is None else skip + count
+        results = []
+        for name in partitions:
+            limit = -1 if wanted < 0 else wanted - len(results)
+            results.extend(self.select(query.format(name), args + [limit]))
+            if 0 <= wanted <= len(results):
+                break
+
+        values = [(utc_isoformat(from_micros(ts)), decode_value(value))
+                  for ts, value in results[skip:]]
+        _log.debug("QueryResults: " + str(values))
+        return {'values': values}
+
     def insert_data_query(self):
         return '''INSERT OR REPLACE INTO data values(?, ?, ?)'''
     
@@ -194,4 +542,4 @@ class SqlLiteFuncts(DbDriver):
     def get_topic_map(self):
         q = "SELECT topic_id, topic_name FROM topics"
         rows = self.select(q, None)
-        return dict([(n, t) for t, n in rows])
\ No newline at end of file
+        return dict([(n, t) for t, n in rows])
@@ -70,6 +70,7 @@ from volttron.platform.vip.agent import *
 from volttron.platform.agent.base_historian import BaseHistorian
 from volttron.platform.agent import utils
 from volttron.platform.messaging import topics, headers as headers_mod
+from sqlhistorian.db.basedb import ROLLUP_INTERVALS
 
 #import sqlhistorian
 #import sqlhistorian.settings
@@ -115,6 +116,9 @@ def historian(config_path, **kwargs):
         of the BaseHistorianAgent.
         '''
 
+        if params.get('rollups'):
+            rollup_intervals = tuple(name for name, _ in ROLLUP_INTERVALS)
+
         @Core.receiver("onstart")
         def starting(self, sender, **kwargs):
             
@@ -164,7 +168,9 @@ def historian(config_path, **kwargs):
                 self.topic_map = self.reader.get_topic_map()
 
             try:
-                real_published = []
+                self.writer.prepare_insert(
+                    x['timestamp'] for x in to_publish_list)
+                rows = []
                 for x in to_publish_list:
                     ts = x['timestamp']
                     topic = x['topic']
@@ -180,10 +186,8 @@ def historian(config_path, **kwargs):
                         self.topic_map[topic] = topic_id
                         _log.debug('TopicId: {} => {}'.format(topic_id, topic))
                     
-                    if self.writer.insert_data(ts,topic_id, value):
-                        #_log.debug('item was inserted')
-                        real_published.append(x)
-                if len(real_published) > 0:            
+                    rows.append((ts, topic_id, value))
+                if rows and self.writer.insert_data_many(rows):
                     if self.writer.commit():
                         _log.debug('published {} data values'.format(len(to_publish_list)))
                         self.report_all_handled()
@@ -206,7 +210,8 @@ def historian(config_path, **kwargs):
                 return []
 
         def query_historian(self, topic, start=None, end=None, skip=0,
-                            count=None, order="FIRST_TO_LAST"):
+                            count=None, order="FIRST_TO_LAST", agg=None,
+                            interval=None):
             """This function should return the results of a query in the form:
             {"values": [(timestamp1, value1), (timestamp2, value2), ...],
              "metadata": {"key1": value1, "key2": value2, ...}}
@@ -214,7 +219,8 @@ def historian(config_path, **kwargs):
              metadata is not required (The caller will normalize this to {} for you)
             """
             return self.reader.query(topic, start=start, end=end, skip=skip,
-                                     count=count, order=order)
+                                     count=count, order=order, agg=agg,
+                                     interval=interval)
 
         def historian_setup(self):
             try:
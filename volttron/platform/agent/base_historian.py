@@ -57,17 +57,22 @@
 
 from __future__ import absolute_import, print_function
 from abc import abstractmethod
-from collections import defaultdict
+import base64
+from collections import defaultdict, Sequence
 from dateutil.parser import parse
 from datetime import datetime, timedelta
+import heapq
 import logging
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 from Queue import Queue, Empty
 import re
 import sqlite3
-from threading import Thread
+from threading import Thread, local as threadlocal
+import zlib
 
 import gevent
+import monotonic as clock
 import pytz
 from zmq.utils import jsonapi
 
@@ -80,6 +85,41 @@ _log = logging.getLogger(__name__)
 
 ACTUATOR_TOPIC_PREFIX_PARTS = len(topics.ACTUATOR_VALUE.split('/'))
 ALL_REX = re.compile('.*/all$')
+QUERY_AGGREGATES = ('min', 'max', 'avg', 'count')
+
+# Backup cache statements. sqlite3 keeps recently used statements
+# prepared, so these are compiled once and reused.
+_INSERT_TOPIC = '''INSERT INTO topics values (NULL, ?)'''
+_INSERT_POINT_LIST = '''INSERT INTO point_lists values (NULL, ?, ?)'''
+_REPLACE_SCRAPE = \
+    '''INSERT OR REPLACE INTO outstanding_scrapes values(NULL, ?, ?, ?, ?, ?)'''
+_REPLACE_METADATA = '''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)'''
+_REPLACE_OUTSTANDING = \
+    '''INSERT OR REPLACE INTO outstanding values(NULL, ?, ?, ?, ?)'''
+_MISSING = object()
+
+class _BackupRecords(Sequence):
+    '''Records from the backup cache waiting to be published.
+
+    rows are (timestamp, is_scrape, row) tuples in timestamp order. They
+    are expanded into per point record dictionaries by expand when the
+    records are first accessed.
+    '''
+
+    def __init__(self, rows, length, expand):
+        self.rows = rows
+        self._length = length
+        self._expand = expand
+        self._records = None
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if self._records is None:
+            self._records = self._expand(self.rows)
+        return self._records[index]
+
 
 class BaseHistorianAgent(Agent):
     '''This is the base agent for historian Agents.
@@ -102,20 +142,77 @@ class BaseHistorianAgent(Agent):
     This base historian will cache all received messages to a local database
     before publishing it to the historian.  This allows recovery for unexpected
     happenings before the successful writing of data to the historian.
+
+    With columnar_backup enabled (the default) each device and analysis
+    scrape is cached as a single row holding the values of all its
+    points. These rows are expanded into the usual per point records
+    only when publish_to_historian iterates over them.
+
+    Captured messages wait in a bounded queue until they are written to
+    the backup database in batches of up to backup_batch_size items,
+    collected for at most backup_batch_period seconds. When the queue
+    reaches queue_high_water items, new items are discarded
+    (queue_overflow='drop', the default) until the queue has drained to
+    queue_low_water items. With queue_overflow='block' the capturing
+    callbacks wait instead, so no data is lost, but memory is not
+    bounded: each message from the bus is still handled in a greenlet of
+    its own, and the waiting greenlets and their messages accumulate for
+    as long as the publisher outpaces the historian. Queue and batch
+    statistics are available through the get_ingest_stats RPC method.
+
+    Records are published one batch of up to submit_size_limit records
+    at a time. Historians whose publish_to_historian may safely run in
+    several threads at once can set the concurrent_publishes class
+    attribute to publish that many batches at the same time, which
+    hides the latency of network sinks. Each batch is acknowledged
+    separately through report_handled and report_all_handled, and the
+    batches are removed from the backup cache in order once all of them
+    have returned.
     '''
 
+    concurrent_publishes = 1
+
     def __init__(self,
                  retry_period=300.0,
                  submit_size_limit=1000,
                  max_time_publishing=30,
+                 columnar_backup=True,
+                 queue_high_water=10000,
+                 queue_low_water=None,
+                 queue_overflow='drop',
+                 backup_batch_size=1000,
+                 backup_batch_period=1.0,
                  **kwargs):
         super(BaseHistorianAgent, self).__init__(**kwargs)
+        if queue_overflow not in ('block', 'drop'):
+            raise ValueError('invalid queue_overflow: {!r}'.format(
+                queue_overflow))
         self._started = False
         self._retry_period = retry_period
         self._submit_size_limit = submit_size_limit
         self._max_time_publishing = timedelta(seconds=max_time_publishing)
-        self._successful_published = set()
+        self._columnar_backup = columnar_backup
+        self._queue_high_water = queue_high_water
+        if queue_low_water is None:
+            queue_low_water = queue_high_water // 2
+        self._queue_low_water = queue_low_water
+        self._queue_overflow = queue_overflow
+        self._queue_throttled = False
+        self._backup_batch_size = backup_batch_size
+        self._backup_batch_period = backup_batch_period
+        self._ingest_stats = {'dropped': 0,
+                              'batches': 0,
+                              'batched_items': 0,
+                              'last_batch_size': 0,
+                              'max_batch_size': 0,
+                              'ingest_lag': None,
+                              'publish_lag': None}
+        self._publish_local = threadlocal()
+        self._publish_pool = None
         self._meta_data = defaultdict(dict)
+        # Point lists of cached scrapes by id, and ids by point list.
+        self._point_lists = {}
+        self._point_list_ids = {}
 
         self._event_queue = Queue()
         self._process_thread = Thread(target = self._process_loop)
@@ -155,6 +252,83 @@ class BaseHistorianAgent(Agent):
                                callback=self.capture_analysis_data)
         self._started = True
         
+    @RPC.export
+    def get_ingest_stats(self):
+        '''Return statistics for the queue between capture and backup.
+
+        Lags are in seconds. ingest_lag is how long the oldest item of
+        the last batch waited in the queue. publish_lag is the age of
+        the oldest record in the last successful publish.
+        '''
+        stats = dict(self._ingest_stats)
+        stats.update(queue_depth=self._event_queue.qsize(),
+                     queue_high_water=self._queue_high_water,
+                     queue_low_water=self._queue_low_water,
+                     queue_overflow=self._queue_overflow,
+                     throttled=self._queue_throttled)
+        return stats
+
+    def _queue_event(self, item):
+        '''Queue a captured item for backup, applying the water marks.'''
+        queue = self._event_queue
+        if not self._queue_throttled and \
+                queue.qsize() >= self._queue_high_water:
+            self._queue_throttled = True
+            _log.warning('ingest queue reached {} items; {} new items'.format(
+                self._queue_high_water,
+                'blocking' if self._queue_overflow == 'block'
+                else 'dropping'))
+        if self._queue_throttled:
+            if self._queue_overflow == 'drop':
+                if queue.qsize() > self._queue_low_water:
+                    self._ingest_stats['dropped'] += 1
+                    return
+            else:
+                # Only this greenlet waits; the agent keeps running and
+                # keeps spawning a greenlet for every new message.
+                while queue.qsize() > self._queue_low_water:
+                    gevent.sleep(0.1)
+            if self._queue_throttled:
+                self._queue_throttled = False
+                _log.info('ingest queue drained to {} items'.format(
+                    self._queue_low_water))
+        queue.put((clock.monotonic(), item))
+
+    def _get_batch(self, wait):
+        '''Return the next batch of queued items for backup.
+
+        If wait is true, wait up to retry_period for an item and then
+        keep collecting until backup_batch_size items are collected or
+        backup_batch_period has passed since the first was queued.
+        Otherwise, only take the items already queued.
+        '''
+        queue = self._event_queue
+        try:
+            oldest, item = queue.get(wait, self._retry_period)
+        except Empty:
+            return []
+        batch = [item]
+        deadline = oldest + self._backup_batch_period
+        while len(batch) < self._backup_batch_size:
+            timeout = deadline - clock.monotonic()
+            try:
+                if wait and timeout > 0:
+                    _, item = queue.get(True, timeout)
+                else:
+                    _, item = queue.get_nowait()
+            except Empty:
+                break
+            batch.append(item)
+
+        stats = self._ingest_stats
+        size = len(batch)
+        stats['batches'] += 1
+        stats['batched_items'] += size
+        stats['last_batch_size'] = size
+        stats['max_batch_size'] = max(stats['max_batch_size'], size)
+        stats['ingest_lag'] = clock.monotonic() - oldest
+        return batch
+
     @Core.receiver("onstop")
     def stopping(self, sender, **kwargs):
         '''
@@ -180,9 +354,14 @@ class BaseHistorianAgent(Agent):
             # we can do the proper thing when it is here
             if sender == 'pubsub.compat':
                 data = jsonapi.loads(message)
+            elif (headers.get(headers_mod.CONTENT_ENCODING) ==
+                    headers_mod.CONTENT_ENCODING.ZLIB_BASE64):
+                # Large batches from a forwarder are compressed.
+                data = jsonapi.loads(zlib.decompress(
+                    base64.b64decode(message)))
             else:
                 data = message
-        except ValueError as e:
+        except (ValueError, TypeError, zlib.error) as e:
             _log.error("message for {topic} bad message string: {message_string}".format(topic=topic,
                                                                                      message_string=message[0]))
             return
@@ -210,18 +389,34 @@ class BaseHistorianAgent(Agent):
 
             if not isinstance(readings, list):
                 readings = [(datetime.utcnow(), readings)]
-            elif isinstance(readings[0],str):
+            elif isinstance(readings[0], basestring):
                 my_ts, my_tz = process_timestamp(readings[0])
                 readings = [(my_ts,readings[1])]
                 if tz:
                     meta['tz'] = tz
                 elif my_tz:
                     meta['tz'] = my_tz
+            else:
+                # A list of [timestamp, value] readings.
+                parsed = []
+                my_tz = None
+                for my_ts, value in readings:
+                    result = process_timestamp(my_ts)
+                    if result is not None:
+                        my_ts, my_tz = result
+                        parsed.append((my_ts, value))
+                if not parsed:
+                    continue
+                readings = parsed
+                if tz:
+                    meta['tz'] = tz
+                elif my_tz:
+                    meta['tz'] = my_tz
 
-            self._event_queue.put({'source': source,
-                                   'topic': topic+'/'+point,
-                                   'readings': readings,
-                                   'meta':meta})
+            self._queue_event({'source': source,
+                               'topic': topic+'/'+point,
+                               'readings': readings,
+                               'meta':meta})
 
     def capture_device_data(self, peer, sender, bus, topic, headers, message):
         '''Capture device data and submit it to be published by a historian.
@@ -307,13 +502,21 @@ class BaseHistorianAgent(Agent):
             source = 'scrape'
         _log.debug("Queuing {topic} from {source} for publish".format(topic=topic,
                                                                       source=source))
-        
+
+        if self._columnar_backup:
+            self._queue_event({'source': source,
+                               'device': device,
+                               'timestamp': timestamp,
+                               'values': values,
+                               'meta': meta})
+            return
+
         for key, value in values.iteritems():
             point_topic = device + '/' + key
-            self._event_queue.put({'source': source,
-                                   'topic': point_topic,
-                                   'readings': [(timestamp,value)],
-                                   'meta': meta.get(key,{})})
+            self._queue_event({'source': source,
+                               'topic': point_topic,
+                               'readings': [(timestamp,value)],
+                               'meta': meta.get(key,{})})
 
     def capture_actuator_data(self, topic, headers, message, match):
         '''Capture actuation data and submit it to be published by a historian.
@@ -347,10 +550,10 @@ class BaseHistorianAgent(Agent):
                                                                       source=source))
 
 
-        self._event_queue.put({'source': source,
-                               'topic': topic,
-                               'readings': [timestamp, value],
-                               'meta': meta.get(key,{})})
+        self._queue_event({'source': source,
+                           'topic': topic,
+                           'readings': [timestamp, value],
+                           'meta': meta.get(key,{})})
 
 
     def _process_loop(self):
@@ -375,41 +578,23 @@ class BaseHistorianAgent(Agent):
         wait_for_input = not bool(self._get_outstanding_to_publish())
 
         while True:
-            try:
-                _log.debug("Reading from/waiting for queue.")
-                new_to_publish = [self._event_queue.get(wait_for_input, self._retry_period)]
-            except Empty:
-                _log.debug("Queue wait timed out. Falling out.")
-                new_to_publish = []
-
+            _log.debug("Reading from/waiting for queue.")
+            new_to_publish = self._get_batch(wait_for_input)
             if new_to_publish:
-                _log.debug("Checking for queue build up.")
-                while True:
-                    try:
-                        new_to_publish.append(self._event_queue.get_nowait())
-                    except Empty:
-                        break
-
-            self._backup_new_to_publish(new_to_publish)
+                self._backup_new_to_publish(new_to_publish)
 
             wait_for_input = True
             start_time = datetime.utcnow()
             
             _log.debug("Calling publish_to_historian.")
             while True:
-                to_publish_list = self._get_outstanding_to_publish()
-                if not to_publish_list or not self._started:
-                    break
-                
-                try:
-                    self.publish_to_historian(to_publish_list)
-                except Exception as exp:
-                     _log.exception("An unhandled exception occured while " \
-                               "publishing to the historian.")
-                
-                if not self._any_sucessfull_publishes():
+                if not self._started or not self._publish_batches():
                     break
-                self._cleanup_successful_publishes()
+
+                # Keep the queue moving while working through a backlog.
+                new_to_publish = self._get_batch(False)
+                if new_to_publish:
+                    self._backup_new_to_publish(new_to_publish)
 
                 now = datetime.utcnow()
                 if now - start_time > self._max_time_publishing:
@@ -424,6 +609,11 @@ class BaseHistorianAgent(Agent):
         self._connection = sqlite3.connect('backup.sqlite',
                                            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
 
+        # Let readers and the writer proceed concurrently and sync to
+        # disk at checkpoints rather than on every commit.
+        self._connection.execute('''PRAGMA journal_mode = WAL''')
+        self._connection.execute('''PRAGMA synchronous = NORMAL''')
+
         c = self._connection.cursor()
         c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='outstanding';")
 
@@ -465,100 +655,288 @@ class BaseHistorianAgent(Agent):
                 self._backup_cache[row[0]] = row[1]
                 self._backup_cache[row[1]] = row[0]
 
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='outstanding_scrapes';")
+
+        if c.fetchone() is None:
+            self._connection.execute('''CREATE TABLE outstanding_scrapes
+                                        (id INTEGER PRIMARY KEY,
+                                         ts timestamp NOT NULL,
+                                         source TEXT NOT NULL,
+                                         topic_id INTEGER NOT NULL,
+                                         points_id INTEGER NOT NULL,
+                                         value_string TEXT NOT NULL,
+                                         UNIQUE(ts, topic_id, source))''')
+
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='point_lists';")
+
+        if c.fetchone() is None:
+            self._connection.execute('''CREATE TABLE point_lists
+                                        (points_id INTEGER PRIMARY KEY,
+                                         topic_id INTEGER NOT NULL,
+                                         points TEXT NOT NULL)''')
+        else:
+            c.execute("SELECT * FROM point_lists")
+            for row in c:
+                device = self._backup_cache[row[1]]
+                names = tuple(jsonapi.loads(row[2]))
+                self._point_lists[row[0]] = tuple(
+                    self._backup_cache[device + '/' + name] for name in names)
+                self._point_list_ids[(row[1], names)] = row[0]
+
         c.close()
 
         self._connection.commit()
 
+    def _publish_batches(self):
+        '''Publish the oldest outstanding batches and clean up after them.
+
+        Up to concurrent_publishes batches are published at once, each
+        in its own thread. Returns True if any records were handled.
+        '''
+        batches = self._get_outstanding_batches(self.concurrent_publishes)
+        if not batches:
+            return False
+        if len(batches) == 1:
+            results = [self._publish_batch(batches[0])]
+        else:
+            if self._publish_pool is None:
+                self._publish_pool = ThreadPool(self.concurrent_publishes)
+            results = self._publish_pool.map(self._publish_batch, batches)
+
+        any_handled = False
+        for to_publish_list, handled in zip(batches, results):
+            if not handled:
+                continue
+            any_handled = True
+            oldest = to_publish_list.rows[0][0].replace(tzinfo=None)
+            self._ingest_stats['publish_lag'] = (
+                datetime.utcnow() - oldest).total_seconds()
+            self._cleanup_successful_publishes(handled, to_publish_list)
+        return any_handled
+
+    def _publish_batch(self, to_publish_list):
+        '''Call publish_to_historian and return the handled record ids.'''
+        handled = self._publish_local.handled = set()
+        try:
+            self.publish_to_historian(to_publish_list)
+        except Exception:
+            _log.exception("An unhandled exception occured while " \
+                           "publishing to the historian.")
+        finally:
+            del self._publish_local.handled
+        return handled
+
     def _get_outstanding_to_publish(self):
-        _log.debug("Getting oldest outstanding to publish.")
-        c = self._connection.cursor()
-        c.execute('select * from outstanding order by ts limit ?', (self._submit_size_limit,))
+        batches = self._get_outstanding_batches(1)
+        return batches[0] if batches else []
 
+    def _get_outstanding_batches(self, count):
+        '''Return up to count batches of the oldest outstanding records.'''
+        _log.debug("Getting oldest outstanding to publish.")
+        limit = self._submit_size_limit
+        # Merge both tables in time order, reading rows only until the
+        # batches are full. Both are ordered by the index on ts.
+        points = self._connection.execute(
+            'select * from outstanding order by ts limit ?', (limit * count,))
+        scrapes = self._connection.execute(
+            'select * from outstanding_scrapes order by ts limit ?',
+            (limit * count,))
+        rows = heapq.merge(((row[1], False, row) for row in points),
+                           ((row[1], True, row) for row in scrapes))
+
+        # A scrape counts as one record per point and is never split.
+        batches = []
+        selected = []
+        size = 0
+        try:
+            for row in rows:
+                selected.append(row)
+                size += len(self._point_lists[row[2][4]]) if row[1] else 1
+                if size >= limit:
+                    batches.append(_BackupRecords(
+                        selected, size, self._expand_backup_rows))
+                    selected = []
+                    size = 0
+                    if len(batches) == count:
+                        break
+        finally:
+            points.close()
+            scrapes.close()
+        if selected:
+            batches.append(_BackupRecords(
+                selected, size, self._expand_backup_rows))
+        return batches
+
+    def _expand_backup_rows(self, rows):
         results = []
-        for row in c:
+        for _, is_scrape, row in rows:
             _id = row[0]
-            timestamp = row[1]
+            timestamp = row[1].replace(tzinfo=pytz.UTC)
             source = row[2]
-            topic_id = row[3]
-            value = jsonapi.loads(row[4])
-            meta = self._meta_data[(source, topic_id)].copy()
-            results.append({'_id':_id,
-                            'timestamp': timestamp.replace(tzinfo=pytz.UTC),
-                            'source': source,
-                            'topic': self._backup_cache[topic_id],
-                            'value': value,
-                            'meta': meta})
-
-        c.close()
-
+            if not is_scrape:
+                topic_id = row[3]
+                results.append({'_id': _id,
+                                'timestamp': timestamp,
+                                'source': source,
+                                'topic': self._backup_cache[topic_id],
+                                'value': jsonapi.loads(row[4]),
+                                'meta': self._meta_data[(source, topic_id)].copy()})
+                continue
+            topic_ids = self._point_lists[row[4]]
+            values = jsonapi.loads(row[5])
+            for index, topic_id in enumerate(topic_ids):
+                results.append({'_id': (_id, index),
+                                'timestamp': timestamp,
+                                'source': source,
+                                'topic': self._backup_cache[topic_id],
+                                'value': values[index],
+                                'meta': self._meta_data[(source, topic_id)].copy()})
         return results
 
-    def _cleanup_successful_publishes(self):
+    def _cleanup_successful_publishes(self, published, to_publish_list):
         _log.debug("Cleaning up successfully published values.")
-        c = self._connection.cursor()
-
-        if None in self._successful_published:
-            c.execute('''DELETE FROM outstanding
-                        WHERE ROWID IN
-                        (SELECT ROWID FROM outstanding
-                          ORDER BY ts LIMIT ?)''', (self._submit_size_limit,))
+        fetched = to_publish_list.rows
+
+        point_ids = []
+        # Handled point indexes by scrape id; None if all were handled.
+        scrapes = defaultdict(set)
+        if None in published:
+            for _, is_scrape, row in fetched:
+                if is_scrape:
+                    scrapes[row[0]] = None
+                else:
+                    point_ids.append(row[0])
         else:
-            temp = list(self._successful_published)
-            temp.sort()
+            for _id in published:
+                if isinstance(_id, tuple):
+                    scrapes[_id[0]].add(_id[1])
+                else:
+                    point_ids.append(_id)
+
+        # The unhandled points of a partially handled scrape are kept
+        # as individual rows.
+        remaining = []
+        fetched_scrapes = {row[0]: row for _, is_scrape, row in fetched
+                           if is_scrape}
+        for scrape_id, handled in scrapes.iteritems():
+            row = fetched_scrapes.get(scrape_id)
+            if row is None or handled is None:
+                continue
+            topic_ids = self._point_lists[row[4]]
+            if len(handled) >= len(topic_ids):
+                continue
+            values = jsonapi.loads(row[5])
+            remaining.extend((row[1], row[2], topic_id, jsonapi.dumps(values[index]))
+                             for index, topic_id in enumerate(topic_ids)
+                             if index not in handled)
+
+        c = self._connection.cursor()
+        if point_ids:
             c.executemany('''DELETE FROM outstanding
                             WHERE id = ?''',
-                            ((_id,) for _id in
-                             self._successful_published))
+                            ((_id,) for _id in point_ids))
+        if scrapes:
+            c.executemany('''DELETE FROM outstanding_scrapes
+                            WHERE id = ?''',
+                            ((_id,) for _id in scrapes))
+        if remaining:
+            c.executemany(_REPLACE_OUTSTANDING, remaining)
+        c.close()
 
         self._connection.commit()
 
-        self._successful_published = set()
-
-    def _any_sucessfull_publishes(self):
-        return bool(self._successful_published)
+    def _get_backup_topic_id(self, c, topic):
+        topic_id = self._backup_cache.get(topic)
+        if topic_id is None:
+            c.execute(_INSERT_TOPIC, (topic,))
+            topic_id = c.lastrowid
+            self._backup_cache[topic_id] = topic
+            self._backup_cache[topic] = topic_id
+        return topic_id
+
+    def _changed_meta(self, source, topic_id, meta, meta_rows):
+        # Metadata rarely changes, so only write what is new.
+        cached_meta = self._meta_data[(source, topic_id)]
+        for name, value in meta.iteritems():
+            if cached_meta.get(name, _MISSING) != value:
+                meta_rows.append((source, topic_id, name, value))
+                cached_meta[name] = value
 
     def _backup_new_to_publish(self, new_publish_list):
         _log.debug("Backing up unpublished values.")
         c = self._connection.cursor()
 
+        meta_rows = []
+        value_rows = []
+        scrape_rows = []
         for item in new_publish_list:
             source = item['source']
-            topic = item['topic']
             meta = item.get('meta', {})
-            values = item['readings']
-
-            topic_id = self._backup_cache.get(topic)
-
-            if topic_id is None:
-                c.execute('''INSERT INTO topics values (?,?)''', (None, topic))
-                c.execute('''SELECT last_insert_rowid()''')
-                row = c.fetchone()
-                topic_id = row[0]
-                self._backup_cache[topic_id] = topic
-                self._backup_cache[topic] = topic_id
-
-            for name, value in meta.iteritems():
-                c.execute('''INSERT OR REPLACE INTO metadata values(?, ?, ?, ?)''',
-                            (source,topic_id,name,value))
-                self._meta_data[(source,topic_id)][name] = value
 
+            if 'device' in item:
+                values = item['values']
+                if not values:
+                    continue
+                device_id = self._get_backup_topic_id(c, item['device'])
+                names = tuple(sorted(values))
+                points_id = self._point_list_ids.get((device_id, names))
+                if points_id is None:
+                    device = item['device']
+                    topic_ids = tuple(
+                        self._get_backup_topic_id(c, device + '/' + name)
+                        for name in names)
+                    c.execute(_INSERT_POINT_LIST,
+                              (device_id, jsonapi.dumps(names)))
+                    points_id = c.lastrowid
+                    self._point_lists[points_id] = topic_ids
+                    self._point_list_ids[(device_id, names)] = points_id
+                if meta:
+                    for name, topic_id in zip(names,
+                                              self._point_lists[points_id]):
+                        self._changed_meta(source, topic_id,
+                                           meta.get(name, {}), meta_rows)
+                scrape_rows.append(
+                    (item['timestamp'], source, device_id, points_id,
+                     jsonapi.dumps([values[name] for name in names])))
+                continue
 
-            
-            for timestamp, value in values:
-                c.execute('''INSERT OR REPLACE INTO outstanding values(NULL, ?, ?, ?, ?)''',
-                          (timestamp,source,topic_id,jsonapi.dumps(value)))
+            topic_id = self._get_backup_topic_id(c, item['topic'])
+            self._changed_meta(source, topic_id, meta, meta_rows)
+            for timestamp, value in item['readings']:
+                value_rows.append(
+                    (timestamp, source, topic_id, jsonapi.dumps(value)))
+
+        if meta_rows:
+            c.executemany(_REPLACE_METADATA, meta_rows)
+        if value_rows:
+            c.executemany(_REPLACE_OUTSTANDING, value_rows)
+        if scrape_rows:
+            c.executemany(_REPLACE_SCRAPE, scrape_rows)
+        c.close()
 
         self._connection.commit()
 
+    def _handled_records(self):
+        handled = getattr(self._publish_local, 'handled', None)
+        if handled is None:
+            _log.error('records may only be reported handled from '
+                       'publish_to_historian')
+        return handled
+
     def report_handled(self, record):
+        handled = self._handled_records()
+        if handled is None:
+            return
         if isinstance(record, list):
             for x in record:
-                self._successful_published.add(x['_id'])
+                handled.add(x['_id'])
         else:
-            self._successful_published.add(record['_id'])
+            handled.add(record['_id'])
 
     def report_all_handled(self):
-        self._successful_published.add(None)
+        handled = self._handled_records()
+        if handled is not None:
+            handled.add(None)
 
     @abstractmethod
     def publish_to_historian(self, to_publish_list):
@@ -576,16 +954,115 @@ class BaseQueryHistorianAgent(Agent):
     Event processing in publish_to_historian and setup in historian_setup
     both happen in the same thread separate from the main thread. This is
     to allow blocking while processing events.
+
+    Historians that keep downsampled rollups list the interval names
+    they support in rollup_intervals; query then accepts an agg from
+    QUERY_AGGREGATES and one of those intervals and passes them on to
+    query_historian.
     '''
 
+    rollup_intervals = ()
+    # Seconds query_stream waits for the caller to ask for the next chunk.
+    query_stream_timeout = 60
+
     @RPC.export
     def query(self, topic=None, start=None, end=None, skip=0,
-              count=None, order="FIRST_TO_LAST"):
+              count=None, order="FIRST_TO_LAST", agg=None, interval=None):
         """Actual RPC handler"""
 
+        start, end = self._check_query(topic, start, end, agg, interval)
+
+        _log.debug("In base query")
+
+        if start:
+            _log.debug("start={}".format(start))
+
+        results = self._query_historian(topic, start, end, skip, count,
+                                        order, agg, interval)
+        metadata = results.get("metadata")
+        if metadata is None:
+            results['metadata'] = {}
+        return results
+
+    @RPC.export
+    def query_stream(self, topic, channel_name, start=None, end=None,
+                     order="FIRST_TO_LAST", agg=None, interval=None,
+                     chunk_size=1000):
+        """Stream the results of a query to the caller over a channel.
+
+        Takes the same arguments as query, less skip and count, plus the
+        name of a channel the caller has opened. Sends 'ready' on the
+        channel, then answers each 'next' with a JSON object holding the
+        next chunk_size values (and, in the first chunk, the metadata),
+        reading them a page at a time from the timestamp of the last
+        value sent. An empty chunk ends the results, which the caller
+        acknowledges with 'done'. Returns the number of values sent.
+        Raises IOError if the caller stops asking for chunks for
+        query_stream_timeout seconds. Use QueryStream to make the calls.
+        """
+        start, end = self._check_query(topic, start, end, agg, interval)
+        chunk_size = max(int(chunk_size), 1)
+        peer = bytes(self.vip.rpc.context.vip_message.peer)
+        channel = self.vip.channel(peer, channel_name)
+        sent = 0
+        cursor = None
+        try:
+            channel.send('ready')
+            while True:
+                request = None
+                with gevent.Timeout(self.query_stream_timeout, False):
+                    request = channel.recv()
+                if request is None:
+                    raise IOError('no request for the next chunk in {} '
+                                  'seconds'.format(self.query_stream_timeout))
+                if request != 'next':
+                    break
+                # Ask for one extra row in case the historian includes
+                # the row at the cursor.
+                results = self._query_historian(
+                    topic, start, end, 0, chunk_size + 1, order, agg,
+                    interval)
+                values = list(results.get('values') or ())
+                if cursor is not None and values and values[0][0] == cursor:
+                    del values[0]
+                del values[chunk_size:]
+                chunk = {'values': values}
+                if cursor is None:
+                    chunk['metadata'] = results.get('metadata') or {}
+                channel.send(jsonapi.dumps(chunk))
+                if not values:
+                    # Messages still queued when the channel closes are
+                    # dropped, so wait for the caller to see the end.
+                    with gevent.Timeout(self.query_stream_timeout, False):
+                        channel.recv()
+                    break
+                sent += len(values)
+                cursor = values[-1][0]
+                if order == 'LAST_TO_FIRST':
+                    end = parse(cursor)
+                else:
+                    start = parse(cursor)
+        finally:
+            channel.close(linger=0)
+            del channel
+        return sent
+
+    def _check_query(self, topic, start, end, agg, interval):
+        '''Validate query arguments and return start and end parsed.'''
         if topic is None:
             raise TypeError('"Topic" required')
 
+        if agg is not None or interval is not None:
+            if not self.rollup_intervals:
+                raise ValueError('this historian does not support '
+                                 'aggregate queries')
+            if agg not in QUERY_AGGREGATES:
+                raise ValueError('agg must be one of {}'.format(
+                    ', '.join(QUERY_AGGREGATES)))
+            if interval not in self.rollup_intervals:
+                raise ValueError('interval must be one of {}'.format(
+                    ', '.join(self.rollup_intervals)))
+
         if start is not None:
             try:
                 start = parse(start)
@@ -598,16 +1075,15 @@ class BaseQueryHistorianAgent(Agent):
             except TypeError:
                 end = time_parser.parse(end)
 
-        _log.debug("In base query")
-
-        if start:
-            _log.debug("start={}".format(start))
+        return start, end
 
-        results = self.query_historian(topic, start, end, skip, count, order)
-        metadata = results.get("metadata")
-        if metadata is None:
-            results['metadata'] = {}
-        return results
+    def _query_historian(self, topic, start, end, skip, count, order, agg,
+                         interval):
+        if agg is None:
+            return self.query_historian(topic, start, end, skip, count,
+                                        order)
+        return self.query_historian(topic, start, end, skip, count, order,
+                                    agg=agg, interval=interval)
 
     @RPC.export
     def get_topic_list(self):
@@ -629,6 +1105,65 @@ class BaseQueryHistorianAgent(Agent):
 class BaseHistorian(BaseHistorianAgent, BaseQueryHistorianAgent):
     pass
 
+
+class QueryStream(object):
+    '''Iterate over the (timestamp, value) results of a historian query.
+
+    The results are streamed from the historian's query_stream over a
+    VIP channel a chunk at a time, so neither side holds more than one
+    chunk. agent is the agent making the query and peer the historian's
+    identity; the remaining keyword arguments are passed to
+    query_stream. metadata is set once the first chunk arrives.
+
+        for ts, value in QueryStream(self, 'platform.historian', topic,
+                                     start='2016-01-01T00:00:00'):
+            ...
+    '''
+
+    def __init__(self, agent, peer, topic, **kwargs):
+        self.agent = agent
+        self.peer = peer
+        self.topic = topic
+        self.kwargs = kwargs
+        self.metadata = None
+
+    def __iter__(self):
+        channel = self.agent.vip.channel(self.peer)
+        # The call lasts as long as the stream, so it must not time out.
+        result = self.agent.vip.rpc.call_with_timeout(
+            None, self.peer, 'query_stream', self.topic, channel.name,
+            **self.kwargs)
+        done = False
+        try:
+            self._recv(channel, result)
+            while True:
+                channel.send('next')
+                chunk = jsonapi.loads(self._recv(channel, result))
+                if 'metadata' in chunk:
+                    self.metadata = chunk['metadata']
+                if not chunk['values']:
+                    channel.send('done')
+                    break
+                for ts, value in chunk['values']:
+                    yield ts, value
+            done = True
+            result.get()
+        finally:
+            if not done:
+                channel.send('stop')
+            channel.close(linger=0)
+            del channel
+
+    @staticmethod
+    def _recv(channel, result):
+        # Wait for the next message, failing if the call returns (with
+        # an error) instead of sending one.
+        while not channel.poll(100):
+            if result.ready():
+                result.get()
+                raise ValueError('query_stream ended before sending results')
+        return channel.recv()
+
 #The following code is
 #Copyright (c) 2011, 2012, Regents of the University of California
 #and is under the same licence as the remainder of the code in this file.
@@ -279,9 +279,8 @@ class Dispatcher(object):
             return self.serialize(json_error(
                 None, PARSE_ERROR, 'invalid JSON', detail=str(exc)))
         if isinstance(message, list):
-            dispatch = self._dispatch_one
             with self.batch(message) as batch:
-                responses = (dispatch(msg, batch, context) for msg in message)
+                responses = self.dispatch_batch(message, batch, context)
                 response = [response for response in responses if response]
         elif isinstance(message, dict):
             response = self._dispatch_one(message, None, context)
@@ -296,6 +295,16 @@ class Dispatcher(object):
             except ValueError as exc:
                 self.exception(response, None, str(exc), context=context)
 
+    def dispatch_batch(self, messages, batch, context=None):
+        '''Dispatch the messages of a batch and return their responses.
+
+        Messages are dispatched one after another, in order. Subclasses
+        may override this to dispatch the messages concurrently, but
+        must return the responses in the same order as the messages.
+        '''
+        dispatch = self._dispatch_one
+        return [dispatch(msg, batch, context) for msg in messages]
+
     def _dispatch_one(self, msg, batch, context):
         '''Dispatch a single JSON-RPC message.'''
         try:
@@ -81,8 +81,10 @@ from . import config
 from . import vip
 from .vip.agent import Agent, Core
 from .vip.agent.compat import CompatPubSub
+from .vip.utils import encode_peer
 from .vip.router import *
 from .vip.socket import encode_key, Address
+from .vip.tracking import Tracker
 from .auth import AuthService
 from .control import ControlService
 from .agent import utils
@@ -247,9 +249,10 @@ class Router(BaseRouter):
 
     def __init__(self, local_address, addresses=(),
                  context=None, secretkey=None, default_user_id=None,
-                 monitor=False):
+                 monitor=False, tracker=None, queue_limit=0):
         super(Router, self).__init__(
-            context=context, default_user_id=default_user_id)
+            context=context, default_user_id=default_user_id,
+            queue_limit=queue_limit)
         self.local_address = Address(local_address)
         self.addresses = addresses = [Address(addr) for addr in addresses]
         self._secretkey = secretkey
@@ -257,6 +260,21 @@ class Router(BaseRouter):
         if self.logger.level == logging.NOTSET:
             self.logger.setLevel(logging.WARNING)
         self._monitor = monitor
+        self._tracker = tracker
+        # Only pay for instrumentation which is enabled. With neither
+        # tracing nor tracking, the no-op BaseRouter.issue() is used.
+        issuers = []
+        if self.logger.isEnabledFor(logging.DEBUG):
+            issuers.append(self.trace)
+        if tracker is not None:
+            issuers.append(tracker.hit)
+        if len(issuers) == 1:
+            self.issue = issuers[0]
+        elif issuers:
+            def issue(topic, frames, extra=None):
+                for issuer in issuers:
+                    issuer(topic, frames, extra)
+            self.issue = issue
 
     def setup(self):
         sock = self.socket
@@ -286,7 +304,7 @@ class Router(BaseRouter):
             address.bind(sock)
             _log.debug('Additional VIP router bound to %s' % address)
 
-    def issue(self, topic, frames, extra=None):
+    def trace(self, topic, frames, extra=None):
         log = self.logger.debug
         formatter = FramesFormatter(frames)
         if topic == ERROR:
@@ -314,6 +332,11 @@ class Router(BaseRouter):
                         value = [addr.base for addr in self.addresses]
                     else:
                         value = [self.local_address.base]
+                elif name == b'stats' and self._tracker is not None:
+                    value = self._tracker.stats
+                elif name == b'queues':
+                    value = {encode_peer(peer): stats for peer, stats
+                             in self.queue_stats.iteritems()}
                 else:
                     value = None
             frames[6:] = [b'', jsonapi.dumps(value)]
@@ -367,6 +390,13 @@ def main(argv=sys.argv):
     parser.add_argument(
         '--monitor', action='store_true',
         help='monitor and log connections (implies -v)')
+    parser.add_argument(
+        '--router-stats', action='store_true',
+        help='count routed messages and bytes by peer and subsystem')
+    parser.add_argument(
+        '--router-queue-limit', type=int, metavar='COUNT',
+        help='queue up to COUNT messages for each slow peer rather '
+             'than returning errors to senders')
     parser.add_argument(
         '-q', '--quiet', action='add_const', const=10, dest='verboseness',
         help='decrease logger verboseness; may be used multiple times')
@@ -464,6 +494,8 @@ def main(argv=sys.argv):
         log=None,
         log_config=None,
         monitor=False,
+        router_stats=False,
+        router_queue_limit=0,
         verboseness=logging.WARNING,
         volttron_home=volttron_home,
         autostart=True,
@@ -598,7 +630,9 @@ def main(argv=sys.argv):
         try:
             Router(opts.vip_local_address, opts.vip_address,
                    secretkey=secretkey, default_user_id=b'vip.service',
-                   monitor=opts.monitor).run()
+                   monitor=opts.monitor,
+                   tracker=Tracker() if opts.router_stats else None,
+                   queue_limit=opts.router_queue_limit).run()
         except Exception:
             _log.exception('Unhandled exception in router loop')
         finally:
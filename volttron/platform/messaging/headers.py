@@ -67,8 +67,15 @@ CONTENT_TYPE = type('ContentTypeStr', (str,),
                     {'JSON': 'application/json',
                      'PLAIN_TEXT': 'text/plain'})('Content-Type')
 
+CONTENT_ENCODING = type('ContentEncodingStr', (str,),
+                        {'ZLIB_BASE64': 'zlib+base64'})('Content-Encoding')
+
 DATE = 'Date'
 
+# Set on a device's "all" message when it carries only the points that
+# changed since they were last published.
+PARTIAL = 'Partial'
+
 FROM = 'From'
 TO = 'To'
 
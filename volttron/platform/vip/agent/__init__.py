@@ -65,18 +65,19 @@ from .subsystems import *
 
 class Agent(object):
     class Subsystems(object):
-        def __init__(self, owner, core):
+        def __init__(self, owner, core, rpc_timeout=None):
             self.peerlist = PeerList(core)
             self.ping = Ping(core)
-            self.rpc = RPC(core, owner)
+            self.rpc = RPC(core, owner, timeout=rpc_timeout)
             self.hello = Hello(core)
             self.pubsub = PubSub(core, self.rpc, self.peerlist, owner)
             self.channel = Channel(core)
 
-    def __init__(self, identity=None, address=None, context=None):
+    def __init__(self, identity=None, address=None, context=None,
+                 rpc_timeout=None):
         self.core = Core(
             self, identity=identity, address=address, context=context)
-        self.vip = Agent.Subsystems(self, self.core)
+        self.vip = Agent.Subsystems(self, self.core, rpc_timeout)
         self.core.setup()
 
 
@@ -63,7 +63,7 @@ from zmq import green as zmq
 from zmq.utils import jsonapi
 
 from . import Core, RPC, PeerList, PubSub
-from .subsystems.pubsub import encode_peer
+from ..utils import encode_peer
 from volttron.platform.messaging.headers import Headers
 
 
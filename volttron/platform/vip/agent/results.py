@@ -57,13 +57,14 @@
 
 from __future__ import absolute_import
 
+import math
 import random
 import weakref
 
 from gevent.event import AsyncResult
 
 
-__all__ = ['counter', 'ResultsDictionary']
+__all__ = ['counter', 'ResultsDictionary', 'ResultsTable']
 
 
 def counter(start=None, minimum=0, maximum=2**64-1):
@@ -85,3 +86,103 @@ class ResultsDictionary(weakref.WeakValueDictionary):
         result.ident = ident = '%s.%s' % (next(self._counter), hash(result))
         self[ident] = result
         return result
+
+
+class ResultsTable(object):
+    '''Correlate outstanding requests with integer idents.
+
+    Values are stored in a slab of slots which grows as needed; freed
+    slots are reused. An ident combines a slot index with a serial
+    number, so a late response for a reused slot is not mistaken for
+    the current occupant.
+
+    Entries added with a timeout and not popped within that many seconds
+    are removed by expire(), which should be called every resolution
+    seconds. Entries are grouped into buckets by the tick in which they
+    are due to expire, and a whole bucket is expired at once. Entries
+    added without a timeout are kept until they are popped.
+    '''
+
+    INDEX_BITS = 24
+
+    def __init__(self, resolution=1.0, size=256):
+        self.resolution = resolution
+        self._idents = [None] * size
+        self._values = [None] * size
+        self._buckets = [None] * size
+        self._free = range(size - 1, -1, -1)
+        self._serial = counter(maximum=2**(53 - self.INDEX_BITS))
+        self._wheel = {}
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._idents) - len(self._free)
+
+    def _grow(self):
+        size = len(self._idents)
+        if size >= 1 << self.INDEX_BITS:
+            raise MemoryError('too many outstanding results')
+        for slots in (self._idents, self._values, self._buckets):
+            slots.extend([None] * size)
+        self._free.extend(xrange(size * 2 - 1, size, -1))
+        return size
+
+    def add(self, value, timeout=None):
+        '''Store value and return the integer ident assigned to it.
+
+        If timeout is not None, the entry expires once at least timeout
+        seconds have passed.
+        '''
+        try:
+            index = self._free.pop()
+        except IndexError:
+            index = self._grow()
+        ident = (next(self._serial) << self.INDEX_BITS) | index
+        self._idents[index] = ident
+        self._values[index] = value
+        if timeout is not None:
+            # The current tick is partly over, so wait one more.
+            tick = self._tick + int(math.ceil(timeout / self.resolution)) + 1
+            try:
+                bucket = self._wheel[tick]
+            except KeyError:
+                bucket = self._wheel[tick] = set()
+            self._buckets[index] = bucket
+            bucket.add(index)
+        return ident
+
+    def pop(self, ident, default=None):
+        '''Remove and return the value for ident, or default.
+
+        ident may be an integer or a string of digits, as found in
+        message frames.
+        '''
+        try:
+            ident = int(ident)
+            index = ident & ((1 << self.INDEX_BITS) - 1)
+            if self._idents[index] != ident:
+                return default
+        except (TypeError, ValueError, IndexError):
+            return default
+        value = self._values[index]
+        bucket = self._buckets[index]
+        if bucket is not None:
+            bucket.discard(index)
+        self._release(index)
+        return value
+
+    def _release(self, index):
+        self._idents[index] = self._values[index] = None
+        self._buckets[index] = None
+        self._free.append(index)
+
+    def expire(self):
+        '''Advance one tick and return the values removed.'''
+        self._tick += 1
+        bucket = self._wheel.pop(self._tick, None)
+        if not bucket:
+            return []
+        values = [self._values[index] for index in bucket]
+        for index in bucket:
+            self._release(index)
+        return values
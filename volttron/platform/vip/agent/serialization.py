@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Message payload encodings for VIP subsystems.
+
+JSON is always available. MessagePack is available if the msgpack
+package is installed. Both encodings carry the same objects (JSON-RPC
+requests and responses, pubsub pushes), which are always a dictionary
+or a list. Their encoded forms can therefore be told apart by the first
+byte: JSON begins with an ASCII character while a MessagePack map or
+array begins with a byte of 0x80 or greater. Receivers use this to
+decode either encoding without an explicit content type. MessagePack
+is limited to what JSON can carry: strings decode as text and map keys
+are converted to strings, so receivers see the same objects whichever
+encoding the sender used.
+'''
+
+
+from __future__ import absolute_import
+
+import os
+
+from zmq.utils import jsonapi
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ['JSON', 'MSGPACK', 'ENCODINGS', 'default_encoding',
+           'encoding_of', 'dumps', 'loads']
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+def _json_key(key):
+    '''Return a map key converted to a string as JSON would.'''
+    if isinstance(key, basestring):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, (int, long)):
+        return str(key)
+    if isinstance(key, float):
+        return repr(key)
+    raise TypeError('key %r is not a string' % (key,))
+
+
+def _json_keys(obj):
+    '''Return obj with the keys of any nested dictionaries stringified.'''
+    if isinstance(obj, dict):
+        return {_json_key(key): _json_keys(value)
+                for key, value in obj.iteritems()}
+    if isinstance(obj, (list, tuple)):
+        return [_json_keys(value) for value in obj]
+    return obj
+
+
+_CODECS = {JSON: (jsonapi.dumps, jsonapi.loads)}
+if msgpack is not None:
+    # Strings are packed and unpacked as text and keys are converted to
+    # strings so that messages decode to the same objects as JSON.
+    _CODECS[MSGPACK] = (
+        lambda obj: msgpack.packb(_json_keys(obj), use_bin_type=False),
+        lambda data: msgpack.unpackb(data, raw=False))
+
+ENCODINGS = sorted(_CODECS)
+
+
+def default_encoding():
+    '''Return the preferred encoding from the environment.
+
+    VOLTTRON_MESSAGE_ENCODING may be set to the name of any supported
+    encoding. JSON is used if it is unset or names an unavailable
+    encoding.
+    '''
+    encoding = os.environ.get('VOLTTRON_MESSAGE_ENCODING', JSON)
+    return encoding if encoding in _CODECS else JSON
+
+
+def encoding_of(data):
+    '''Return the name of the encoding used for data.'''
+    return MSGPACK if data and ord(data[0]) >= 0x80 else JSON
+
+
+def dumps(obj, encoding=JSON):
+    '''Encode obj using the named encoding.'''
+    return _CODECS[encoding][0](obj)
+
+
+def loads(data):
+    '''Decode data in whichever supported encoding it uses.
+
+    Raises ValueError if data is invalid or its encoding is unavailable.
+    '''
+    encoding = encoding_of(data)
+    try:
+        decode = _CODECS[encoding][1]
+    except KeyError:
+        raise ValueError('unsupported encoding: %s' % (encoding,))
+    try:
+        return decode(data)
+    except ValueError:
+        raise
+    except Exception as exc:   # pylint: disable=broad-except
+        # Normalize MessagePack errors to those raised by JSON decoding.
+        raise ValueError(str(exc))
@@ -57,33 +57,107 @@
 
 from __future__ import absolute_import
 
-from base64 import b64encode, b64decode
+import errno
 import inspect
+import logging
 import random
 import weakref
 
 from zmq import green as zmq
 from zmq import SNDMORE
-from zmq.utils import jsonapi
 
 from .base import SubsystemBase
 from ..decorators import annotate, annotations, dualmethod, spawn
-from ..errors import Unreachable
-from .... import jsonrpc
+from ..errors import Again, Unreachable
+from ..serialization import dumps, loads
+from ...utils import decode_peer, encode_peer
 
 
 __all__ = ['PubSub']
 
 
-def encode_peer(peer):
-    if peer.startswith('\x00'):
-        return peer[:1] + b64encode(peer[1:])
-    return peer
+_log = logging.getLogger(__name__)
 
-def decode_peer(peer):
-    if peer.startswith('\x00'):
-        return peer[:1] + b64decode(peer[1:])
-    return peer
+
+def _batch_items(items):
+    '''Return a list of validated (topic, headers, message) items.
+
+    Raises ValueError for the first invalid item so a batch is never
+    partially published.
+    '''
+    result = []
+    for index, item in enumerate(items):
+        try:
+            topic, headers, message = item
+        except (TypeError, ValueError):
+            raise ValueError('batch item %d is not a (topic, headers, '
+                             'message) sequence' % (index,))
+        if not isinstance(topic, basestring):
+            raise ValueError('batch item %d has invalid topic %r' %
+                             (index, topic))
+        if headers is None:
+            headers = {}
+        elif not isinstance(headers, dict):
+            raise ValueError('batch item %d has invalid headers %r' %
+                             (index, headers))
+        result.append((topic, headers, message))
+    return result
+
+
+class PrefixTree(object):
+    '''Character trie mapping topic prefixes to subscriber sets.
+
+    Subscriber sets are stored by reference, so adding or discarding
+    peers from a set needs no update to the tree; only the addition and
+    removal of prefixes must be mirrored here. Finding the subscribers
+    of a topic costs O(len(topic)) rather than O(number of prefixes).
+    '''
+
+    __slots__ = ['_root']
+
+    def __init__(self):
+        # Nodes are [children, subscribers] lists to keep them small.
+        self._root = [{}, None]
+
+    def add(self, prefix, subscribers):
+        node = self._root
+        for char in prefix:
+            children = node[0]
+            try:
+                node = children[char]
+            except KeyError:
+                children[char] = node = [{}, None]
+        node[1] = subscribers
+
+    def remove(self, prefix):
+        node = self._root
+        path = []
+        for char in prefix:
+            path.append((node, char))
+            try:
+                node = node[0][char]
+            except KeyError:
+                return
+        node[1] = None
+        # Prune branches which no longer lead to a subscription.
+        while path and not node[0] and node[1] is None:
+            node, char = path.pop()
+            del node[0][char]
+
+    def match(self, topic):
+        '''Return the union of all subscribers with a prefix of topic.'''
+        node = self._root
+        subscribers = set()
+        if node[1]:
+            subscribers |= node[1]
+        for char in topic:
+            try:
+                node = node[0][char]
+            except KeyError:
+                break
+            if node[1]:
+                subscribers |= node[1]
+        return subscribers
 
 
 class PubSub(SubsystemBase):
@@ -92,7 +166,15 @@ class PubSub(SubsystemBase):
         self.rpc = weakref.ref(rpc_subsys)
         self.peerlist = weakref.ref(peerlist_subsys)
         self._peer_subscriptions = {}
+        self._peer_subscription_index = {}
         self._my_subscriptions = {}
+        # Number of unconfirmed publish_nowait() calls allowed per peer.
+        self.publish_window = 1000
+        # Seconds to wait for the previous confirmation once the window
+        # is used up before failing with Again.
+        self.publish_window_timeout = 30.0
+        self._publish_windows = {}
+        core.register('pubsub', self._handle_subsystem)
 
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
@@ -101,6 +183,9 @@ class PubSub(SubsystemBase):
             rpc_subsys.export(self._peer_unsubscribe, 'pubsub.unsubscribe')
             rpc_subsys.export(self._peer_list, 'pubsub.list')
             rpc_subsys.export(self._peer_publish, 'pubsub.publish')
+            rpc_subsys.export(self._peer_publish_batch,
+                              'pubsub.publish_batch')
+            # Retained for peers which still deliver pushes over RPC.
             rpc_subsys.export(self._peer_push, 'pubsub.push')
             core.onconnected.connect(self._connected)
             core.onviperror.connect(self._viperror)
@@ -117,9 +202,11 @@ class PubSub(SubsystemBase):
 
     def add_bus(self, name):
         self._peer_subscriptions.setdefault(name, {})
+        self._peer_subscription_index.setdefault(name, PrefixTree())
 
     def remove_bus(self, name):
         del self._peer_subscriptions[name]
+        del self._peer_subscription_index[name]
         # XXX: notify subscribers of removed bus
         #      or disallow removal of non-empty bus?
 
@@ -136,6 +223,7 @@ class PubSub(SubsystemBase):
         self.core().spawn_later(delay, self.synchronize, peer)
 
     def _peer_drop(self, sender, peer, **kwargs):
+        self._publish_windows.pop(peer, None)
         self._sync(peer, {})
 
     def _sync(self, peer, items):
@@ -156,6 +244,7 @@ class PubSub(SubsystemBase):
         for bus, prefix in remove:
             subscriptions = self._peer_subscriptions[bus]
             assert not subscriptions.pop(prefix)
+            self._peer_subscription_index[bus].remove(prefix)
         for bus, prefix in items:
             self._add_peer_subscription(peer, bus, prefix)
 
@@ -170,6 +259,7 @@ class PubSub(SubsystemBase):
             subscribers = subscriptions[prefix]
         except KeyError:
             subscriptions[prefix] = subscribers = set()
+            self._peer_subscription_index[bus].add(prefix, subscribers)
         subscribers.add(peer)
 
     def _peer_subscribe(self, prefix, bus=''):
@@ -180,6 +270,7 @@ class PubSub(SubsystemBase):
     def _peer_unsubscribe(self, prefix, bus=''):
         peer = bytes(self.rpc().context.vip_message.peer)
         subscriptions = self._peer_subscriptions[bus]
+        index = self._peer_subscription_index[bus]
         if prefix is None:
             remove = []
             for topic, subscribers in subscriptions.iteritems():
@@ -188,12 +279,14 @@ class PubSub(SubsystemBase):
                     remove.append(topic)
             for topic in remove:
                 del subscriptions[topic]
+                index.remove(topic)
         else:
             for prefix in prefix if isinstance(prefix, list) else [prefix]:
                 subscribers = subscriptions[prefix]
                 subscribers.discard(peer)
                 if not subscribers:
                     del subscriptions[prefix]
+                    index.remove(prefix)
 
     def _peer_list(self, prefix='', bus='', subscribed=True, reverse=False):
         peer = bytes(self.rpc().context.vip_message.peer)
@@ -218,28 +311,62 @@ class PubSub(SubsystemBase):
         peer = bytes(self.rpc().context.vip_message.peer)
         self._distribute(peer, topic, headers, message, bus)
 
+    def _peer_publish_batch(self, items, bus=''):
+        peer = bytes(self.rpc().context.vip_message.peer)
+        for topic, headers, message in _batch_items(items):
+            self._distribute(peer, topic, headers, message, bus)
+
     def _distribute(self, peer, topic, headers, message=None, bus=''):
-        subscriptions = self._peer_subscriptions[bus]
-        subscribers = set()
-        for prefix, subscription in subscriptions.iteritems():
-            if subscription and topic.startswith(prefix):
-                subscribers |= subscription
+        subscribers = self._peer_subscription_index[bus].match(topic)
         if subscribers:
-            sender = encode_peer(peer)
-            json_msg = jsonapi.dumps(jsonrpc.json_method(
-                None, 'pubsub.push',
-                [sender, bus, topic, headers, message], None))
-            frames = [zmq.Frame(b''), zmq.Frame(b''),
-                      zmq.Frame(b'RPC'), zmq.Frame(json_msg)]
+            # Encode once per encoding in use and share the frames with
+            # every subscriber using that encoding.
+            payload = [encode_peer(peer), bus, topic, headers, message]
+            encoded = {}
+            peer_encoding = self.rpc().peer_encoding
             socket = self.core().socket
             for subscriber in subscribers:
+                encoding = peer_encoding(subscriber)
+                try:
+                    frames = encoded[encoding]
+                except KeyError:
+                    encoded[encoding] = frames = [
+                        zmq.Frame(b''), zmq.Frame(b''), zmq.Frame(b'pubsub'),
+                        zmq.Frame(b'push'),
+                        zmq.Frame(dumps(payload, encoding))]
                 socket.send(subscriber, flags=SNDMORE)
                 socket.send_multipart(frames, copy=False)
         return len(subscribers)
 
+    @spawn
+    def _handle_subsystem(self, message):
+        '''Handle pushes delivered on the pubsub subsystem.
+
+        Pushes carry a single encoded list of [sender, bus, topic,
+        headers, message] and bypass the JSON-RPC dispatcher entirely.
+        '''
+        try:
+            op = bytes(message.args[0])
+        except IndexError:
+            return
+        if op != b'push':
+            _log.error('peer %r sent unknown pubsub operation %r',
+                       bytes(message.peer), op)
+            return
+        try:
+            sender, bus, topic, headers, msg = loads(bytes(message.args[1]))
+        except (IndexError, ValueError, TypeError):
+            _log.error('peer %r sent invalid pubsub push',
+                       bytes(message.peer))
+            return
+        self._push(bytes(message.peer), sender, bus, topic, headers, msg)
+
     def _peer_push(self, sender, bus, topic, headers, message):
-        '''Handle incoming subscription pushes from peers.'''
+        '''Handle incoming subscription pushes from peers over RPC.'''
         peer = bytes(self.rpc().context.vip_message.peer)
+        self._push(peer, sender, bus, topic, headers, message)
+
+    def _push(self, peer, sender, bus, topic, headers, message):
         handled = 0
         try:
             subscriptions = self._my_subscriptions[peer][bus]
@@ -379,3 +506,60 @@ class PubSub(SubsystemBase):
             return self.rpc().call(
                 peer, 'pubsub.publish', topic=topic, headers=headers,
                 message=message, bus=bus)
+
+    def publish_nowait(self, peer, topic, headers=None, message=None, bus=''):
+        '''Publish a message to a given topic via a peer without waiting.
+
+        Like publish(), but the request is sent as a notification, so
+        peer sends no response and errors are not reported. Nothing is
+        returned.
+
+        Flow control is set by the publish_window attribute. After
+        publish_window notifications to a peer, a confirmed publish is
+        sent instead. If the previous confirmation is still outstanding,
+        the caller blocks until it arrives, or raises Again if it does
+        not arrive within publish_window_timeout seconds. This keeps at
+        most about twice publish_window unconfirmed messages in flight.
+        Set publish_window to 0 to disable flow control.
+        '''
+        if headers is None:
+            headers = {}
+        if peer is None:
+            self._distribute(self.core().socket.identity,
+                             topic, headers, message, bus)
+            return
+        rpc = self.rpc()
+        if self.publish_window:
+            count, pending = self._publish_windows.get(peer, (0, None))
+            if count + 1 >= self.publish_window:
+                if pending is not None:
+                    pending.wait(self.publish_window_timeout)
+                    if not pending.ready():
+                        raise Again(errno.EAGAIN,
+                                    'publish confirmation not received',
+                                    peer, 'pubsub')
+                pending = rpc.call(
+                    peer, 'pubsub.publish', topic=topic, headers=headers,
+                    message=message, bus=bus)
+                self._publish_windows[peer] = 0, pending
+                return
+            self._publish_windows[peer] = count + 1, pending
+        rpc.notify(peer, 'pubsub.publish', topic=topic, headers=headers,
+                   message=message, bus=bus)
+
+    def publish_batch(self, peer, items, bus=''):
+        '''Publish several messages via a peer in a single request.
+
+        items is a sequence of (topic, headers, message) tuples which
+        are published, in order, to subscribers on bus at peer. If peer
+        is None, use self. ValueError is raised, and nothing is
+        published, if any item is invalid.
+        '''
+        items = _batch_items(items)
+        if peer is None:
+            identity = self.core().socket.identity
+            for topic, headers, message in items:
+                self._distribute(identity, topic, headers, message, bus)
+        else:
+            return self.rpc().call(
+                peer, 'pubsub.publish_batch', items=items, bus=bus)
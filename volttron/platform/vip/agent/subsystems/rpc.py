@@ -57,6 +57,7 @@
 
 from __future__ import absolute_import
 
+import errno
 import inspect
 import logging
 import os
@@ -64,18 +65,20 @@ import sys
 import traceback
 import weakref
 
+import gevent
 import gevent.local
 from gevent.event import AsyncResult
-from zmq.utils import jsonapi
 
 from .base import SubsystemBase
-from ..errors import VIPError
-from ..results import counter, ResultsDictionary
+from ..errors import VIPError, Unreachable
+from ..results import ResultsTable
 from ..decorators import annotate, annotations, dualmethod, spawn
+from ..serialization import (JSON, ENCODINGS, default_encoding,
+                             encoding_of, dumps, loads)
 from .... import jsonrpc
 
 
-__all__ = ['RPC']
+__all__ = ['RPC', 'Pipeline']
 
 
 _ROOT_PACKAGE_PATH = os.path.dirname(
@@ -83,62 +86,91 @@ _ROOT_PACKAGE_PATH = os.path.dirname(
 
 _log = logging.getLogger(__name__)
 
+# Notification which, as the first request of a batch, asks the peer to
+# execute the batch in order. Older peers ignore it.
+_SEQUENTIAL = 'rpc.sequential'
+
 
 class Dispatcher(jsonrpc.Dispatcher):
-    def __init__(self, methods, local):
+    def __init__(self, methods, local, results):
         super(Dispatcher, self).__init__()
         self.methods = methods
         self.local = local
-        self._results = ResultsDictionary()
+        self._results = results
 
     def serialize(self, json_obj):
-        return jsonapi.dumps(json_obj)
+        # Respond using the encoding of the request being dispatched.
+        return dumps(json_obj, getattr(self.local, 'encoding', JSON))
 
     def deserialize(self, json_string):
-        return jsonapi.loads(json_string)
+        encoding = encoding_of(json_string)
+        self.local.encoding = encoding if encoding in ENCODINGS else JSON
+        return loads(json_string)
+
+    def dispatch_batch(self, messages, batch, context=None):
+        # Execute the methods of a batch concurrently so a slow method
+        # does not delay the others, unless the batch asks to be executed
+        # in order. Responses keep the request order.
+        requests = [msg for msg in messages
+                    if isinstance(msg, dict) and 'method' in msg]
+        if len(requests) < 2 or requests[0]['method'] == _SEQUENTIAL:
+            return super(Dispatcher, self).dispatch_batch(
+                messages, batch, context)
+        dispatch = self._dispatch_one
+        greenlets = [gevent.spawn(dispatch, msg, batch, context)
+                     for msg in messages]
+        try:
+            gevent.joinall(greenlets)
+        finally:
+            gevent.killall(greenlets, block=False)
+        return [greenlet.value for greenlet in greenlets]
 
-    def batch_call(self, requests):
+    def batch_call(self, requests, encoding=JSON, timeout=None):
+        # pylint: disable=arguments-differ
         methods = []
+        idents = []
         results = []
         for notify, method, args, kwargs in requests:
             if notify:
                 ident = None
             else:
-                result = next(self._results)
-                ident = result.ident
+                result = AsyncResult()
+                ident = self._results.add(result, timeout)
+                idents.append(ident)
                 results.append(result)
-            methods.append((ident, method, args, kwargs))
-        return super(Dispatcher, self).batch_call(methods), results
+            methods.append(jsonrpc.json_method(ident, method, args, kwargs))
+        return dumps(methods, encoding), idents, results
+
+    def call(self, method, args=None, kwargs=None, encoding=JSON,
+             timeout=None):
+        # pylint: disable=arguments-differ
+        result = AsyncResult()
+        ident = self._results.add(result, timeout)
+        return dumps(jsonrpc.json_method(
+            ident, method, args or (), kwargs or {}), encoding), ident, result
 
-    def call(self, method, args=None, kwargs=None):
+    def notify(self, method, args=None, kwargs=None, encoding=JSON):
         # pylint: disable=arguments-differ
-        result = next(self._results)
-        return super(Dispatcher, self).call(
-            result.ident, method, args, kwargs), result
+        return dumps(jsonrpc.json_method(
+            None, method, args or (), kwargs or {}), encoding)
 
     def result(self, response, ident, value, context=None):
-        try:
-            result = self._results.pop(ident)
-        except KeyError:
-            return
-        result.set(value)
+        result = self._results.pop(ident)
+        if isinstance(result, AsyncResult):
+            result.set(value)
 
     def error(self, response, ident, code, message, data=None, context=None):
-        try:
-            result = self._results.pop(ident)
-        except KeyError:
-            return
-        result.set_exception(jsonrpc.exception_from_json(code, message, data))
+        result = self._results.pop(ident)
+        if isinstance(result, AsyncResult):
+            result.set_exception(jsonrpc.exception_from_json(code, message, data))
 
     def exception(self, response, ident, message, context=None):
         # XXX: Should probably wrap exception in RPC specific error
         #      rather than re-raising.
         exc_type, exc, exc_tb = sys.exc_info()   # pylint: disable=unused-variable
-        try:
-            result = self._results.pop(ident)
-        except KeyError:
-            return
-        result.set_exception(exc)
+        result = self._results.pop(ident)
+        if isinstance(result, AsyncResult):
+            result.set_exception(exc)
 
     def method(self, request, ident, name, args, kwargs,
                batch=None, context=None):
@@ -152,6 +184,10 @@ class Dispatcher(jsonrpc.Dispatcher):
         except KeyError:
             if name == 'inspect':
                 return {'methods': self.methods.keys()}
+            elif name == 'rpc.encodings':
+                return ENCODINGS
+            elif name == _SEQUENTIAL:
+                return None
             elif name.endswith('.inspect'):
                 try:
                     method = self.methods[name[:-8]]
@@ -205,13 +241,27 @@ class Dispatcher(jsonrpc.Dispatcher):
 
 
 class RPC(SubsystemBase):
-    def __init__(self, core, owner):
+    '''Remote procedure calls over VIP.
+
+    Calls wait for a response indefinitely unless they have a timeout,
+    set for every call by the timeout attribute or for a single call by
+    call_with_timeout(). Calls which receive no response within their
+    timeout, in seconds, fail with a VIPError (ETIMEDOUT).
+    '''
+
+    def __init__(self, core, owner, timeout=None):
         self.core = weakref.ref(core)
         self.context = None
+        self.encoding = default_encoding()
         self._exports = {}
         self._dispatcher = None
-        self._counter = counter()
-        self._outstanding = weakref.WeakValueDictionary()
+        # Pending results, keyed by the JSON-RPC id of single calls and
+        # by the VIP message id of batches.
+        self.timeout = timeout
+        self._results = ResultsTable()
+        self.unanswered = 0
+        self._peer_encodings = {}
+        self._negotiations = {}
         core.register('RPC', self._handle_subsystem, self._handle_error)
 
         def export(member):   # pylint: disable=redefined-outer-name
@@ -222,9 +272,15 @@ class RPC(SubsystemBase):
         def setup(sender, **kwargs):
             # pylint: disable=unused-argument
             self.context = gevent.local.local()
-            self._dispatcher = Dispatcher(self._exports, self.context)
+            self._dispatcher = Dispatcher(
+                self._exports, self.context, self._results)
         core.onsetup.connect(setup, self)
 
+        def start(sender, **kwargs):
+            # pylint: disable=unused-argument
+            core.periodic(self._results.resolution, self._expire)
+        core.onstart.connect(start, self)
+
     @spawn
     def _handle_subsystem(self, message):
         dispatch = self._dispatcher.dispatch
@@ -236,12 +292,32 @@ class RPC(SubsystemBase):
             self.core().socket.send_vip_object(message, copy=False)
 
     def _handle_error(self, sender, message, error, **kwargs):
-        result = self._outstanding.pop(bytes(message.id), None)
+        if isinstance(error, Unreachable):
+            # The peer may return running different code.
+            self._peer_encodings.pop(bytes(error.peer), None)
+        result = self._results.pop(bytes(message.id))
         if isinstance(result, AsyncResult):
             result.set_exception(error)
         elif result:
-            for result in result:
+            for ident in result:
+                member = self._results.pop(ident)
+                if member is not None:
+                    member.set_exception(error)
+
+    def _expire(self):
+        error = None
+        count = 0
+        for result in self._results.expire():
+            # Batch entries hold member idents, which expire on their own.
+            if isinstance(result, AsyncResult):
+                if error is None:
+                    error = VIPError(errno.ETIMEDOUT, 'no response received',
+                                     None, 'RPC')
                 result.set_exception(error)
+                count += 1
+        if count:
+            self.unanswered += count
+            _log.warning('%d RPC calls expired without a response', count)
 
     @dualmethod
     def export(self, method, name=None):
@@ -259,29 +335,150 @@ class RPC(SubsystemBase):
             return method
         return decorate
 
+    def peer_encoding(self, peer):
+        '''Return the encoding to use for messages sent to peer.
+
+        JSON is used until the peer confirms that it supports the
+        preferred encoding, which is set from the encoding attribute.
+        Peers which predate encoding negotiation only receive JSON.
+        '''
+        try:
+            return self._peer_encodings[peer]
+        except KeyError:
+            pass
+        self._peer_encodings[peer] = JSON
+        if self.encoding != JSON:
+            def negotiated(result):
+                self._negotiations.pop(peer, None)
+                if result.successful() and self.encoding in result.value:
+                    self._peer_encodings[peer] = self.encoding
+            result = self._negotiations[peer] = self.call(
+                peer, 'rpc.encodings')
+            result.rawlink(negotiated)
+        return JSON
+
     def batch(self, peer, requests):
-        request, results = self._dispatcher.batch_call(requests)
-        if results:
-            items = weakref.WeakSet(results)
-            ident = '%s.%s' % (next(self._counter), id(items))
+        request, idents, results = self._dispatcher.batch_call(
+            requests, self.peer_encoding(peer), self.timeout)
+        self._send_batch(peer, request, idents, results)
+        return results or None
+
+    def pipeline(self, peer, max_size=100, max_delay=0.01, sequential=False):
+        '''Return a Pipeline for sending batched requests to peer.'''
+        return Pipeline(self, peer, max_size, max_delay, sequential)
+
+    def _send_batch(self, peer, request, idents, results):
+        '''Send a batch request, keyed by an entry holding its idents.
+
+        The entry lets an error for the whole message fail its members,
+        and is removed once every member has resolved.
+        '''
+        ident = b''
+        if idents:
+            ident = self._results.add(idents)
+            remaining = [len(results)]
+            def resolved(result):   # pylint: disable=unused-argument
+                remaining[0] -= 1
+                if not remaining[0]:
+                    self._results.pop(ident)
             for result in results:
-                result._weak_set = items   # pylint: disable=protected-access
-            self._outstanding[ident] = items
-        else:
-            ident = b''
+                result.rawlink(resolved)
+            ident = bytes(ident)
         if request:
             self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
-        return results or None
 
     def call(self, peer, method, *args, **kwargs):
-        request, result = self._dispatcher.call(method, args, kwargs)
-        ident = '%s.%s' % (next(self._counter), hash(result))
-        self._outstanding[ident] = result
-        self.core().socket.send_vip(peer, 'RPC', [request], msg_id=ident)
-        return result
+        return self._call(self.timeout, peer, method, args, kwargs)
 
     __call__ = call
 
+    def call_with_timeout(self, timeout, peer, method, *args, **kwargs):
+        '''Like call(), but with its own timeout in seconds.
+
+        A timeout of None waits for the response indefinitely.
+        '''
+        return self._call(timeout, peer, method, args, kwargs)
+
+    def _call(self, timeout, peer, method, args, kwargs):
+        request, ident, result = self._dispatcher.call(
+            method, args, kwargs, self.peer_encoding(peer), timeout)
+        self.core().socket.send_vip(peer, 'RPC', [request],
+                                    msg_id=bytes(ident))
+        return result
+
     def notify(self, peer, method, *args, **kwargs):
-        request = self._dispatcher.notify(method, args, kwargs)
+        request = self._dispatcher.notify(
+            method, args, kwargs, self.peer_encoding(peer))
         self.core().socket.send_vip(peer, 'RPC', [request])
+
+
+class Pipeline(object):
+    '''Queue RPC requests to a single peer and send them in batches.
+
+    Requests are held until flush() is called, the pipeline is used as
+    a context manager and exited, max_size requests are queued, or
+    max_delay seconds have passed since the first request was queued.
+    The queued requests are then sent to the peer as one JSON-RPC
+    batch. Set max_delay to None to disable the timer.
+
+    Peers execute the methods of a batch concurrently. If sequential
+    is True, peers instead execute them one after another in the order
+    they were queued, which suits requests that depend on the effects
+    of one another. Ordering only holds within a batch, so size such a
+    pipeline to hold all of the requests that must stay in order.
+    '''
+
+    def __init__(self, rpc, peer, max_size=100, max_delay=0.01,
+                 sequential=False):
+        self._rpc = weakref.ref(rpc)
+        self.peer = peer
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.sequential = sequential
+        self._requests = []
+        self._idents = []
+        self._results = []
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, exc_tb):
+        self.flush()
+
+    def call(self, method, *args, **kwargs):
+        '''Queue a method call and return an AsyncResult for it.'''
+        result = AsyncResult()
+        rpc = self._rpc()
+        ident = rpc._results.add(result, rpc.timeout)   # pylint: disable=protected-access
+        self._idents.append(ident)
+        self._results.append(result)
+        self._queue(ident, method, args, kwargs)
+        return result
+
+    def notify(self, method, *args, **kwargs):
+        '''Queue a method call for which no result is expected.'''
+        self._queue(None, method, args, kwargs)
+
+    def _queue(self, ident, method, args, kwargs):
+        self._requests.append(jsonrpc.json_method(ident, method, args, kwargs))
+        if len(self._requests) >= self.max_size:
+            self.flush()
+        elif self._timer is None and self.max_delay is not None:
+            self._timer = gevent.spawn_later(self.max_delay, self.flush)
+
+    def flush(self):
+        '''Send all queued requests to the peer as a single batch.'''
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        requests, self._requests = self._requests, []
+        idents, self._idents = self._idents, []
+        results, self._results = self._results, []
+        if not requests:
+            return
+        if self.sequential:
+            requests.insert(0, jsonrpc.json_method(None, _SEQUENTIAL, (), {}))
+        rpc = self._rpc()
+        request = dumps(requests, rpc.peer_encoding(self.peer))
+        rpc._send_batch(self.peer, request, idents, results)   # pylint: disable=protected-access
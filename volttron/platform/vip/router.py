@@ -58,10 +58,12 @@
 
 from __future__ import absolute_import
 
+from collections import deque
 import os
 
 import zmq
-from zmq import Frame, NOBLOCK, ZMQError, EINVAL, EHOSTUNREACH
+from zmq import Frame, NOBLOCK, ZMQError, EAGAIN, EINVAL, EHOSTUNREACH
+from zmq.error import Again
 
 
 __all__ = ['BaseRouter', 'OUTGOING', 'INCOMING', 'UNROUTABLE', 'ERROR']
@@ -98,12 +100,23 @@ class BaseRouter(object):
     called to allow for debugging and logging. Custom subsystems may be
     implemented in the handle_subsystem() method. The socket will be
     closed when the stop() method is called.
+
+    If queue_limit is greater than zero, messages which cannot be sent
+    immediately because the recipient is not keeping up are held in a
+    per-peer queue of up to queue_limit messages and retried, rather
+    than being bounced back to the sender with an EAGAIN error. Once a
+    peer's queue is full, further messages to that peer are bounced.
     '''
 
     _context_class = zmq.Context
     _socket_class = zmq.Socket
 
-    def __init__(self, context=None, default_user_id=None):
+    # Maximum number of messages routed between checks of the send
+    # queues and milliseconds to wait before retrying queued sends.
+    batch_size = 1000
+    retry_interval = 10
+
+    def __init__(self, context=None, default_user_id=None, queue_limit=0):
         '''Initialize the object instance.
 
         If context is None (the default), the zmq global context will be
@@ -111,15 +124,25 @@ class BaseRouter(object):
         '''
         self.context = context or self._context_class.instance()
         self.default_user_id = default_user_id
+        self.queue_limit = queue_limit
         self.socket = None
         self._peers = set()
+        self._queues = {}
+        self._queue_stats = {}
 
     def run(self):
-        '''Main router loop.'''
+        '''Main router loop.
+
+        Incoming messages are drained in batches of up to batch_size
+        after each poll. Queued sends are retried between batches.
+        '''
         self.start()
         try:
-            while self.poll():
-                self.route()
+            while True:
+                if self.poll(self.retry_interval if self._queues else None):
+                    self.drain(self.batch_size)
+                if self._queues:
+                    self._flush_queues()
         finally:
             self.stop()
 
@@ -155,6 +178,17 @@ class BaseRouter(object):
         '''Returns the underlying socket's poll method.'''
         return self.socket.poll
 
+    @property
+    def queue_stats(self):
+        '''Return send queue statistics by peer.
+
+        Each value is a dictionary with the current queue length, the
+        high-water mark reached, and the number of messages bounced
+        because the queue was full.
+        '''
+        return {peer: dict(stats, queued=len(self._queues.get(peer, ())))
+                for peer, stats in self._queue_stats.iteritems()}
+
     def handle_subsystem(self, frames, user_id):
         '''Handle additional subsystems and provide a response.
 
@@ -223,26 +257,42 @@ class BaseRouter(object):
         self._peers.add(peer)
 
     def _drop_peer(self, peer):
+        self._queues.pop(peer, None)
+        self._queue_stats.pop(peer, None)
         try:
             self._peers.remove(peer)
         except KeyError:
             return
         self._distribute(b'peerlist', b'drop', peer)
 
-    def route(self):
+    def drain(self, limit):
+        '''Route up to limit messages without blocking.
+
+        Returns the number of messages routed.
+        '''
+        route = self.route
+        for count in xrange(limit):
+            try:
+                route(NOBLOCK)
+            except Again:
+                return count
+        return limit
+
+    def route(self, flags=0):
         '''Route one message and return.
 
         One message is read from the socket and processed. If the
         recipient is the router (empty recipient), the standard hello
         and ping subsystems are handled. Other subsystems are sent to
         handle_subsystem() for processing. Messages destined for other
-        entities are routed appropriately.
+        entities are routed appropriately. If flags includes NOBLOCK
+        and no message is waiting, zmq.error.Again is raised.
         '''
         socket = self.socket
         issue = self.issue
         # Expecting incoming frames:
         #   [SENDER, RECIPIENT, PROTO, USER_ID, MSG_ID, SUBSYS, ...]
-        frames = socket.recv_multipart(copy=False)
+        frames = socket.recv_multipart(flags=flags, copy=False)
         issue(INCOMING, frames)
         if len(frames) < 6:
             # Cannot route if there are insufficient frames, such as
@@ -313,13 +363,22 @@ class BaseRouter(object):
         recipient, sender = frames[:2]
         # Expecting outgoing frames:
         #   [RECIPIENT, SENDER, PROTO, USER_ID, MSG_ID, SUBSYS, ...]
+        queue = self._queues.get(bytes(recipient)) if self._queues else None
         try:
+            if queue is not None:
+                # Keep ordering behind messages already waiting for peer
+                self._enqueue(queue, frames)
+                return drop
             # Try sending the message to its recipient
             socket.send_multipart(frames, flags=NOBLOCK, copy=False)
             issue(OUTGOING, frames)
         except ZMQError as exc:
+            if exc.errno == EAGAIN and queue is None and self.queue_limit:
+                queue = self._queues[bytes(recipient)] = deque()
+                self._enqueue(queue, frames)
+                return drop
             try:
-                errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
+                error = _ROUTE_ERRORS[exc.errno]
             except KeyError:
                 error = None
             if error is None:
@@ -329,20 +388,79 @@ class BaseRouter(object):
                 drop.append(bytes(recipient))
             if exc.errno != EHOSTUNREACH or sender is not frames[0]:
                 # Only send errors if the sender and recipient differ
-                proto, user_id, msg_id, subsystem = frames[2:6]
-                frames = [sender, b'', proto, user_id, msg_id,
-                          b'error', errnum, errmsg, recipient, subsystem]
+                drop.extend(self._send_error(frames, error))
+        return drop
+
+    def _send_error(self, frames, error):
+        '''Return error to the sender of the outgoing frames.
+
+        Returns a list of peers found to be unreachable.
+        '''
+        issue = self.issue
+        drop = []
+        recipient, sender, proto, user_id, msg_id, subsystem = frames[:6]
+        if not bytes(sender):
+            # Sent by the router itself
+            return drop
+        errnum, errmsg = error
+        frames = [sender, b'', proto, user_id, msg_id,
+                  b'error', errnum, errmsg, recipient, subsystem]
+        try:
+            self.socket.send_multipart(frames, flags=NOBLOCK, copy=False)
+            issue(OUTGOING, frames)
+        except ZMQError as exc:
+            try:
+                error = _ROUTE_ERRORS[exc.errno]
+            except KeyError:
+                error = None
+            if error is None:
+                raise
+            issue(ERROR, frames, error)
+            if exc.errno == EHOSTUNREACH:
+                drop.append(bytes(sender))
+        return drop
+
+    def _enqueue(self, queue, frames):
+        peer = bytes(frames[0])
+        try:
+            stats = self._queue_stats[peer]
+        except KeyError:
+            self._queue_stats[peer] = stats = {'high_water': 0, 'dropped': 0}
+        if len(queue) >= self.queue_limit:
+            stats['dropped'] += 1
+            raise Again()
+        # Copy the list, which callers may reuse, but not the frames.
+        queue.append(list(frames))
+        if len(queue) > stats['high_water']:
+            stats['high_water'] = len(queue)
+
+    def _flush_queues(self):
+        '''Retry sending queued messages in order.'''
+        issue = self.issue
+        socket = self.socket
+        drop = []
+        for peer, queue in self._queues.items():
+            while queue:
+                frames = queue[0]
                 try:
                     socket.send_multipart(frames, flags=NOBLOCK, copy=False)
-                    issue(OUTGOING, frames)
                 except ZMQError as exc:
-                    try:
-                        errnum, errmsg = error = _ROUTE_ERRORS[exc.errno]
-                    except KeyError:
-                        error = None
-                    if error is None:
+                    if exc.errno == EAGAIN:
+                        break
+                    if exc.errno != EHOSTUNREACH:
                         raise
-                    issue(ERROR, frames, error)
-                    if exc.errno == EHOSTUNREACH:
-                        drop.append(bytes(sender))
-        return drop
+                    # Peer disconnected; bounce what was waiting for it.
+                    error = _ROUTE_ERRORS[exc.errno]
+                    for frames in queue:
+                        issue(ERROR, frames, error)
+                        if frames[1] is not frames[0]:
+                            drop.extend(self._send_error(frames, error))
+                    queue.clear()
+                    drop.append(peer)
+                else:
+                    queue.popleft()
+                    issue(OUTGOING, frames)
+            if not queue:
+                del self._queues[peer]
+        for peer in drop:
+            self._drop_peer(peer)
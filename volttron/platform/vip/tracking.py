@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*- {{{
+# vim: set fenc=utf-8 ft=python sw=4 ts=4 sts=4 et:
+
+# Copyright (c) 2015, Battelle Memorial Institute
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation
+# are those of the authors and should not be interpreted as representing
+# official policies, either expressed or implied, of the FreeBSD
+# Project.
+#
+# This material was prepared as an account of work sponsored by an
+# agency of the United States Government.  Neither the United States
+# Government nor the United States Department of Energy, nor Battelle,
+# nor any of their employees, nor any jurisdiction or organization that
+# has cooperated in the development of these materials, makes any
+# warranty, express or implied, or assumes any legal liability or
+# responsibility for the accuracy, completeness, or usefulness or any
+# information, apparatus, product, software, or process disclosed, or
+# represents that its use would not infringe privately owned rights.
+#
+# Reference herein to any specific commercial product, process, or
+# service by trade name, trademark, manufacturer, or otherwise does not
+# necessarily constitute or imply its endorsement, recommendation, or
+# favoring by the United States Government or any agency thereof, or
+# Battelle Memorial Institute. The views and opinions of authors
+# expressed herein do not necessarily state or reflect those of the
+# United States Government or any agency thereof.
+#
+# PACIFIC NORTHWEST NATIONAL LABORATORY
+# operated by BATTELLE for the UNITED STATES DEPARTMENT OF ENERGY
+# under Contract DE-AC05-76RL01830
+#}}}
+
+'''Message accounting for VIP routers.
+
+A Tracker may be passed to a router to count messages and bytes by peer
+and subsystem and to build a histogram of the time taken to route each
+message. Nothing is formatted or logged; counters are only updated, so
+tracking is cheap enough to leave enabled on a busy platform.
+'''
+
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+import time
+
+import monotonic as clock
+
+from .router import OUTGOING, INCOMING, UNROUTABLE, ERROR
+from .utils import encode_peer
+
+
+__all__ = ['Tracker']
+
+
+def _counter():
+    return {'messages': 0, 'bytes': 0}
+
+
+class Tracker(object):
+    '''Count routed messages and measure routing latency.
+
+    The hit() method has the same signature as BaseRouter.issue() and
+    may be used in its place. Latency is measured from the receipt of a
+    message to the first send which results from it and is recorded in
+    power-of-two microsecond buckets.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''Clear all counters.'''
+        self._started = time.time()
+        self._incoming = None
+        self._peers = {INCOMING: defaultdict(_counter),
+                       OUTGOING: defaultdict(_counter)}
+        self._subsystems = {INCOMING: defaultdict(_counter),
+                            OUTGOING: defaultdict(_counter)}
+        self._errors = defaultdict(int)
+        self._unroutable = defaultdict(int)
+        self._latency = defaultdict(int)
+
+    def hit(self, topic, frames, extra=None):
+        if topic == INCOMING:
+            self._incoming = clock.monotonic()
+        elif topic == UNROUTABLE:
+            self._unroutable[extra] += 1
+            return
+        elif topic == ERROR:
+            self._errors[bytes(extra[0])] += 1
+            return
+        if topic == OUTGOING and self._incoming is not None:
+            elapsed = int((clock.monotonic() - self._incoming) * 1000000)
+            self._latency[1 << elapsed.bit_length()] += 1
+            self._incoming = None
+        size = sum(len(frame) for frame in frames)
+        counter = self._peers[topic][bytes(frames[0])]
+        counter['messages'] += 1
+        counter['bytes'] += size
+        if len(frames) > 5:
+            counter = self._subsystems[topic][bytes(frames[5])]
+            counter['messages'] += 1
+            counter['bytes'] += size
+
+    @property
+    def stats(self):
+        '''Return a JSON serializable snapshot of the counters.'''
+        def directions(counters, encode=lambda name: name):
+            return {direction: {encode(name): dict(counter)
+                                for name, counter in
+                                counters[topic].iteritems()}
+                    for direction, topic in [('incoming', INCOMING),
+                                             ('outgoing', OUTGOING)]}
+        return {
+            'start': self._started,
+            'end': time.time(),
+            'peers': directions(self._peers, encode_peer),
+            'subsystems': directions(self._subsystems),
+            'errors': dict(self._errors),
+            'unroutable': dict(self._unroutable),
+            # JSON object keys must be strings.
+            'latency_us': {str(bucket): count for bucket, count
+                           in self._latency.iteritems()},
+        }
@@ -0,0 +1,208 @@
+from collections import defaultdict
+import datetime
+import os
+from Queue import Queue
+import shutil
+import tempfile
+from threading import local
+import unittest
+
+from volttron.platform.agent.base_historian import BaseHistorianAgent
+from volttron.platform.messaging import headers as headers_mod
+
+
+class Historian(BaseHistorianAgent):
+
+    def __init__(self, columnar_backup=True, submit_size_limit=1000):
+        # Skip the agent core and the processing thread.
+        self._columnar_backup = columnar_backup
+        self._submit_size_limit = submit_size_limit
+        self._publish_local = local()
+        self._publish_pool = None
+        self._backup_cache = {}
+        self._meta_data = defaultdict(dict)
+        self._point_lists = {}
+        self._point_list_ids = {}
+        self._event_queue = Queue()
+        self._queue_high_water = 10000
+        self._queue_low_water = 5000
+        self._queue_overflow = 'drop'
+        self._queue_throttled = False
+        self._backup_batch_size = 1000
+        self._backup_batch_period = 1.0
+        self._retry_period = 300.0
+        self._ingest_stats = defaultdict(int)
+        self.published = []
+        self.handle = lambda records: self.report_all_handled()
+        self._setup_backup_db()
+
+    def publish_to_historian(self, to_publish_list):
+        records = list(to_publish_list)
+        self.published.append(records)
+        self.handle(records)
+
+
+START = datetime.datetime(2015, 6, 1, 12, 0, 0, 500)
+
+
+class ColumnarBackupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def capture(self, historian, device, values, seconds=0, meta=None):
+        timestamp = START + datetime.timedelta(seconds=seconds)
+        headers = {headers_mod.DATE: timestamp.isoformat() + 'Z'}
+        historian.capture_device_data(
+            None, 'platform.driver', '', 'devices/' + device + '/all',
+            headers, [values, meta or {}])
+        historian._backup_new_to_publish(historian._get_batch(False))
+
+    def count(self, historian, table):
+        return historian._connection.execute(
+            'SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+    def test_scrape_stored_as_one_row(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(self.count(historian, 'outstanding_scrapes'), 1)
+        self.assertEqual(self.count(historian, 'outstanding'), 0)
+
+    def test_scrape_expands_to_point_records(self):
+        historian = Historian()
+        meta = {'a': {'units': 'F'}, 'b': {'units': 'kW'}}
+        self.capture(historian, 'campus/device', {'b': 2.5, 'a': 1}, meta=meta)
+        records = list(historian._get_outstanding_to_publish())
+        scrape_id = records[0]['_id'][0]
+        self.assertEqual([r['_id'] for r in records],
+                         [(scrape_id, 0), (scrape_id, 1)])
+        self.assertEqual([r['topic'] for r in records],
+                         ['campus/device/a', 'campus/device/b'])
+        self.assertEqual([r['value'] for r in records], [1, 2.5])
+        self.assertEqual([r['meta'] for r in records],
+                         [{'units': 'F'}, {'units': 'kW'}])
+        for record in records:
+            self.assertEqual(record['source'], 'scrape')
+            self.assertEqual(record['timestamp'].replace(tzinfo=None), START)
+            self.assertIsNotNone(record['timestamp'].tzinfo)
+
+    def test_point_list_reused(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2})
+        self.capture(historian, 'campus/device', {'a': 3, 'b': 4}, 1)
+        self.capture(historian, 'campus/device', {'a': 5}, 2)
+        self.assertEqual(self.count(historian, 'point_lists'), 2)
+        records = list(historian._get_outstanding_to_publish())
+        self.assertEqual([r['value'] for r in records], [1, 2, 3, 4, 5])
+
+    def test_batches_do_not_split_scrapes(self):
+        historian = Historian(submit_size_limit=4)
+        for second in range(3):
+            self.capture(historian, 'campus/device',
+                         {'a': second, 'b': second, 'c': second}, second)
+        batches = historian._get_outstanding_batches(3)
+        self.assertEqual([len(batch) for batch in batches], [6, 3])
+        self.assertEqual([len(list(batch)) for batch in batches], [6, 3])
+
+    def test_batches_stop_at_count(self):
+        historian = Historian(submit_size_limit=4)
+        for second in range(10):
+            self.capture(historian, 'campus/device',
+                         {'a': second, 'b': second}, second)
+        historian._columnar_backup = False
+        self.capture(historian, 'campus/device', {'a': 10}, 1.5)
+        batches = historian._get_outstanding_batches(2)
+        self.assertEqual([len(batch) for batch in batches], [4, 5])
+        self.assertEqual([r['value'] for r in batches[1]], [10, 2, 2, 3, 3])
+
+    def test_mixed_rows_ordered_by_time(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1}, 0)
+        self.capture(historian, 'campus/device', {'a': 3}, 2)
+        historian._columnar_backup = False
+        self.capture(historian, 'campus/device', {'a': 2}, 1)
+        self.assertEqual(self.count(historian, 'outstanding'), 1)
+        records = list(historian._get_outstanding_to_publish())
+        self.assertEqual([r['value'] for r in records], [1, 2, 3])
+        self.assertEqual([isinstance(r['_id'], tuple) for r in records],
+                         [True, False, True])
+
+    def test_all_handled_removes_rows(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2})
+        self.assertTrue(historian._publish_batches())
+        self.assertEqual(self.count(historian, 'outstanding_scrapes'), 0)
+        self.assertFalse(historian._publish_batches())
+
+    def test_partially_handled_scrape_keeps_remaining_points(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2, 'c': 3})
+        historian.handle = lambda records: historian.report_handled(
+            [records[0], records[2]])
+        self.assertTrue(historian._publish_batches())
+        self.assertEqual(self.count(historian, 'outstanding_scrapes'), 0)
+        self.assertEqual(self.count(historian, 'outstanding'), 1)
+
+        historian.handle = lambda records: historian.report_handled(records)
+        historian._publish_batches()
+        record, = historian.published[-1]
+        self.assertEqual(record['topic'], 'campus/device/b')
+        self.assertEqual(record['value'], 2)
+        self.assertEqual(record['timestamp'].replace(tzinfo=None), START)
+        self.assertEqual(self.count(historian, 'outstanding'), 0)
+
+    def test_unhandled_scrape_is_kept(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2})
+        historian.handle = lambda records: None
+        self.assertFalse(historian._publish_batches())
+        self.assertEqual(self.count(historian, 'outstanding_scrapes'), 1)
+
+    def test_point_lists_reloaded(self):
+        historian = Historian()
+        self.capture(historian, 'campus/device', {'a': 1, 'b': 2})
+        historian._connection.close()
+        historian = Historian()
+        records = list(historian._get_outstanding_to_publish())
+        self.assertEqual([(r['topic'], r['value']) for r in records],
+                         [('campus/device/a', 1), ('campus/device/b', 2)])
+
+
+
+class IngestQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.historian = Historian.__new__(Historian)
+        self.historian._event_queue = Queue()
+        self.historian._queue_high_water = 4
+        self.historian._queue_low_water = 2
+        self.historian._queue_overflow = 'drop'
+        self.historian._queue_throttled = False
+        self.historian._ingest_stats = defaultdict(int)
+
+    def test_drops_until_low_water(self):
+        historian = self.historian
+        for item in range(6):
+            historian._queue_event(item)
+        self.assertEqual(historian._event_queue.qsize(), 4)
+        self.assertEqual(historian._ingest_stats['dropped'], 2)
+        self.assertTrue(historian._queue_throttled)
+
+        historian._event_queue.get()
+        historian._queue_event(6)
+        self.assertEqual(historian._ingest_stats['dropped'], 3)
+        historian._event_queue.get()
+        historian._queue_event(7)
+        self.assertFalse(historian._queue_throttled)
+        self.assertEqual([historian._event_queue.get()[1] for _ in range(3)],
+                         [2, 3, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
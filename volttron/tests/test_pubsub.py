@@ -0,0 +1,265 @@
+import unittest
+
+from gevent.event import AsyncResult
+
+from volttron.platform.vip.agent.errors import Again, Unreachable
+from volttron.platform.vip.agent.serialization import JSON, MSGPACK, loads
+from volttron.platform.vip.agent.subsystems.pubsub import PubSub
+from volttron.platform.vip.utils import encode_peer
+
+
+class Signal(object):
+
+    def connect(self, receiver, *args, **kwargs):
+        pass
+
+
+class Socket(object):
+
+    identity = 'publisher'
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame, flags=0):
+        self.sent.append([frame])
+
+    def send_multipart(self, frames, copy=True):
+        self.sent[-1].extend(bytes(frame) for frame in frames)
+
+
+class Core(object):
+
+    def __init__(self):
+        self.socket = Socket()
+        self.onsetup = Signal()
+        self.handlers = {}
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+
+class Context(object):
+    pass
+
+
+class RPC(object):
+
+    def __init__(self):
+        self.encodings = {}
+        self.context = Context()
+        self.calls = []
+
+    def peer_encoding(self, peer):
+        return self.encodings.get(peer, JSON)
+
+    def call(self, peer, method, *args, **kwargs):
+        self.calls.append((peer, method, args, kwargs))
+        self.result = AsyncResult()
+        return self.result
+
+    def notify(self, peer, method, *args, **kwargs):
+        self.calls.append((peer, method, args, kwargs))
+
+
+class PeerList(object):
+    pass
+
+
+class Message(object):
+
+    def __init__(self, peer, args):
+        self.peer = peer
+        self.args = args
+
+
+class PubSubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.core = Core()
+        self.rpc = RPC()
+        self.peerlist = PeerList()
+        self.pubsub = PubSub(self.core, self.rpc, self.peerlist, None)
+        self.pubsub.add_bus('')
+        self.received = []
+
+    def callback(self, *args):
+        self.received.append(args)
+
+    def subscribe_peer(self, peer, prefix):
+        self.rpc.context.vip_message = Message(peer, [])
+        self.pubsub._peer_subscribe(prefix)
+
+
+class PushTests(PubSubTestCase):
+
+    def test_distribute_sends_push_frames(self):
+        self.subscribe_peer('subscriber', 'devices/')
+        self.subscribe_peer('other', 'analysis/')
+        count = self.pubsub._distribute('\x00sender', 'devices/a/all',
+                                        {'h': 1}, [1, 2])
+        self.assertEqual(count, 1)
+        (frames,) = self.core.socket.sent
+        self.assertEqual(frames[:5], ['subscriber', '', '', 'pubsub', 'push'])
+        self.assertEqual(loads(frames[5]),
+                         [encode_peer('\x00sender'), '', 'devices/a/all',
+                          {'h': 1}, [1, 2]])
+
+    def test_distribute_encodes_per_subscriber(self):
+        self.subscribe_peer('json', 'devices/')
+        self.subscribe_peer('msgpack', 'devices/')
+        self.rpc.encodings['msgpack'] = MSGPACK
+        self.pubsub._distribute('sender', 'devices/a', {}, 1)
+        payloads = {frames[0]: frames[5] for frames in self.core.socket.sent}
+        self.assertEqual(payloads['json'][:1], '[')
+        self.assertGreaterEqual(ord(payloads['msgpack'][0]), 0x80)
+        self.assertEqual(loads(payloads['json']), loads(payloads['msgpack']))
+
+    def test_push_frame_delivered_to_callback(self):
+        self.subscribe_peer('subscriber', 'devices/')
+        self.pubsub._distribute('\x00sender', 'devices/a/all', {'h': 1}, 5)
+        (frames,) = self.core.socket.sent
+
+        core, rpc = Core(), RPC()
+        subscriber = PubSub(core, rpc, self.peerlist, None)
+        subscriber.add_subscription('pubsub', 'devices/', self.callback)
+        message = Message('pubsub', frames[4:])
+        subscriber._handle_subsystem(message).join()
+        self.assertEqual(self.received, [
+            ('pubsub', '\x00sender', '', 'devices/a/all', {'h': 1}, 5)])
+
+    def test_invalid_push_ignored(self):
+        self.pubsub.add_subscription('pubsub', '', self.callback)
+        for args in ([], ['pull', '[]'], ['push'], ['push', '[1, 2]'],
+                     ['push', 'not json']):
+            self.pubsub._handle_subsystem(Message('pubsub', args)).join()
+        self.assertEqual(self.received, [])
+
+    def test_legacy_rpc_push(self):
+        self.pubsub.add_subscription('pubsub', 'devices/', self.callback)
+        self.rpc.context.vip_message = Message('pubsub', [])
+        self.pubsub._peer_push(encode_peer('\x00sender'), '',
+                               'devices/a', {}, 'message')
+        self.assertEqual(self.received, [
+            ('pubsub', '\x00sender', '', 'devices/a', {}, 'message')])
+
+    def test_unhandled_push_synchronizes(self):
+        self.pubsub.add_subscription('pubsub', 'devices/', self.callback)
+        self.pubsub._push('pubsub', 'sender', '', 'analysis/a', {}, None)
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.rpc.calls, [
+            ('pubsub', 'pubsub.sync', ({'': ['devices/']},), {})])
+
+
+class BatchTests(PubSubTestCase):
+
+    def pushed(self):
+        return [loads(frames[5])[2:] for frames in self.core.socket.sent]
+
+    def test_peer_batch_distributed_in_order(self):
+        self.subscribe_peer('subscriber', 'devices/')
+        self.rpc.context.vip_message = Message('publisher', [])
+        self.pubsub._peer_publish_batch([
+            ['devices/b', {'n': 1}, 1],
+            ['analysis/a', {}, 2],
+            ['devices/a', None, 3],
+            ['devices/b', {'n': 4}, 4]])
+        self.assertEqual(self.pushed(), [['devices/b', {'n': 1}, 1],
+                                         ['devices/a', {}, 3],
+                                         ['devices/b', {'n': 4}, 4]])
+
+    def test_local_batch(self):
+        self.subscribe_peer('subscriber', 'devices/')
+        self.pubsub.publish_batch(None, [('devices/a', {'n': 1}, 1),
+                                         ('devices/b', None, 2)])
+        self.assertEqual(self.pushed(), [['devices/a', {'n': 1}, 1],
+                                         ['devices/b', {}, 2]])
+
+    def test_remote_batch(self):
+        self.pubsub.publish_batch('pubsub', [('devices/a', None, 1)], 'bus')
+        self.assertEqual(self.rpc.calls, [
+            ('pubsub', 'pubsub.publish_batch', (),
+             {'items': [('devices/a', {}, 1)], 'bus': 'bus'})])
+
+    def test_invalid_batch_not_published(self):
+        self.subscribe_peer('subscriber', 'devices/')
+        self.rpc.context.vip_message = Message('publisher', [])
+        for invalid in (['devices/b', {}], ('devices/b', 'headers', 2),
+                        (None, {}, 2), 'devices/b'):
+            items = [('devices/a', {}, 1), invalid]
+            self.assertRaises(ValueError, self.pubsub._peer_publish_batch,
+                              items)
+            self.assertRaises(ValueError, self.pubsub.publish_batch,
+                              None, items)
+            self.assertRaises(ValueError, self.pubsub.publish_batch,
+                              'pubsub', items)
+        self.assertEqual(self.core.socket.sent, [])
+        self.assertEqual(self.rpc.calls, [])
+
+
+class PublishWindowTests(PubSubTestCase):
+
+    def setUp(self):
+        super(PublishWindowTests, self).setUp()
+        self.pubsub.publish_window = 3
+        self.pubsub.publish_window_timeout = 0.01
+
+    def publish(self, count=1, peer='pubsub'):
+        for _ in range(count):
+            self.pubsub.publish_nowait(peer, 'devices/a', message=1)
+
+    def test_window(self):
+        self.publish(2)
+        self.assertEqual(len(self.rpc.calls), 2)
+        self.assertIsNone(self.pubsub._publish_windows['pubsub'][1])
+        self.publish()
+        pending = self.pubsub._publish_windows['pubsub']
+        self.assertEqual(pending, (0, self.rpc.result))
+        self.publish(2)
+        self.assertEqual(self.pubsub._publish_windows['pubsub'],
+                         (2, self.rpc.result))
+
+        # The window is used up and the confirmation is outstanding.
+        self.assertRaises(Again, self.publish)
+        self.assertEqual(len(self.rpc.calls), 5)
+        pending[1].set(1)
+        self.publish()
+        self.assertEqual(len(self.rpc.calls), 6)
+        self.assertIsNot(self.pubsub._publish_windows['pubsub'][1],
+                         pending[1])
+
+    def test_failed_confirmation_does_not_block(self):
+        self.publish(3)
+        self.rpc.result.set_exception(ValueError())
+        self.publish(3)
+        self.assertEqual(len(self.rpc.calls), 6)
+
+    def test_windows_are_per_peer(self):
+        self.publish(3)
+        self.publish(3, peer='other')
+        self.assertEqual(self.pubsub._publish_windows['pubsub'][0], 0)
+        self.assertEqual(self.pubsub._publish_windows['other'][0], 0)
+
+    def test_reset_on_peer_drop(self):
+        self.publish(4)
+        self.pubsub._peer_drop(self.peerlist, 'pubsub')
+        self.assertNotIn('pubsub', self.pubsub._publish_windows)
+        self.publish(2)
+        self.assertEqual(self.pubsub._publish_windows['pubsub'], (2, None))
+
+    def test_reset_on_unreachable(self):
+        self.publish(5)
+        self.pubsub._viperror(self.core, Unreachable(
+            113, 'unreachable', 'pubsub', 'pubsub'))
+        self.assertNotIn('pubsub', self.pubsub._publish_windows)
+        self.publish(2)
+        self.assertEqual(len(self.rpc.calls), 7)
+
+    def test_disabled(self):
+        self.pubsub.publish_window = 0
+        self.publish(5)
+        self.assertEqual(self.pubsub._publish_windows, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
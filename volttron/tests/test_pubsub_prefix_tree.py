@@ -0,0 +1,65 @@
+import unittest
+
+from volttron.platform.vip.agent.subsystems.pubsub import PrefixTree
+
+
+class PrefixTreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = PrefixTree()
+
+    def test_match_unions_every_prefix(self):
+        self.tree.add('devices', {'a'})
+        self.tree.add('devices/campus', {'b'})
+        self.tree.add('devices/campus/building', {'c'})
+        self.tree.add('devices/other', {'d'})
+        self.assertEqual(self.tree.match('devices/campus/building/all'),
+                         {'a', 'b', 'c'})
+        self.assertEqual(self.tree.match('devices/other'), {'a', 'd'})
+
+    def test_empty_prefix_matches_everything(self):
+        self.tree.add('', {'all'})
+        self.assertEqual(self.tree.match('anything'), {'all'})
+        self.assertEqual(self.tree.match(''), {'all'})
+
+    def test_no_match(self):
+        self.tree.add('devices', {'a'})
+        self.assertEqual(self.tree.match('analysis/devices'), set())
+        self.assertEqual(self.tree.match('dev'), set())
+
+    def test_subscriber_sets_are_shared(self):
+        subscribers = {'a'}
+        self.tree.add('devices', subscribers)
+        subscribers.add('b')
+        self.assertEqual(self.tree.match('devices/x'), {'a', 'b'})
+        subscribers.clear()
+        self.assertEqual(self.tree.match('devices/x'), set())
+
+    def test_match_does_not_return_tree_sets(self):
+        subscribers = {'a'}
+        self.tree.add('devices', subscribers)
+        self.tree.match('devices').add('b')
+        self.assertEqual(subscribers, {'a'})
+
+    def test_remove_keeps_longer_and_shorter_prefixes(self):
+        self.tree.add('devices', {'a'})
+        self.tree.add('devices/campus', {'b'})
+        self.tree.add('devices/campus/building', {'c'})
+        self.tree.remove('devices/campus')
+        self.assertEqual(self.tree.match('devices/campus/building'),
+                         {'a', 'c'})
+
+    def test_remove_prunes_branches(self):
+        self.tree.add('devices/campus', {'a'})
+        self.tree.remove('devices/campus')
+        self.assertEqual(self.tree._root, [{}, None])
+
+    def test_remove_unknown_prefix(self):
+        self.tree.add('devices', {'a'})
+        self.tree.remove('devices/unknown')
+        self.tree.remove('other')
+        self.assertEqual(self.tree.match('devices/unknown'), {'a'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+from collections import deque
+import unittest
+
+from zmq.utils import jsonapi
+
+from volttron.platform.agent.base_historian import QueryStream
+from volttron.platform.vip.agent.results import ResultsTable
+from volttron.platform.vip.agent.serialization import JSON
+from volttron.platform.vip.agent.subsystems.rpc import Dispatcher, RPC
+
+
+class Socket(object):
+
+    def __init__(self):
+        self.idents = []
+
+    def send_vip(self, peer, subsystem, args, msg_id):
+        self.idents.append(msg_id)
+
+
+class Channel(object):
+    '''Plays the historian's side of query_stream.'''
+
+    name = 'stream'
+
+    def __init__(self, rpc, chunks):
+        self.rpc = rpc
+        self.chunks = deque(chunks)
+        self.incoming = deque(['ready'])
+        self.closed = False
+
+    def send(self, message):
+        if message == 'next':
+            # Let more than the RPC timeout pass before each chunk.
+            for _ in range(5):
+                self.rpc._expire()
+            self.incoming.append(jsonapi.dumps(
+                {'values': self.chunks.popleft() if self.chunks else []}))
+        elif message == 'done':
+            ident = self.rpc.core().socket.idents[0]
+            result = self.rpc._results.pop(ident)
+            if result is not None:
+                result.set(3)
+
+    def poll(self, timeout):
+        return bool(self.incoming)
+
+    def recv(self):
+        return self.incoming.popleft()
+
+    def close(self, linger=None):
+        self.closed = True
+
+
+class Agent(object):
+    pass
+
+
+def make_rpc(timeout):
+    class Core(object):
+        pass
+    core = Core()
+    core.socket = Socket()
+    rpc = RPC.__new__(RPC)
+    rpc.core = lambda: core
+    rpc.timeout = timeout
+    rpc.unanswered = 0
+    rpc._peer_encodings = {'platform.historian': JSON}
+    rpc._results = ResultsTable(resolution=1)
+    rpc._dispatcher = Dispatcher({}, None, rpc._results)
+    return rpc
+
+
+class QueryStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rpc = make_rpc(timeout=2)
+        self.channel = Channel(self.rpc, [[['t1', 1], ['t2', 2]],
+                                          [['t3', 3]]])
+        agent = self.agent = Agent()
+        agent.vip = Agent()
+        agent.vip.rpc = self.rpc
+        agent.vip.channel = lambda peer: self.channel
+
+    def test_stream_outlives_rpc_timeout(self):
+        stream = QueryStream(self.agent, 'platform.historian', 'topic')
+        self.assertEqual(list(stream),
+                         [('t1', 1), ('t2', 2), ('t3', 3)])
+        self.assertEqual(self.rpc.unanswered, 0)
+        self.assertTrue(self.channel.closed)
+
+    def test_other_calls_still_time_out(self):
+        result = self.rpc.call('platform.historian', 'query')
+        for _ in range(5):
+            self.rpc._expire()
+        self.assertTrue(result.ready())
+        self.assertEqual(self.rpc.unanswered, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import errno
+import unittest
+
+import gevent
+from gevent.event import AsyncResult
+
+from volttron.platform.vip.agent.errors import VIPError
+from volttron.platform.vip.agent.results import ResultsTable
+from volttron.platform.vip.agent.serialization import JSON
+from volttron.platform.vip.agent.subsystems.rpc import Dispatcher, RPC
+
+
+class ResultsTableTests(unittest.TestCase):
+
+    def test_add_and_pop(self):
+        table = ResultsTable()
+        ident = table.add('value')
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.pop(ident), 'value')
+        self.assertEqual(len(table), 0)
+        self.assertIsNone(table.pop(ident))
+
+    def test_pop_accepts_strings(self):
+        table = ResultsTable()
+        ident = table.add('value')
+        self.assertEqual(table.pop(bytes(ident)), 'value')
+
+    def test_pop_rejects_bad_idents(self):
+        table = ResultsTable()
+        table.add('value')
+        for ident in (None, 'abc', '', 2 ** 70, -1):
+            self.assertEqual(table.pop(ident, 'default'), 'default')
+        self.assertEqual(len(table), 1)
+
+    def test_reused_slot_ignores_stale_ident(self):
+        table = ResultsTable(size=1)
+        stale = table.add('first')
+        table.pop(stale)
+        current = table.add('second')
+        self.assertNotEqual(stale, current)
+        self.assertIsNone(table.pop(stale))
+        self.assertEqual(table.pop(current), 'second')
+
+    def test_grows_when_full(self):
+        table = ResultsTable(size=2)
+        idents = [table.add(i) for i in range(10)]
+        self.assertEqual(len(table), 10)
+        self.assertEqual([table.pop(ident) for ident in idents], range(10))
+        self.assertEqual(len(table), 0)
+
+    def test_expire_after_timeout(self):
+        table = ResultsTable(resolution=1)
+        old = table.add('old', 3)
+        table.expire()
+        new = table.add('new', 3)
+        self.assertEqual(table.expire(), [])
+        self.assertEqual(table.expire(), [])
+        self.assertEqual(table.expire(), ['old'])
+        self.assertIsNone(table.pop(old))
+        self.assertEqual(table.expire(), ['new'])
+        self.assertIsNone(table.pop(new))
+        self.assertEqual(len(table), 0)
+
+    def test_popped_entries_do_not_expire(self):
+        table = ResultsTable(resolution=1)
+        ident = table.add('value', 1)
+        table.pop(ident)
+        self.assertEqual(table.expire() + table.expire(), [])
+
+    def test_entries_without_timeout_do_not_expire(self):
+        table = ResultsTable(resolution=1)
+        ident = table.add('value')
+        for _ in range(1000):
+            self.assertEqual(table.expire(), [])
+        self.assertEqual(table.pop(ident), 'value')
+
+    def test_mixed_timeouts(self):
+        table = ResultsTable(resolution=0.5)
+        table.add('long', 10)
+        table.add('short', 1)
+        table.add('never')
+        expired = [table.expire() for _ in range(25)]
+        self.assertEqual(expired[2], ['short'])
+        self.assertEqual(expired[20], ['long'])
+        self.assertEqual(sum(expired, []), ['short', 'long'])
+        self.assertEqual(len(table), 1)
+
+
+class BatchEntryTests(unittest.TestCase):
+
+    class Socket(object):
+        def __init__(self):
+            self.sent = []
+
+        def send_vip(self, peer, subsystem, args, msg_id):
+            self.sent.append(msg_id)
+
+    def setUp(self):
+        socket = self.socket = self.Socket()
+        class Core(object):
+            pass
+        core = Core()
+        core.socket = socket
+        self.rpc = RPC.__new__(RPC)
+        self.rpc._results = ResultsTable()
+        self.rpc.core = lambda: core
+
+    def test_batch_entry_removed_when_members_resolve(self):
+        results = [AsyncResult(), AsyncResult()]
+        idents = [self.rpc._results.add(result) for result in results]
+        self.rpc._send_batch('peer', 'request', idents, results)
+        self.assertEqual(len(self.rpc._results), 3)
+        self.rpc._results.pop(idents[0]).set(1)
+        gevent.sleep(0)
+        self.assertEqual(len(self.rpc._results), 2)
+        self.rpc._results.pop(idents[1]).set_exception(ValueError())
+        gevent.sleep(0)
+        self.assertEqual(len(self.rpc._results), 0)
+        self.assertIsNone(self.rpc._results.pop(self.socket.sent[0]))
+
+    def test_notifications_only(self):
+        self.rpc._send_batch('peer', 'request', [], [])
+        self.assertEqual(self.socket.sent, [b''])
+        self.assertEqual(len(self.rpc._results), 0)
+
+
+class CallTimeoutTests(unittest.TestCase):
+
+    class Socket(object):
+        def send_vip(self, peer, subsystem, args, msg_id):
+            pass
+
+    def setUp(self):
+        class Core(object):
+            pass
+        core = Core()
+        core.socket = self.Socket()
+        self.rpc = RPC.__new__(RPC)
+        self.rpc.core = lambda: core
+        self.rpc.timeout = None
+        self.rpc.unanswered = 0
+        self.rpc._peer_encodings = {'peer': JSON}
+        self.rpc._results = ResultsTable(resolution=1)
+        self.rpc._dispatcher = Dispatcher({}, None, self.rpc._results)
+
+    def expire(self, ticks):
+        for _ in range(ticks):
+            self.rpc._expire()
+        gevent.sleep(0)
+
+    def test_calls_wait_indefinitely_by_default(self):
+        result = self.rpc.call('peer', 'method')
+        self.expire(1000)
+        self.assertFalse(result.ready())
+
+    def test_call_with_timeout(self):
+        result = self.rpc.call_with_timeout(2, 'peer', 'method')
+        untimed = self.rpc.call('peer', 'method')
+        self.expire(2)
+        self.assertFalse(result.ready())
+        self.expire(1)
+        self.assertRaises(VIPError, result.get, block=False)
+        self.assertEqual(result.exception.errno, errno.ETIMEDOUT)
+        self.assertEqual(self.rpc.unanswered, 1)
+        self.assertFalse(untimed.ready())
+
+    def test_default_timeout(self):
+        self.rpc.timeout = 1
+        result = self.rpc.call('peer', 'method')
+        untimed = self.rpc.call_with_timeout(None, 'peer', 'method')
+        self.expire(2)
+        self.assertRaises(VIPError, result.get, block=False)
+        self.assertFalse(untimed.ready())
+
+
+if __name__ == '__main__':
+    unittest.main()
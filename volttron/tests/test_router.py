@@ -0,0 +1,161 @@
+import errno
+import unittest
+
+from zmq import Frame, ZMQError
+from zmq.error import Again
+
+from volttron.platform.vip.router import BaseRouter
+
+
+class Socket(object):
+    '''Router socket which records sends to peers.'''
+
+    def __init__(self, context, socket_type):
+        self.incoming = []
+        self.sent = []
+        self.busy = set()
+        self.gone = set()
+
+    def recv_multipart(self, flags=0, copy=True):
+        if not self.incoming:
+            raise Again()
+        return self.incoming.pop(0)
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        recipient = bytes(frames[0])
+        if recipient in self.gone:
+            raise ZMQError(errno.EHOSTUNREACH)
+        if recipient in self.busy:
+            raise Again()
+        self.sent.append([bytes(frame) for frame in frames])
+
+
+class Router(BaseRouter):
+
+    _socket_class = Socket
+
+    def setup(self):
+        pass
+
+    def lookup_user_id(self, sender, recipient, auth_token):
+        return b''
+
+
+class RouterTestCase(unittest.TestCase):
+
+    queue_limit = 2
+
+    def setUp(self):
+        self.router = Router(context=object(), queue_limit=self.queue_limit)
+        self.router.start()
+        self.socket = self.router.socket
+        self.msg_id = 0
+
+    def send(self, sender, recipient, route=True):
+        self.msg_id += 1
+        frames = [sender, recipient, b'VIP1', b'', str(self.msg_id),
+                  b'test', b'hello']
+        self.socket.incoming.append([Frame(frame) for frame in frames])
+        if route:
+            self.router.route()
+
+    def received(self, peer, subsystem=b'test'):
+        return [frames for frames in self.socket.sent
+                if frames[0] == peer and frames[5] == subsystem]
+
+    def msg_ids(self, peer):
+        return [frames[4] for frames in self.received(peer)]
+
+    def errors(self, peer):
+        return [(frames[4], int(frames[6]), frames[8])
+                for frames in self.received(peer, b'error')]
+
+
+class QueueTests(RouterTestCase):
+
+    def test_busy_recipient_queued(self):
+        self.socket.busy.add(b'b')
+        self.send(b'a', b'b')
+        self.send(b'a', b'b')
+        self.assertEqual(self.msg_ids(b'b'), [])
+        self.assertEqual(self.errors(b'a'), [])
+        self.assertEqual(self.router.queue_stats[b'b'],
+                         {'queued': 2, 'high_water': 2, 'dropped': 0})
+
+        self.socket.busy.clear()
+        self.router._flush_queues()
+        self.assertEqual(self.msg_ids(b'b'), ['1', '2'])
+        self.assertEqual(self.router._queues, {})
+
+    def test_full_queue_bounces(self):
+        self.socket.busy.add(b'b')
+        for _ in range(3):
+            self.send(b'a', b'b')
+        self.assertEqual(self.errors(b'a'), [('3', errno.EAGAIN, b'b')])
+        self.assertEqual(self.router.queue_stats[b'b'],
+                         {'queued': 2, 'high_water': 2, 'dropped': 1})
+
+    def test_order_kept_behind_queue(self):
+        self.socket.busy.add(b'b')
+        self.send(b'a', b'b')
+        self.socket.busy.clear()
+        self.send(b'a', b'b')
+        self.assertEqual(self.msg_ids(b'b'), [])
+        self.router._flush_queues()
+        self.assertEqual(self.msg_ids(b'b'), ['1', '2'])
+
+    def test_flush_stops_when_busy_again(self):
+        self.socket.busy.add(b'b')
+        self.send(b'a', b'b')
+        self.send(b'a', b'b')
+        self.socket.busy.clear()
+        send = self.socket.send_multipart
+        def send_one(frames, flags=0, copy=True):
+            send(frames, flags, copy)
+            self.socket.busy.add(b'b')
+        self.socket.send_multipart = send_one
+        self.router._flush_queues()
+        self.assertEqual(self.msg_ids(b'b'), ['1'])
+        self.assertEqual(self.router.queue_stats[b'b']['queued'], 1)
+
+    def test_unreachable_recipient_bounces_queued(self):
+        for peer in (b'a', b'b', b'c'):
+            self.send(peer, b'a')
+        self.socket.busy.add(b'b')
+        self.send(b'a', b'b')
+        self.send(b'c', b'b')
+        self.socket.gone.add(b'b')
+        self.router._flush_queues()
+        self.assertEqual(self.errors(b'a'), [('4', errno.EHOSTUNREACH, b'b')])
+        self.assertEqual(self.errors(b'c'), [('5', errno.EHOSTUNREACH, b'b')])
+        self.assertNotIn(b'b', self.router._peers)
+        self.assertNotIn(b'b', self.router.queue_stats)
+        self.assertEqual(self.router._queues, {})
+        drops = self.received(b'a', b'peerlist')[-1]
+        self.assertEqual(drops[6:], [b'drop', b'b'])
+
+
+class NoQueueTests(RouterTestCase):
+
+    queue_limit = 0
+
+    def test_busy_recipient_bounces(self):
+        self.socket.busy.add(b'b')
+        self.send(b'a', b'b')
+        self.assertEqual(self.errors(b'a'), [('1', errno.EAGAIN, b'b')])
+        self.assertEqual(self.router._queues, {})
+
+
+class DrainTests(RouterTestCase):
+
+    def test_drain_limit(self):
+        for _ in range(3):
+            self.send(b'a', b'b', route=False)
+        self.assertEqual(self.router.drain(2), 2)
+        self.assertEqual(self.router.drain(2), 1)
+        self.assertEqual(self.router.drain(2), 0)
+        self.assertEqual(self.msg_ids(b'b'), ['1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+import gevent
+import gevent.local
+
+from volttron.platform.vip.agent.results import ResultsTable
+from volttron.platform.vip.agent.serialization import JSON, dumps, loads
+from volttron.platform.vip.agent.subsystems.rpc import (Dispatcher, Pipeline,
+                                                        RPC)
+
+
+class Socket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send_vip(self, peer, subsystem, args, msg_id):
+        self.sent.append((peer, [loads(arg) for arg in args]))
+
+
+class Core(object):
+    pass
+
+
+def make_rpc():
+    core = Core()
+    core.socket = Socket()
+    rpc = RPC.__new__(RPC)
+    rpc.encoding = JSON
+    rpc.timeout = None
+    rpc._peer_encodings = {}
+    rpc._results = ResultsTable()
+    rpc.core = lambda: core
+    return rpc
+
+
+class PipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rpc = make_rpc()
+        self.sent = self.rpc.core().socket.sent
+
+    def methods(self, index=-1):
+        peer, (batch,) = self.sent[index]
+        return [request['method'] for request in batch]
+
+    def test_flush_on_exit(self):
+        with Pipeline(self.rpc, 'peer', max_delay=None) as pipeline:
+            result = pipeline.call('a', 1)
+            pipeline.notify('b')
+            self.assertEqual(self.sent, [])
+        peer, (batch,) = self.sent[0]
+        self.assertEqual(peer, 'peer')
+        self.assertEqual(batch[0]['params'], [1])
+        self.assertIn('id', batch[0])
+        self.assertNotIn('id', batch[1])
+        self.assertEqual(self.rpc._results.pop(batch[0]['id']), result)
+
+    def test_flush_at_max_size(self):
+        pipeline = Pipeline(self.rpc, 'peer', max_size=2, max_delay=None)
+        for method in 'abc':
+            pipeline.call(method)
+        self.assertEqual(self.methods(), ['a', 'b'])
+        pipeline.flush()
+        self.assertEqual(self.methods(), ['c'])
+        pipeline.flush()
+        self.assertEqual(len(self.sent), 2)
+
+    def test_flush_after_max_delay(self):
+        pipeline = Pipeline(self.rpc, 'peer', max_delay=0.01)
+        pipeline.call('a')
+        pipeline.call('b')
+        self.assertEqual(self.sent, [])
+        gevent.sleep(0.05)
+        self.assertEqual(self.methods(), ['a', 'b'])
+
+    def test_sequential_marker(self):
+        with Pipeline(self.rpc, 'peer', sequential=True) as pipeline:
+            pipeline.call('a')
+            pipeline.call('b')
+        peer, (batch,) = self.sent[0]
+        self.assertEqual(batch[0], {'jsonrpc': '2.0',
+                                    'method': 'rpc.sequential'})
+        self.assertEqual(self.methods(), ['rpc.sequential', 'a', 'b'])
+
+
+class DispatchBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        def slow(name):
+            gevent.sleep(0.02)
+            self.calls.append(name)
+            return name
+        def fast(name):
+            self.calls.append(name)
+            return name
+        def fail():
+            raise ValueError('failed')
+        methods = {'slow': slow, 'fast': fast, 'fail': fail}
+        self.dispatcher = Dispatcher(methods, gevent.local.local(),
+                                     ResultsTable())
+
+    def dispatch(self, requests, sequential=False):
+        batch = [{'jsonrpc': '2.0', 'method': method, 'params': params,
+                  'id': ident}
+                 for ident, (method, params) in enumerate(requests)]
+        if sequential:
+            batch.insert(0, {'jsonrpc': '2.0', 'method': 'rpc.sequential'})
+        return loads(self.dispatcher.dispatch(dumps(batch)))
+
+    def test_concurrent(self):
+        responses = self.dispatch([('slow', ['a']), ('fast', ['b'])])
+        self.assertEqual(self.calls, ['b', 'a'])
+        self.assertEqual([(r['id'], r['result']) for r in responses],
+                         [(0, 'a'), (1, 'b')])
+
+    def test_sequential(self):
+        responses = self.dispatch([('slow', ['a']), ('fast', ['b']),
+                                   ('slow', ['c'])], sequential=True)
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+        self.assertEqual([(r['id'], r['result']) for r in responses],
+                         [(0, 'a'), (1, 'b'), (2, 'c')])
+
+    def test_error_does_not_stop_batch(self):
+        for sequential in (False, True):
+            responses = self.dispatch([('fail', []), ('fast', ['b'])],
+                                      sequential)
+            self.assertIn('error', responses[0])
+            self.assertEqual(responses[1]['result'], 'b')
+
+    def test_single_request(self):
+        self.assertEqual(self.dispatch([('fast', ['a'])])[0]['result'], 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import unittest
+
+from volttron.platform.vip.agent import serialization
+from volttron.platform.vip.agent.serialization import (
+    JSON, MSGPACK, default_encoding, dumps, encoding_of, loads)
+
+
+MESSAGES = [
+    {'jsonrpc': '2.0', 'id': 1, 'method': 'echo', 'params': [u'caf\xe9']},
+    [{'jsonrpc': '2.0', 'id': 2, 'result': {'a': [1, 2.5, None, True]}}],
+    {},
+    [],
+]
+
+
+class SerializationTests(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        for message in MESSAGES:
+            data = dumps(message, JSON)
+            self.assertEqual(encoding_of(data), JSON)
+            self.assertEqual(loads(data), message)
+
+    def test_encoding_of_leading_whitespace_is_json(self):
+        self.assertEqual(encoding_of(' {}'), JSON)
+        self.assertEqual(loads(' {}'), {})
+
+    def test_encoding_of_empty_data_is_json(self):
+        self.assertEqual(encoding_of(''), JSON)
+        self.assertRaises(ValueError, loads, '')
+
+    def test_high_byte_is_msgpack(self):
+        for byte in ('\x80', '\x90', '\xde', '\xdd'):
+            self.assertEqual(encoding_of(byte + 'rest'), MSGPACK)
+
+    def test_invalid_json_raises_value_error(self):
+        self.assertRaises(ValueError, loads, '{"unterminated": ')
+
+    def test_default_encoding(self):
+        saved = os.environ.pop('VOLTTRON_MESSAGE_ENCODING', None)
+        try:
+            self.assertEqual(default_encoding(), JSON)
+            os.environ['VOLTTRON_MESSAGE_ENCODING'] = 'unknown'
+            self.assertEqual(default_encoding(), JSON)
+            os.environ['VOLTTRON_MESSAGE_ENCODING'] = JSON
+            self.assertEqual(default_encoding(), JSON)
+        finally:
+            if saved is None:
+                os.environ.pop('VOLTTRON_MESSAGE_ENCODING', None)
+            else:
+                os.environ['VOLTTRON_MESSAGE_ENCODING'] = saved
+
+
+@unittest.skipIf(serialization.msgpack is None, 'msgpack is not installed')
+class MessagePackTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        for message in MESSAGES:
+            data = dumps(message, MSGPACK)
+            self.assertEqual(encoding_of(data), MSGPACK)
+            self.assertEqual(loads(data), message)
+
+    def test_strings_decode_as_text(self):
+        message = {'topic': 'devices/all', 'value': [u'caf\xe9', 'on']}
+        decoded = loads(dumps(message, MSGPACK))
+        self.assertEqual(decoded, message)
+        self.assertEqual(decoded, loads(dumps(message, JSON)))
+        for value in decoded['value'] + decoded.keys():
+            self.assertIsInstance(value, unicode)
+
+    def test_keys_converted_like_json(self):
+        message = {'a': {1: 'one', 2.5: 'float', None: 'null',
+                         False: 'false'},
+                   'b': [{3: [{4: 'nested'}]}], 'c': ({5: 'tuple'},)}
+        decoded = loads(dumps(message, MSGPACK))
+        self.assertEqual(decoded, loads(dumps(message, JSON)))
+        self.assertEqual(decoded, {
+            'a': {'1': 'one', '2.5': 'float', 'null': 'null',
+                  'false': 'false'},
+            'b': [{'3': [{'4': 'nested'}]}], 'c': [{'5': 'tuple'}]})
+
+    def test_unsupported_key_raises_type_error(self):
+        self.assertRaises(TypeError, dumps, {(1, 2): 'tuple'}, MSGPACK)
+
+    def test_invalid_msgpack_raises_value_error(self):
+        data = dumps({'key': 'value' * 10}, MSGPACK)
+        self.assertRaises(ValueError, loads, data[:-5])
+
+    def test_default_encoding(self):
+        saved = os.environ.get('VOLTTRON_MESSAGE_ENCODING')
+        os.environ['VOLTTRON_MESSAGE_ENCODING'] = MSGPACK
+        try:
+            self.assertEqual(default_encoding(), MSGPACK)
+        finally:
+            if saved is None:
+                del os.environ['VOLTTRON_MESSAGE_ENCODING']
+            else:
+                os.environ['VOLTTRON_MESSAGE_ENCODING'] = saved
+
+
+if __name__ == '__main__':
+    unittest.main()